@@ -0,0 +1,395 @@
+"""
+ODX benchmark suite, over synthetic data (see `synthetic`).
+
+Times every phase separately, and appends the results (with the git commit,
+library versions and dataset parameters) to a results file, one json line
+per run. Each run is compared with the previous run of the same dataset,
+so regressions are visible between versions.
+"""
+import json
+import time
+import socket
+import argparse
+import datetime
+import platform
+import subprocess
+import importlib.util
+from pathlib import Path
+import numpy as np
+import pandas as pd
+from rich import print
+from rich.table import Table
+
+from odx import config
+from odx.bus_schedule import BusSchedule
+from odx.metro_schedule import MetroSchedule
+from odx.geo import StopsDistance
+from odx.odx import ODX
+from odx.od_matrix import ODMatrix
+from odx.report import get_max_rss_mb
+
+from synthetic import SyntheticParams, generate_dataset, load_params
+
+REPO_PATH = Path(__file__).resolve().parents[1]
+RESULTS_PATH = REPO_PATH / "benchmarks" / "results.jsonl"
+DATA_PATH = f"{config.DATA_PATH}/synthetic"
+
+PHASES = [
+    "bus_schedule",
+    "bus_schedule_bundle",
+    "metro_schedule",
+    "stops_distance",
+    "get_stages",
+    "infer_destinations",
+    "get_stage_table",
+    "infer_destinations_table",
+    "link_journeys_table",
+    "od_matrix_table",
+    "process_carris_afc",
+    "process_metro_afc",
+    "combine_afc",
+]
+
+# results needed by each phase, computed before it is timed
+PHASE_INPUTS = {
+    "stops_distance": ["bus_schedule", "metro_schedule"],
+    "get_stages": ["odx", "afc"],
+    "infer_destinations": ["odx", "get_stages"],
+    "get_stage_table": ["odx", "afc"],
+    "infer_destinations_table": ["odx", "get_stage_table"],
+    "link_journeys_table": ["odx", "infer_destinations_table"],
+    "od_matrix_table": ["odx", "link_journeys_table"],
+    "combine_afc": ["process_carris_afc", "process_metro_afc"],
+}
+
+
+def load_script(name):
+    """Imports `preprocessing/<name>.py`, which is not a package"""
+    path = REPO_PATH / "preprocessing" / f"{name}.py"
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def check_od_matrix(od_matrix, expected, name):
+    """Raises a `RuntimeError` if the cells of two `ODMatrix` differ"""
+    if not (
+        np.array_equal(od_matrix.keys, expected.keys)
+        and np.allclose(od_matrix.counts, expected.counts)
+    ):
+        raise RuntimeError(f"OD matrix {name} differs from the expected one")
+
+
+def get_git_revision():
+    try:
+        commit = subprocess.check_output(
+            ["git", "rev-parse", "HEAD"], cwd=REPO_PATH, text=True
+        ).strip()
+        dirty = bool(
+            subprocess.check_output(
+                ["git", "status", "--porcelain", "--untracked-files=no"],
+                cwd=REPO_PATH,
+                text=True,
+            ).strip()
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return f"{commit}-dirty" if dirty else commit
+
+
+class Benchmark:
+    """
+    Runs the benchmark phases over the synthetic dataset in `data_path`,
+    in `PHASES` order. The inputs of each phase (see `PHASE_INPUTS`)
+    are computed before it is timed, by running the phases they come from
+    if they were not selected.
+    """
+
+    def __init__(self, data_path, phases=PHASES):
+        self.data_path = Path(data_path)
+        self.work_path = self.data_path / "benchmark"
+        self.work_path.mkdir(exist_ok=True)
+        self.phases = phases
+        self.results = {}
+        self._cache = {}
+
+    def run(self):
+        for phase in PHASES:
+            if phase in self.phases:
+                self.timed(phase)
+        return self.results
+
+    def timed(self, phase):
+        for input_ in PHASE_INPUTS.get(phase, []):
+            self.get(input_)
+
+        print(f"[bold]Running {phase}..")
+        start = time.perf_counter()
+        getattr(self, phase)()
+        seconds = time.perf_counter() - start
+
+        self.results[phase] = {
+            "seconds": round(seconds, 4),
+            "max_rss_mb": round(get_max_rss_mb(), 1),
+        }
+        print(f"{phase}: {seconds:.3f}s")
+
+    def get(self, phase):
+        """Result of `phase`, running it (untimed) if needed"""
+        if phase not in self._cache:
+            getattr(self, phase)()
+        return self._cache[phase]
+
+    def bus_schedule(self):
+        self._cache["bus_schedule"] = BusSchedule(
+            stops_path=self.data_path / "stops.json",
+            routes_path=self.data_path / "routes.json",
+            stage_times_gtfs_path=self.data_path / "bus_stage_times_gtfs.json",
+            bundle_path=None,
+            force=True,
+        )
+
+    def bus_schedule_bundle(self):
+        bundle_path = self.work_path / "bus_schedule_bundle"
+        if not (bundle_path / "meta.json").exists():
+            self.get("bus_schedule").compile(bundle_path)
+
+        self._cache["bus_schedule"] = BusSchedule(
+            stops_path=self.data_path / "stops.json",
+            routes_path=self.data_path / "routes.json",
+            stage_times_gtfs_path=self.data_path / "bus_stage_times_gtfs.json",
+            bundle_path=bundle_path,
+            force=True,
+        )
+
+    def metro_schedule(self):
+        self._cache["metro_schedule"] = MetroSchedule(
+            gtfs_path=self.data_path / "gtfs_metro",
+            bundle_path=None,
+            force=True,
+        )
+
+    def stops_distance(self):
+        self._cache["stops_distance"] = StopsDistance(
+            self.get("bus_schedule").stops + self.get("metro_schedule").stops,
+            dense=config.DENSE_STOPS_DISTANCE,
+        )
+
+    def odx(self):
+        # ODX uses the schedules built above, which are singletons
+        self.get("bus_schedule")
+        self.get("metro_schedule")
+        self._cache["odx"] = ODX()
+
+    def afc(self):
+        self._cache["afc"] = pd.read_feather(self.data_path / "afc.feather")
+
+    def get_stages(self):
+        self._cache["get_stages"] = self.get("odx").get_stages(self.get("afc"))
+
+    def infer_destinations(self):
+        self._cache["infer_destinations"] = self.get("odx").infer_destinations(
+            self.get("get_stages")
+        )
+
+    def get_stage_table(self):
+        self._cache["get_stage_table"] = self.get("odx").get_stage_table(
+            self.get("afc")
+        )
+
+    def infer_destinations_table(self):
+        self._cache["infer_destinations_table"] = self.get(
+            "odx"
+        ).infer_destinations_table(self.get("get_stage_table"))
+
+    def link_journeys_table(self):
+        _, self._cache["link_journeys_table"] = self.get(
+            "odx"
+        ).link_journeys_table(self.get("infer_destinations_table"))
+
+    def od_matrix_table(self):
+        """
+        Accumulates the journeys into an OD matrix one day at a time, and
+        merges the matrices of every day through save/load and update,
+        checking both against the matrix of all the days
+        """
+        odx = self.get("odx")
+        journeys = self.get("link_journeys_table")
+
+        od_matrix = None
+        day_paths = []
+        for day, day_journeys in journeys.groupby("day"):
+            od_matrix = odx.od_matrix_table(
+                journeys=day_journeys, od_matrix=od_matrix
+            )
+            day_path = self.work_path / f"od_matrix_{day:%Y%m%d}.npz"
+            odx.od_matrix_table(journeys=day_journeys).save(day_path)
+            day_paths.append(day_path)
+
+        merged = ODMatrix.load(day_paths[0])
+        for day_path in day_paths[1:]:
+            merged.update(ODMatrix.load(day_path))
+
+        expected = odx.od_matrix_table(journeys)
+        check_od_matrix(od_matrix, expected, "accumulated by day")
+        check_od_matrix(merged, expected, "merged from saved days")
+        self._cache["od_matrix_table"] = od_matrix
+
+    def process_carris_afc(self):
+        output_path = self.work_path / "afc_carris.feather"
+        load_script("process_carris_afc").process_carris_afc(
+            self.data_path / "raw" / "afc_carris.csv",
+            output_path=output_path,
+            card_mapping_path=self.work_path / "card_mapping.feather",
+        )
+        self._cache["process_carris_afc"] = output_path
+
+    def process_metro_afc(self):
+        output_path = self.work_path / "afc_metro.feather"
+        load_script("process_metro_afc").process_metro_afc(
+            self.data_path / "raw" / "afc_metro.csv",
+            metro_stop_mapping_path=self.data_path / "metro_stop_mapping.json",
+            output_path=output_path,
+            card_mapping_path=self.work_path / "card_mapping.feather",
+        )
+        self._cache["process_metro_afc"] = output_path
+
+    def combine_afc(self):
+        params = load_params(self.data_path)
+        start_date = datetime.date.fromisoformat(params.start_date)
+        # the last service day ends on the next day
+        end_date = start_date + datetime.timedelta(days=params.n_days)
+
+        load_script("combine_afc").get_combined_afc(
+            afc_sources={
+                "bus": self.get("process_carris_afc"),
+                "metro": self.get("process_metro_afc"),
+            },
+            start_date=start_date,
+            end_date=end_date,
+            output_path=str(self.work_path / "combined_afc"),
+        )
+        self._cache["combine_afc"] = True
+
+
+def get_environment():
+    return {
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "pandas": pd.__version__,
+        "platform": platform.platform(),
+        "host": socket.gethostname(),
+    }
+
+
+def load_results(results_path):
+    try:
+        with open(results_path) as f:
+            return [json.loads(line) for line in f if line.strip()]
+    except FileNotFoundError:
+        return []
+
+
+def save_result(result, results_path):
+    with open(results_path, "a") as f:
+        f.write(json.dumps(result) + "\n")
+
+
+def print_comparison(result, previous):
+    table = Table(title=f"ODX benchmark ({result['params']['n_taps']} taps)")
+    table.add_column("phase")
+    table.add_column("seconds", justify="right")
+    table.add_column("max rss (MB)", justify="right")
+    table.add_column("previous (s)", justify="right")
+    table.add_column("change", justify="right")
+
+    for phase, phase_result in result["phases"].items():
+        seconds = phase_result["seconds"]
+        prev = (previous or {}).get("phases", {}).get(phase)
+        if prev:
+            change = seconds / prev["seconds"] - 1 if prev["seconds"] else 0
+            color = "red" if change > 0.1 else "green" if change < -0.1 else ""
+            change = f"[{color}]{change:+.0%}" if color else f"{change:+.0%}"
+            prev = f"{prev['seconds']:.3f}"
+        else:
+            prev, change = "-", "-"
+        table.add_row(
+            phase,
+            f"{seconds:.3f}",
+            f"{phase_result['max_rss_mb']:.0f}",
+            prev,
+            change,
+        )
+    print(table)
+    if previous:
+        print(f"Compared with run of {previous['date']} ({previous['git']})")
+
+
+def run_benchmarks(
+    params,
+    data_path=DATA_PATH,
+    phases=PHASES,
+    results_path=RESULTS_PATH,
+):
+    """
+    Runs the benchmark `phases` over a synthetic dataset with `params`,
+    generated in `data_path` unless it is already there.
+    Appends the results to `results_path`.
+    """
+    if load_params(data_path) is None or (
+        load_params(data_path).to_dict() != params.to_dict()
+    ):
+        generate_dataset(data_path, params)
+
+    phase_results = Benchmark(data_path, phases).run()
+
+    result = {
+        "date": datetime.datetime.now().isoformat(timespec="seconds"),
+        "git": get_git_revision(),
+        "environment": get_environment(),
+        "params": params.to_dict(),
+        "phases": phase_results,
+    }
+    previous = [
+        r
+        for r in load_results(results_path)
+        if r["params"] == result["params"]
+        and r["environment"]["host"] == result["environment"]["host"]
+    ]
+    save_result(result, results_path)
+    print_comparison(result, previous[-1] if previous else None)
+    return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run ODX benchmarks")
+    parser.add_argument(
+        "-n", "--taps", type=int, default=100_000, help="number of afc records"
+    )
+    parser.add_argument(
+        "-d", "--days", type=int, default=3, help="number of days"
+    )
+    parser.add_argument("-s", "--seed", type=int, default=0, help="seed")
+    parser.add_argument(
+        "-p",
+        "--phases",
+        nargs="+",
+        choices=PHASES,
+        default=PHASES,
+        help="phases to run, all by default",
+    )
+    parser.add_argument(
+        "--data", help="synthetic dataset directory", default=DATA_PATH
+    )
+    parser.add_argument(
+        "-o", "--output", help="results file", default=RESULTS_PATH
+    )
+
+    args = parser.parse_args()
+    run_benchmarks(
+        SyntheticParams(n_taps=args.taps, n_days=args.days, seed=args.seed),
+        data_path=args.data,
+        phases=args.phases,
+        results_path=args.output,
+    )
@@ -0,0 +1,806 @@
+"""
+Synthetic AFC and schedule data, for benchmarking without the real dumps.
+
+Generates, in a single directory:
+- a bus network: `stops.json`, `routes.json` and `bus_stage_times_gtfs.json`,
+  as written by `process_carris_schedule`
+- a GTFS-shaped metro folder (`gtfs_metro`) and `metro_stop_mapping.json`
+- a GTFS-shaped Carris folder (`gtfs_carris`), with trips of every bus
+  route through the day, slower at rush hours
+- the afc of a population of cards over several days: the combined afc
+  (`afc.feather`, as written by `combine_afc`) and, optionally, the raw
+  Carris and Metro csv files read by the preprocessing scripts (`raw/`)
+
+Cards travel in chains: every stage boards close to where the previous one
+alighted, so destinations can be inferred. The data includes CIRC routes,
+metro stages without an exit (or entry) tap, unknown stops and routes, and
+duplicated raw taps. The afc is generated and written one day at a time.
+"""
+import json
+import math
+import string
+import argparse
+import datetime
+from pathlib import Path
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+from rich import print
+from tqdm.auto import tqdm
+
+from odx.geo import StopsIndex
+from odx.config import ODXConfig
+
+PARAMS_FILE = "params.json"
+
+# city center and size (degrees), about the size of Lisbon
+CENTER_LAT, CENTER_LON = 38.74, -9.15
+SPAN_LAT, SPAN_LON = 0.11, 0.14
+
+METRO_LINES = ["Amarela", "Azul", "Verde", "Vermelha"]
+
+CARRIS_RAW_COLUMNS = {
+    "timestamp": "Data/Hora",
+    "card_id": "NºSerie",
+    "stop_id": "IDParagem",
+    "route_direction": "Sentido",
+    "route_id": "Carreira",
+    "route_variant": "Variante",
+    "stop_name": "Designação",
+    "stop_number": "Paragem",
+    "description": "Descrição",
+}
+METRO_RAW_COLUMNS = {
+    "date": "FECHA",
+    "time": "HORA",
+    "stop_id": "ESTACAO",
+    "card_id": "NUM_SER",
+    "way": "E_S",
+}
+
+UNKNOWN_ROUTE_ID = "X"
+
+# service hours and headway (seconds) of the bus gtfs trips
+BUS_SERVICE_HOURS = (6, 24)
+BUS_HEADWAY = 20 * 60
+BUS_DWELL_TIME = 20
+
+
+def traffic_factor(seconds):
+    """Bus stage time multiplier at a time of day, peaking at rush hours"""
+    hours = np.asarray(seconds) / 3600
+    return (
+        1
+        + 0.4 * np.exp(-(((hours - 8.5) / 1.0) ** 2))
+        + 0.3 * np.exp(-(((hours - 18) / 1.2) ** 2))
+    )
+
+
+def to_gtfs_times(seconds):
+    """'HH:MM:SS' strings of integer seconds after midnight"""
+    seconds = pd.Series(np.asarray(seconds, dtype=np.int64))
+    return (
+        (seconds // 3600).astype(str).str.zfill(2)
+        + ":"
+        + (seconds // 60 % 60).astype(str).str.zfill(2)
+        + ":"
+        + (seconds % 60).astype(str).str.zfill(2)
+    )
+
+
+class SyntheticParams:
+    """
+    Parameters of a synthetic dataset.
+
+    Parameters
+    ----------
+    n_taps: int
+        approximate number of afc records
+    n_days: int
+        number of service days, starting on `start_date`
+    n_bus_stops: int
+    n_bus_lines: int
+        number of bus lines. Most have an ASC and a DESC route,
+        some have an extra variant, and every `circ_every` is CIRC
+    n_metro_stations: int
+    mean_stages: float
+        mean number of stages of a card in a day
+    metro_share: float
+        probability of a stage being a metro stage
+    missing_exit: float
+        probability of a metro stage having no exit tap
+    missing_entry: float
+        probability of a metro stage having no entry tap
+    unknown_stop: float
+        probability of a bus tap's stop not being in the schedule
+    unknown_route: float
+        probability of a bus tap's route not being in the schedule
+    duplicates: float
+        probability of a raw carris tap being duplicated
+    active_share: float
+        probability of a card travelling on a given day
+    """
+
+    def __init__(
+        self,
+        n_taps=100_000,
+        n_days=3,
+        start_date="2019-10-07",
+        seed=0,
+        n_bus_stops=2000,
+        n_bus_lines=170,
+        n_metro_stations=56,
+        circ_every=8,
+        mean_stages=2.5,
+        metro_share=0.35,
+        missing_exit=0.1,
+        missing_entry=0.02,
+        unknown_stop=0.01,
+        unknown_route=0.01,
+        duplicates=0.005,
+        active_share=0.8,
+    ):
+        self.n_taps = int(n_taps)
+        self.n_days = int(n_days)
+        self.start_date = str(start_date)
+        self.seed = int(seed)
+        self.n_bus_stops = int(n_bus_stops)
+        self.n_bus_lines = int(n_bus_lines)
+        self.n_metro_stations = int(n_metro_stations)
+        self.circ_every = int(circ_every)
+        self.mean_stages = float(mean_stages)
+        self.metro_share = float(metro_share)
+        self.missing_exit = float(missing_exit)
+        self.missing_entry = float(missing_entry)
+        self.unknown_stop = float(unknown_stop)
+        self.unknown_route = float(unknown_route)
+        self.duplicates = float(duplicates)
+        self.active_share = float(active_share)
+
+    def to_dict(self):
+        return dict(vars(self))
+
+    @property
+    def n_cards(self):
+        """Number of cards needed for about `n_taps` records"""
+        taps_per_stage = 1 + self.metro_share * (1 - self.missing_exit)
+        taps_per_day = self.active_share * self.mean_stages * taps_per_stage
+        return max(1, math.ceil(self.n_taps / (self.n_days * taps_per_day)))
+
+
+class SyntheticNetwork:
+    """Bus and metro network, with the lookups used to generate afc"""
+
+    # nearest stops considered when boarding close to a location
+    N_NEAREST = 6
+
+    def __init__(self, params, rng):
+        self.params = params
+        self._build_bus_stops(rng)
+        self._build_bus_routes(rng)
+        self._build_metro(rng)
+
+    def _build_bus_stops(self, rng):
+        n = self.params.n_bus_stops
+        self.stop_ids = np.arange(1000, 1000 + n)
+        self.stop_lats = CENTER_LAT + rng.uniform(-0.5, 0.5, n) * SPAN_LAT
+        self.stop_lons = CENTER_LON + rng.uniform(-0.5, 0.5, n) * SPAN_LON
+
+        self.stop_index = StopsIndex.from_arrays(
+            self.stop_ids, self.stop_lats, self.stop_lons
+        )
+        # the stop itself is its closest stop
+        self.nearest, _ = self.stop_index.query_nearest(
+            self.stop_lats, self.stop_lons, k=self.N_NEAREST + 1
+        )
+
+    def _walk(self, rng, length):
+        """
+        Stop positions of a route: a walk through nearby stops, keeping
+        roughly the same heading
+        """
+        heading = rng.uniform(0, 2 * np.pi)
+        positions = [int(rng.integers(len(self.stop_ids)))]
+        visited = set(positions)
+
+        for _ in range(length - 1):
+            current = positions[-1]
+            candidates = [
+                p for p in self.nearest[current, 1:] if p not in visited
+            ]
+            if not candidates:
+                break
+            candidates = np.array(candidates)
+            d_lat = self.stop_lats[candidates] - self.stop_lats[current]
+            d_lon = self.stop_lons[candidates] - self.stop_lons[current]
+            alignment = np.cos(np.arctan2(d_lat, d_lon) - heading)
+            alignment += rng.normal(0, 0.5, len(candidates))
+            positions.append(int(candidates[np.argmax(alignment)]))
+            visited.add(positions[-1])
+            heading += rng.normal(0, 0.2)
+        return positions
+
+    def _build_bus_routes(self, rng):
+        self.routes = []
+        for line in range(self.params.n_bus_lines):
+            route_id = str(700 + line)
+            positions = self._walk(rng, int(rng.integers(15, 45)))
+            sids = [int(s) for s in self.stop_ids[positions]]
+
+            if line % self.params.circ_every == 0:
+                # circ routes have the first stop_id twice, first and last
+                self.routes.append((route_id, "CIRC", 0, sids + [sids[0]]))
+                continue
+
+            self.routes.append((route_id, "ASC", 0, sids))
+            self.routes.append((route_id, "DESC", 0, sids[::-1]))
+            if line % 3 == 0:
+                # shorter variant
+                self.routes.append((route_id, "ASC", 1, sids[2:-2]))
+
+        # stops of every route, flattened. Circ routes without the last stop
+        sid_to_pos = {sid: pos for pos, sid in enumerate(self.stop_ids)}
+        route_stops = [
+            [sid_to_pos[s] for s in (sids[:-1] if d == "CIRC" else sids)]
+            for _, d, _, sids in self.routes
+        ]
+        self.route_lens = np.array([len(s) for s in route_stops])
+        self.route_starts = np.cumsum(self.route_lens) - self.route_lens
+        self.route_is_circ = np.array(
+            [d == "CIRC" for _, d, _, _ in self.routes]
+        )
+        route_stops = np.concatenate(route_stops)
+        self.route_stops = route_stops
+
+        # (route, position) of every stop visit, grouped by stop
+        visit_routes = np.repeat(np.arange(len(self.routes)), self.route_lens)
+        visit_pos = np.arange(len(route_stops)) - np.repeat(
+            self.route_starts, self.route_lens
+        )
+        order = np.argsort(route_stops, kind="stable")
+        self.visit_routes = visit_routes[order]
+        self.visit_pos = visit_pos[order]
+        self.visit_counts = np.bincount(
+            route_stops, minlength=len(self.stop_ids)
+        )
+        self.visit_starts = np.cumsum(self.visit_counts) - self.visit_counts
+
+    def _build_metro(self, rng):
+        n = self.params.n_metro_stations
+        self.station_ids = np.arange(1, n + 1)
+        self.station_codes = np.array(
+            [
+                string.ascii_uppercase[i // 26]
+                + string.ascii_uppercase[i % 26]
+                for i in range(n)
+            ]
+        )
+
+        # every line is a straight-ish line through the city
+        self.lines = []
+        lats, lons = [], []
+        for station_pos in np.array_split(np.arange(n), len(METRO_LINES)):
+            angle = rng.uniform(0, np.pi)
+            t = np.linspace(-0.5, 0.5, len(station_pos))
+            lats.append(
+                CENTER_LAT
+                + t * SPAN_LAT * np.sin(angle)
+                + rng.normal(0, 0.002, len(t))
+            )
+            lons.append(
+                CENTER_LON
+                + t * SPAN_LON * np.cos(angle)
+                + rng.normal(0, 0.002, len(t))
+            )
+            self.lines.append(station_pos)
+        self.station_lats = np.concatenate(lats)
+        self.station_lons = np.concatenate(lons)
+
+        # closest bus stop of each station, and closest station of each stop
+        self.station_stop, _ = self.stop_index.query_nearest(
+            self.station_lats, self.station_lons
+        )
+        self.station_stop = self.station_stop[:, 0]
+        station_index = StopsIndex.from_arrays(
+            self.station_ids, self.station_lats, self.station_lons
+        )
+        self.stop_station, _ = station_index.query_nearest(
+            self.stop_lats, self.stop_lons
+        )
+        self.stop_station = self.stop_station[:, 0]
+
+    def board_bus(self, rng, near):
+        """
+        Boards a random route at one of the stops closest to the stops
+        in `near` (stop positions).
+        Returns (route idx, position in route), -1 routes if none
+        """
+        choice = rng.integers(self.N_NEAREST + 1, size=len(near))
+        stops = self.nearest[near, choice]
+        counts = self.visit_counts[stops]
+        visits = self.visit_starts[stops] + np.floor(
+            rng.random(len(near)) * counts
+        ).astype(np.int64)
+        visits = np.minimum(visits, len(self.visit_routes) - 1)
+
+        routes = np.where(counts > 0, self.visit_routes[visits], -1)
+        return routes, self.visit_pos[visits]
+
+    def alight_bus(self, rng, routes, positions):
+        """Random subsequent position in each route"""
+        lens = self.route_lens[routes]
+        circ = self.route_is_circ[routes]
+        r = rng.random(len(routes))
+
+        remaining = np.where(circ, lens - 1, lens - 1 - positions)
+        exits = positions + 1 + np.floor(r * remaining).astype(np.int64)
+        exits = np.where(circ, exits % lens, exits)
+        return np.where(remaining > 0, exits, positions)
+
+    def route_stop(self, routes, positions):
+        """Stop position of the `positions`-th stop of each route"""
+        return self.route_stops[self.route_starts[routes] + positions]
+
+    def save_schedules(self, path, rng):
+        """Writes the bus schedule files and the metro gtfs folder"""
+        path = Path(path)
+        stops = [
+            {
+                "stop_id": int(sid),
+                "stop_name": f"Paragem {sid}",
+                "stop_lat": float(lat),
+                "stop_lon": float(lon),
+                "street_point": None,
+            }
+            for sid, lat, lon in zip(
+                self.stop_ids, self.stop_lats, self.stop_lons
+            )
+        ]
+        with open(path / "stops.json", "w") as f:
+            json.dump(stops, f)
+
+        routes = [
+            {
+                "route_id": route_id,
+                "route_direction": direction,
+                "route_variant": variant,
+                "route_stop_ids": sids,
+            }
+            for route_id, direction, variant, sids in self.routes
+        ]
+        with open(path / "routes.json", "w") as f:
+            json.dump(routes, f)
+
+        # ~18 km/h between stops, some pairs missing
+        sid_to_pos = {sid: pos for pos, sid in enumerate(self.stop_ids)}
+        stage_times = {}
+        for _, _, _, sids in self.routes:
+            for from_sid, to_sid in zip(sids[:-1], sids[1:]):
+                if rng.random() < 0.02:
+                    continue
+                a, b = sid_to_pos[from_sid], sid_to_pos[to_sid]
+                dist_km = math.hypot(
+                    (self.stop_lats[a] - self.stop_lats[b]) * 111,
+                    (self.stop_lons[a] - self.stop_lons[b]) * 87,
+                )
+                stage_times.setdefault(str(from_sid), {})[str(to_sid)] = round(
+                    dist_km / 18 * 3600 + rng.uniform(10, 40)
+                )
+        with open(path / "bus_stage_times_gtfs.json", "w") as f:
+            json.dump(stage_times, f)
+
+        self._save_bus_gtfs(path / "gtfs_carris", stage_times)
+        self._save_metro_gtfs(path / "gtfs_metro")
+
+        mapping = {
+            code: f"M{sid}"
+            for code, sid in zip(self.station_codes, self.station_ids)
+        }
+        with open(path / "metro_stop_mapping.json", "w") as f:
+            json.dump(mapping, f)
+
+    def _save_bus_gtfs(self, path, stage_times):
+        """
+        Writes a trip of every bus route every `BUS_HEADWAY` seconds of the
+        service hours, with the `stage_times` (30s where missing) scaled by
+        the `traffic_factor` of its departure
+        """
+        path.mkdir(parents=True, exist_ok=True)
+        # its own generator, so the afc of a seed does not change
+        rng = np.random.default_rng(self.params.seed + 1)
+        starts = np.arange(
+            BUS_SERVICE_HOURS[0] * 3600,
+            BUS_SERVICE_HOURS[1] * 3600,
+            BUS_HEADWAY,
+        )
+
+        route_ids = sorted({route_id for route_id, _, _, _ in self.routes})
+        pd.DataFrame(
+            {"route_id": route_ids, "route_short_name": route_ids}
+        ).to_csv(path / "routes.txt", index=False)
+
+        trips, stop_times = [], []
+        for route_id, direction, variant, sids in self.routes:
+            trip_ids = [
+                f"{route_id}_{direction}_{variant}_{k}"
+                for k in range(len(starts))
+            ]
+            trips.append(
+                pd.DataFrame(
+                    {
+                        "route_id": route_id,
+                        "service_id": "DU",
+                        "trip_id": trip_ids,
+                        "direction_id": int(direction == "DESC"),
+                    }
+                )
+            )
+
+            base_times = np.array(
+                [
+                    stage_times.get(str(from_sid), {}).get(str(to_sid), 30)
+                    for from_sid, to_sid in zip(sids[:-1], sids[1:])
+                ],
+                dtype=np.float64,
+            )
+            # (trips x stages)
+            times = (
+                base_times[None, :]
+                * traffic_factor(starts)[:, None]
+                * rng.uniform(0.9, 1.1, (len(starts), len(base_times)))
+            )
+            arrivals = starts[:, None] + np.concatenate(
+                [
+                    np.zeros((len(starts), 1)),
+                    np.cumsum(times + BUS_DWELL_TIME, axis=1),
+                ],
+                axis=1,
+            ).round().astype(np.int64)
+            stop_times.append(
+                pd.DataFrame(
+                    {
+                        "trip_id": np.repeat(trip_ids, len(sids)),
+                        "arrival_time": to_gtfs_times(arrivals.ravel()),
+                        "departure_time": to_gtfs_times(
+                            arrivals.ravel() + BUS_DWELL_TIME
+                        ),
+                        "stop_id": np.tile(
+                            [f"1_{sid}" for sid in sids], len(starts)
+                        ),
+                        "stop_sequence": np.tile(
+                            np.arange(1, len(sids) + 1), len(starts)
+                        ),
+                    }
+                )
+            )
+
+        pd.concat(trips).to_csv(path / "trips.txt", index=False)
+        pd.concat(stop_times).to_csv(path / "stop_times.txt", index=False)
+
+    def _save_metro_gtfs(self, path):
+        path.mkdir(parents=True, exist_ok=True)
+        pd.DataFrame(
+            {
+                "stop_id": [f"M{sid}" for sid in self.station_ids],
+                "stop_name": [f"Estacao {c}" for c in self.station_codes],
+                "stop_lat": self.station_lats,
+                "stop_lon": self.station_lons,
+            }
+        ).to_csv(path / "stops.txt", index=False)
+
+        routes, trips, stop_times = [], [], []
+        for line_idx, (name, station_pos) in enumerate(
+            zip(METRO_LINES, self.lines)
+        ):
+            for direction, line_pos in enumerate(
+                [station_pos, station_pos[::-1]]
+            ):
+                route_id = f"L{line_idx}{direction}"
+                first = self.station_codes[line_pos[0]]
+                last = self.station_codes[line_pos[-1]]
+                routes.append(
+                    {
+                        "route_id": route_id,
+                        "route_long_name": f"{name} - {first}/{last}",
+                    }
+                )
+                trip_id = f"{route_id}_1"
+                trips.append(
+                    {
+                        "route_id": route_id,
+                        "service_id": "DU",
+                        "trip_id": trip_id,
+                    }
+                )
+                for seq, pos in enumerate(line_pos):
+                    time = f"06:{2 * seq:02d}:00"
+                    stop_times.append(
+                        {
+                            "trip_id": trip_id,
+                            "arrival_time": time,
+                            "departure_time": time,
+                            "stop_id": f"M{self.station_ids[pos]}",
+                            "stop_sequence": seq + 1,
+                        }
+                    )
+
+        pd.DataFrame(routes).to_csv(path / "routes.txt", index=False)
+        pd.DataFrame(trips).to_csv(path / "trips.txt", index=False)
+        pd.DataFrame(stop_times).to_csv(path / "stop_times.txt", index=False)
+
+
+def generate_afc_day(network, day, card_ids, rng):
+    """
+    Afc records of the cards in `card_ids`, on service `day`.
+
+    Returns
+    -------
+    pd.DataFrame
+        combined afc columns, sorted by timestamp
+    """
+    params = network.params
+    n_cards = len(card_ids)
+    n_stages = 1 + rng.poisson(params.mean_stages - 1, n_cards)
+
+    day_start = pd.Timestamp(day).to_datetime64()
+    # taps after the start of the next service day are dropped
+    day_end = day_start + np.timedelta64(
+        datetime.timedelta(
+            days=1,
+            hours=ODXConfig.NEW_DAY_TIME.hour,
+            minutes=ODXConfig.NEW_DAY_TIME.minute,
+        )
+    )
+
+    records = []
+    near = rng.integers(len(network.stop_ids), size=n_cards)
+    seconds = rng.uniform(5, 10, n_cards) * 3600
+
+    for stage in range(n_stages.max()):
+        active = np.flatnonzero(n_stages > stage)
+        cards = card_ids[active]
+        stage_near = near[active]
+        ts = day_start + (seconds[active] * 1e9).astype("timedelta64[ns]")
+        ts = ts.astype("datetime64[s]").astype("datetime64[ns]")
+        is_metro = rng.random(len(active)) < params.metro_share
+
+        # bus
+        bus = np.flatnonzero(~is_metro)
+        routes, positions = network.board_bus(rng, stage_near[bus])
+        boarded = routes >= 0
+        bus, routes, positions = (
+            bus[boarded],
+            routes[boarded],
+            positions[boarded],
+        )
+        exits = network.alight_bus(rng, routes, positions)
+        near[active[bus]] = network.route_stop(routes, exits)
+
+        stop_ids = network.stop_ids[network.route_stop(routes, positions)]
+        stop_ids = np.where(
+            rng.random(len(bus)) < params.unknown_stop,
+            network.stop_ids[-1] + 1,
+            stop_ids,
+        )
+        route_ids = np.array(
+            [network.routes[r][0] for r in routes], dtype=object
+        )
+        route_ids[rng.random(len(bus)) < params.unknown_route] = (
+            UNKNOWN_ROUTE_ID
+        )
+        records.append(
+            pd.DataFrame(
+                {
+                    "timestamp": ts[bus],
+                    "card_id": cards[bus],
+                    "stop_id": stop_ids,
+                    "route_id": route_ids,
+                    "route_variant": [network.routes[r][2] for r in routes],
+                    "route_direction": [network.routes[r][1] for r in routes],
+                    "stop_number": positions + 1,
+                    "mode": "bus",
+                    "way": None,
+                }
+            )
+        )
+
+        # metro
+        metro = np.flatnonzero(is_metro)
+        entries = network.stop_station[stage_near[metro]]
+        exits = rng.integers(len(network.station_ids), size=len(metro))
+        near[active[metro]] = network.station_stop[exits]
+        trip_time = rng.uniform(5, 18, len(metro)) * 60
+        has_entry = rng.random(len(metro)) >= params.missing_entry
+        has_exit = has_entry & (rng.random(len(metro)) >= params.missing_exit)
+        has_exit |= ~has_entry
+
+        for way, mask, station_pos, offset in [
+            ("IN", has_entry, entries, 0),
+            ("OUT", has_exit, exits, trip_time),
+        ]:
+            offset = (np.broadcast_to(offset, len(metro)) * 1e9).astype(
+                "timedelta64[ns]"
+            )
+            records.append(
+                pd.DataFrame(
+                    {
+                        "timestamp": (ts[metro] + offset)[mask].astype(
+                            "datetime64[s]"
+                        ),
+                        "card_id": cards[metro][mask],
+                        "stop_id": network.station_ids[station_pos[mask]],
+                        "mode": "metro",
+                        "way": way,
+                    }
+                )
+            )
+
+        seconds[active] += rng.uniform(20, 240, len(active)) * 60
+
+    afc = pd.concat(records, ignore_index=True)
+    afc["timestamp"] = afc["timestamp"].astype("datetime64[ns]")
+    afc = afc[afc["timestamp"] < day_end]
+    for col in ["card_id", "stop_id", "route_variant", "stop_number"]:
+        afc[col] = afc[col].astype("Int64")
+    afc["route_direction"] = afc["route_direction"].astype(object)
+    return afc.sort_values(
+        ["timestamp", "card_id"], kind="stable", ignore_index=True
+    )
+
+
+def to_raw_carris(afc, network, rng):
+    """Raw carris csv rows of the bus records in `afc`"""
+    bus = afc[afc["mode"] == "bus"]
+    duplicated = rng.random(len(bus)) < network.params.duplicates
+    bus = pd.concat([bus, bus[duplicated]]).sort_index(kind="stable")
+    cols = CARRIS_RAW_COLUMNS
+
+    return pd.DataFrame(
+        {
+            cols["timestamp"]: bus["timestamp"].astype(str),
+            cols["card_id"]: bus["card_id"],
+            cols["stop_id"]: bus["stop_id"],
+            cols["route_direction"]: bus["route_direction"],
+            cols["route_id"]: bus["route_id"],
+            cols["route_variant"]: bus["route_variant"],
+            cols["stop_name"]: "Paragem " + bus["stop_id"].astype(str),
+            cols["stop_number"]: bus["stop_number"],
+            cols["description"]: "Validação",
+        }
+    )
+
+
+def to_raw_metro(afc, network, rng):
+    """Raw metro csv rows of the metro records in `afc`"""
+    metro = afc[afc["mode"] == "metro"]
+    timestamps = metro["timestamp"].astype(str)
+    # stations have several gates: 'AB' -> 'AB1', 'AB2'..
+    gates = rng.integers(1, 5, len(metro)).astype(str)
+    cols = METRO_RAW_COLUMNS
+
+    return pd.DataFrame(
+        {
+            cols["date"]: timestamps.str[:10],
+            cols["time"]: timestamps.str[11:],
+            cols["stop_id"]: np.char.add(
+                network.station_codes[
+                    metro["stop_id"].to_numpy(dtype=np.int64) - 1
+                ],
+                gates,
+            ),
+            cols["card_id"]: metro["card_id"],
+            cols["way"]: metro["way"].map({"IN": "E", "OUT": "S"}),
+        }
+    )
+
+
+def generate_dataset(path, params=None, raw=True):
+    """
+    Generates a synthetic dataset in `path` (see module docstring).
+
+    Parameters
+    ----------
+    path: str
+    params: SyntheticParams
+    raw: bool
+        whether to also write the raw carris and metro afc csv files
+
+    Returns
+    -------
+    int
+        number of combined afc records
+    """
+    params = params or SyntheticParams()
+    path = Path(path)
+    path.mkdir(parents=True, exist_ok=True)
+    rng = np.random.default_rng(params.seed)
+
+    print(f"Generating network in {path}..")
+    network = SyntheticNetwork(params, rng)
+    network.save_schedules(path, rng)
+
+    raw_carris_path = path / "raw" / "afc_carris.csv"
+    raw_metro_path = path / "raw" / "afc_metro.csv"
+    if raw:
+        raw_carris_path.parent.mkdir(exist_ok=True)
+
+    card_ids = (
+        np.sort(rng.choice(90_000_000, size=params.n_cards, replace=False))
+        + 10_000_000
+    )
+    days = pd.date_range(params.start_date, periods=params.n_days)
+
+    print(
+        f"Generating ~{params.n_taps} afc records of {params.n_cards} cards, "
+        f"over {params.n_days} days.."
+    )
+    n_records = 0
+    writer = None
+    for idx, day in enumerate(tqdm(days)):
+        active = rng.random(len(card_ids)) < params.active_share
+        afc = generate_afc_day(network, day, card_ids[active], rng)
+
+        table = pa.Table.from_pandas(afc, preserve_index=False)
+        if writer is None:
+            writer = pa.ipc.new_file(path / "afc.feather", table.schema)
+        writer.write_table(table)
+        n_records += len(afc)
+
+        if raw:
+            header = idx == 0
+            to_raw_carris(afc, network, rng).to_csv(
+                raw_carris_path,
+                sep=";",
+                index=False,
+                header=header,
+                mode="w" if header else "a",
+                encoding="latin1",
+            )
+            to_raw_metro(afc, network, rng).to_csv(
+                raw_metro_path,
+                sep=";",
+                index=False,
+                header=header,
+                mode="w" if header else "a",
+                encoding="latin1",
+            )
+    writer.close()
+
+    with open(path / PARAMS_FILE, "w") as f:
+        json.dump(params.to_dict(), f)
+
+    print(f"Generated {n_records} afc records")
+    return n_records
+
+
+def load_params(path):
+    """Parameters of the dataset in `path`, or None if there is none"""
+    try:
+        with open(Path(path) / PARAMS_FILE) as f:
+            return SyntheticParams(**json.load(f))
+    except FileNotFoundError:
+        return None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate synthetic data")
+    parser.add_argument("path", type=str, nargs=1, help="output directory")
+    parser.add_argument(
+        "-n", "--taps", type=int, default=100_000, help="number of afc records"
+    )
+    parser.add_argument(
+        "-d", "--days", type=int, default=3, help="number of days"
+    )
+    parser.add_argument("-s", "--seed", type=int, default=0, help="seed")
+    parser.add_argument(
+        "--no-raw",
+        action="store_true",
+        help="don't write the raw carris and metro afc csv files",
+    )
+
+    args = parser.parse_args()
+    generate_dataset(
+        args.path[0],
+        SyntheticParams(n_taps=args.taps, n_days=args.days, seed=args.seed),
+        raw=not args.no_raw,
+    )
@@ -0,0 +1,356 @@
+"""
+Compact schema of processed AFC records.
+
+Every preprocessing script, the afc store and `combine_afc` write
+AFC records with the types of `AFC_FIELDS`:
+
+- low cardinality strings (route, direction, way, mode) are dictionary
+  encoded, and read by pandas as categoricals
+- stop ids are int32, small integers int16
+- timestamps are timestamp[ns], stored as int64 epoch nanoseconds
+- card ids are dense int32 codes, mapped to the original card ids
+  by a `CardMapping` table
+
+Dictionaries must be the same for every batch of an Arrow IPC (feather)
+file, so batches are encoded with fixed dictionaries before they are
+written (see `encode_dictionaries`).
+"""
+import os
+import fcntl
+from pathlib import Path
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+from loguru import logger
+
+AFC_FIELDS = {
+    "timestamp": pa.timestamp("ns"),
+    "card_id": pa.int32(),
+    "stop_id": pa.int32(),
+    "route_id": pa.dictionary(pa.int16(), pa.string()),
+    "route_variant": pa.int16(),
+    "route_direction": pa.dictionary(pa.int8(), pa.string()),
+    "stop_number": pa.int16(),
+    "way": pa.dictionary(pa.int8(), pa.string()),
+    "mode": pa.dictionary(pa.int8(), pa.string()),
+}
+
+# pandas dtypes of `AFC_FIELDS`
+AFC_DTYPES = {
+    "timestamp": "datetime64[ns]",
+    "card_id": "int32",
+    "stop_id": "Int32",
+    "route_id": "category",
+    "route_variant": "Int16",
+    "route_direction": "category",
+    "stop_number": "Int16",
+    "way": "category",
+    "mode": "category",
+}
+
+
+def get_afc_schema(columns):
+    """
+    Arrow schema of the afc `columns`, with the pandas metadata that
+    makes pandas restore `AFC_DTYPES`
+    """
+    empty = pd.DataFrame(
+        {col: pd.Series(dtype=AFC_DTYPES[col]) for col in columns}
+    )
+    schema = pa.schema([(col, AFC_FIELDS[col]) for col in columns])
+    return pa.Table.from_pandas(
+        empty, schema=schema, preserve_index=False
+    ).schema
+
+
+def to_afc_frame(df):
+    """`df` with its afc columns cast to `AFC_DTYPES`"""
+    return df.astype({col: AFC_DTYPES[col] for col in df if col in AFC_DTYPES})
+
+
+def encode_dictionaries(table, dictionaries):
+    """
+    `table` with its dictionary columns encoded with the values of
+    `dictionaries` (column -> list of values), so that every batch
+    written to the same file shares them. Raises a `ValueError` if
+    a column has (non null) values that are not in its dictionary.
+    """
+    for name, values in dictionaries.items():
+        if name not in table.column_names:
+            continue
+        field = pa.field(name, AFC_FIELDS[name])
+        values = pa.array(values, pa.string())
+        column = table[name]
+        if pa.types.is_dictionary(column.type):
+            column = column.cast(pa.string())
+        indices = pc.index_in(column, value_set=values)
+        missing = pc.and_(pc.is_null(indices), pc.is_valid(column))
+        if pc.any(missing).as_py():
+            unknown = pc.unique(column.filter(missing)).to_pylist()
+            raise ValueError(
+                f"Values of {name} not in its dictionary: {unknown[:10]}"
+            )
+        indices = indices.cast(field.type.index_type)
+        column = pa.chunked_array(
+            [
+                pa.DictionaryArray.from_arrays(chunk, values)
+                for chunk in indices.chunks
+            ],
+            field.type,
+        )
+        table = table.set_column(
+            table.schema.get_field_index(name), field, column
+        )
+    return table
+
+
+def to_afc_table(df, dictionaries=None):
+    """
+    Arrow table with the compact afc schema of the afc dataframe `df`,
+    with its dictionary columns encoded with `dictionaries` if given
+    """
+    table = pa.Table.from_pandas(
+        to_afc_frame(df),
+        schema=get_afc_schema(list(df.columns)),
+        preserve_index=False,
+    )
+    if dictionaries:
+        table = encode_dictionaries(table, dictionaries)
+    return table
+
+
+def parse_ints(array):
+    """
+    Casts a string array to Int64. Values that are not integers
+    become nulls, instead of failing the whole array.
+    """
+    try:
+        ints = pc.cast(array, pa.int64())
+    except pa.ArrowInvalid:
+        is_int = pc.match_substring_regex(array, r"^\s*-?\d+\s*$")
+        ints = pc.cast(
+            pc.utf8_trim_whitespace(pc.if_else(is_int, array, None)),
+            pa.int64(),
+        )
+    return ints.to_pandas(types_mapper={pa.int64(): pd.Int64Dtype()}.get)
+
+
+def open_afc_file(path, columns=None):
+    """
+    Reader of the afc feather in `path`, memory mapped, reading only
+    `columns` (all by default) of its record batches
+    """
+    source = pa.memory_map(str(path))
+    reader = pa.ipc.open_file(source)
+    if columns is None:
+        return reader
+    names = reader.schema.names
+    fields = [names.index(col) for col in columns if col in names]
+    if not fields:
+        raise ValueError(f"None of the columns {columns} are in {path}")
+    return pa.ipc.open_file(
+        source, options=pa.ipc.IpcReadOptions(included_fields=fields)
+    )
+
+
+def get_batch_range(path, time_bounds=None):
+    """
+    (first, end) indices of the record batches of the afc feather in
+    `path`, sorted by timestamp, that hold the records within
+    `time_bounds` (start, end excluded). Batches are binary searched by
+    their first and last timestamps, so only the timestamps of a
+    logarithmic number of batches are read.
+    """
+    reader = open_afc_file(path, ["timestamp"])
+    n_batches = reader.num_record_batches
+    if time_bounds is None:
+        return 0, n_batches
+    start, end = (pd.Timestamp(t).value for t in time_bounds)
+
+    bounds = {}
+
+    def get_bounds(i):
+        # (first, last) timestamps of batch i, as int64. An empty batch
+        # takes the last timestamp of the previous ones, to keep the order
+        if i not in bounds:
+            timestamps = reader.get_batch(i).column(0).cast(pa.int64())
+            if len(timestamps):
+                bounds[i] = (timestamps[0].as_py(), timestamps[-1].as_py())
+            else:
+                last = get_bounds(i - 1)[1] if i else np.iinfo(np.int64).min
+                bounds[i] = (last, last)
+        return bounds[i]
+
+    def search(is_before):
+        # first batch that is not before, `is_before` being monotonic
+        low, high = 0, n_batches
+        while low < high:
+            mid = (low + high) // 2
+            if is_before(mid):
+                low = mid + 1
+            else:
+                high = mid
+        return low
+
+    first = search(lambda i: get_bounds(i)[1] < start)
+    last = search(lambda i: get_bounds(i)[0] < end)
+    return first, max(first, last)
+
+
+def get_dictionaries(paths, columns, time_bounds=None):
+    """
+    Sorted union of the dictionary values of `columns` in the afc
+    feather files in `paths`, reading only those columns of the batches
+    within `time_bounds` (see `get_batch_range`)
+    """
+    values = {col: set() for col in columns}
+    for path in paths:
+        names = pa.ipc.open_file(pa.memory_map(str(path))).schema.names
+        file_columns = [col for col in columns if col in names]
+        if not file_columns:
+            continue
+        first, end = get_batch_range(path, time_bounds)
+        reader = open_afc_file(path, file_columns)
+        # every batch, as plain (or delta dictionary) columns may
+        # have different values in each
+        for i in range(first, end):
+            batch = reader.get_batch(i)
+            for col in file_columns:
+                column = batch.column(col)
+                if pa.types.is_dictionary(column.type):
+                    column = column.dictionary
+                values[col].update(
+                    v for v in column.unique().to_pylist() if v is not None
+                )
+    return {col: sorted(col_values) for col, col_values in values.items()}
+
+
+class CardMapping:
+    """
+    Dense int32 codes of card ids, shared by every operator so that
+    a card has the same code in every processed afc file.
+    The code of a card is its index in the mapping table, which is saved
+    in `path` (a feather file with a `card_id` column).
+
+    Encoding mappings hold an exclusive lock (a `.lock` file next to
+    `path`) from loading to `close`, so that processing scripts run at
+    the same time do not hand out the same codes to different cards:
+    the second one waits for the first to save its codes.
+
+    Parameters
+    ----------
+    path: str
+        mapping table path, loaded if it exists
+    lock: bool
+        whether to lock the mapping, to encode cards. Mappings only used
+        to `decode` need not be locked
+    """
+
+    def __init__(self, path, lock=True):
+        self.path = Path(path)
+        self._lock = None
+        if lock:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self._lock = open(
+                self.path.with_name(self.path.name + ".lock"), "w"
+            )
+            try:
+                fcntl.flock(self._lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                logger.info(f"Waiting for the lock of {self.path}..")
+                fcntl.flock(self._lock, fcntl.LOCK_EX)
+
+        if self.path.is_file():
+            card_ids = pd.read_feather(self.path)["card_id"]
+        else:
+            card_ids = pd.Series(dtype=np.int64)
+        self._card_ids = pd.Index(card_ids.to_numpy(dtype=np.int64))
+        self._n_saved = len(self._card_ids)
+        self._stat = self._get_stat()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        return len(self._card_ids)
+
+    def _get_stat(self):
+        if not self.path.is_file():
+            return None
+        stat = self.path.stat()
+        return (stat.st_size, stat.st_mtime_ns)
+
+    def encode(self, card_ids):
+        """
+        Codes of `card_ids` (array of int64, without missing values).
+        Unknown cards get new codes, in order of first appearance.
+        """
+        if self._lock is None:
+            raise RuntimeError("Encoding cards requires a locked mapping")
+        card_ids = np.asarray(card_ids, dtype=np.int64)
+        codes = self._card_ids.get_indexer(card_ids)
+        is_new = codes < 0
+        if is_new.any():
+            new_ids = pd.unique(card_ids[is_new])
+            if len(self._card_ids) + len(new_ids) > np.iinfo(np.int32).max:
+                raise OverflowError("Too many cards for int32 card codes")
+            self._card_ids = self._card_ids.append(pd.Index(new_ids))
+            codes[is_new] = self._card_ids.get_indexer(card_ids[is_new])
+        return codes.astype(np.int32)
+
+    def decode(self, codes):
+        """
+        Card ids of the card `codes`, an array, or an arrow array
+        (whose nulls are kept)
+        """
+        if isinstance(codes, (pa.Array, pa.ChunkedArray)):
+            return pc.take(pa.array(self._card_ids.to_numpy()), codes)
+        return self._card_ids.to_numpy()[np.asarray(codes)]
+
+    def decode_frame(self, df, column="card_id"):
+        """
+        Copy of a dataframe (e.g. a stage or journey table) with the card
+        ids of the codes in `column`
+        """
+        df = df.copy()
+        card_ids = self.decode(pa.Array.from_pandas(df[column]))
+        df[column] = card_ids.to_pandas(
+            types_mapper={pa.int64(): pd.Int64Dtype()}.get
+        ).set_axis(df.index)
+        return df
+
+    def save(self):
+        """
+        Saves the new codes. Raises a `RuntimeError` if the mapping file
+        was changed since it was loaded (by a process that did not lock
+        it), as codes would then conflict
+        """
+        if len(self._card_ids) == self._n_saved:
+            return
+        if self._get_stat() != self._stat:
+            raise RuntimeError(
+                f"{self.path} changed since it was loaded, "
+                "new card codes may conflict with its codes"
+            )
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_name(self.path.name + ".tmp")
+        pd.DataFrame({"card_id": self._card_ids.to_numpy()}).to_feather(
+            tmp_path
+        )
+        os.replace(tmp_path, self.path)
+        logger.info(
+            f"Saved {len(self._card_ids) - self._n_saved} new card codes "
+            f"to {self.path}"
+        )
+        self._n_saved = len(self._card_ids)
+        self._stat = self._get_stat()
+
+    def close(self):
+        """Releases the lock of the mapping"""
+        if self._lock is not None:
+            self._lock.close()
+            self._lock = None
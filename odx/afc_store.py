@@ -0,0 +1,286 @@
+"""
+Partitioned AFC store.
+
+Processed AFC records are stored as one feather file per operator,
+service day (see `stages.get_service_day`) and card bucket:
+
+    <path>/operator=<operator>/day=<YYYY-MM-DD>/bucket=<k>.feather
+
+Every partition is sorted by timestamp, without duplicate
+(timestamp, card_id) records. Appending records of a day that is already
+stored merges them with the stored ones, so appends are idempotent and
+overlapping inputs are deduplicated. Reads only open the partitions of the
+requested operators and days.
+"""
+import os
+import json
+import datetime
+from pathlib import Path
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+from loguru import logger
+
+from .afc_schema import to_afc_frame, to_afc_table
+from .stages import get_service_day
+
+META_FILE = "store.json"
+
+DEDUP_COLUMNS = ["timestamp", "card_id"]
+
+
+def get_card_buckets(card_ids, n_buckets):
+    """
+    Bucket of every card id, as in `parallel.partition_by_card`,
+    so every record of a card is in the same bucket
+    """
+    if n_buckets == 1:
+        return np.zeros(len(card_ids), dtype=np.int64)
+    hashes = pd.util.hash_pandas_object(pd.Series(card_ids), index=False)
+    return (hashes.to_numpy() % n_buckets).astype(np.int64)
+
+
+def merge_records(*dfs):
+    """Concatenation of afc dataframes, deduplicated and sorted"""
+    df = pd.concat(dfs, ignore_index=True)
+    df = df.drop_duplicates(subset=DEDUP_COLUMNS)
+    return df.sort_values(by="timestamp", kind="stable", ignore_index=True)
+
+
+def to_day(day):
+    """datetime.date of a date, datetime or iso date string"""
+    return pd.Timestamp(day).date()
+
+
+class AFCStore:
+    """
+    AFC store in `path`, created if it does not exist.
+
+    Parameters
+    ----------
+    path: str
+    n_buckets: int
+        number of card buckets of every day (1 by default). Must match
+        the number of buckets of an existing store.
+    """
+
+    def __init__(self, path, n_buckets=None):
+        self.path = Path(path)
+        meta_path = self.path / META_FILE
+
+        if meta_path.is_file():
+            with open(meta_path) as f:
+                meta = json.load(f)
+            if n_buckets is not None and n_buckets != meta["n_buckets"]:
+                raise ValueError(
+                    f"AFC store in {self.path} has {meta['n_buckets']} "
+                    f"buckets, not {n_buckets}"
+                )
+            self.n_buckets = meta["n_buckets"]
+        else:
+            self.n_buckets = n_buckets or 1
+            self.path.mkdir(parents=True, exist_ok=True)
+            with open(meta_path, "w") as f:
+                json.dump({"n_buckets": self.n_buckets}, f)
+
+    def __repr__(self):
+        return f"AFCStore({self.path}, n_buckets={self.n_buckets})"
+
+    def get_partition_path(self, operator, day, bucket=0):
+        return (
+            self.path
+            / f"operator={operator}"
+            / f"day={to_day(day).isoformat()}"
+            / f"bucket={bucket}.feather"
+        )
+
+    def operators(self):
+        return sorted(
+            p.name.split("=", 1)[1] for p in self.path.glob("operator=*")
+        )
+
+    def days(self, operator, start_day=None, end_day=None):
+        """Sorted stored days of `operator`, between the given days"""
+        days = sorted(
+            datetime.date.fromisoformat(p.name.split("=", 1)[1])
+            for p in (self.path / f"operator={operator}").glob("day=*")
+        )
+        if start_day is not None:
+            days = [day for day in days if day >= to_day(start_day)]
+        if end_day is not None:
+            days = [day for day in days if day <= to_day(end_day)]
+        return days
+
+    def get_partition_paths(
+        self, operator, start_day=None, end_day=None, bucket=0
+    ):
+        """Paths of the stored partitions of a bucket, in day order"""
+        paths = [
+            self.get_partition_path(operator, day, bucket)
+            for day in self.days(operator, start_day, end_day)
+        ]
+        return [path for path in paths if path.is_file()]
+
+    def append(self, afc, operator):
+        """
+        Appends the processed afc dataframe of `operator`, merging it
+        with the records already stored for the same days.
+
+        Returns
+        -------
+        int
+            number of new records
+        """
+        days = get_service_day(afc["timestamp"]).to_numpy()
+        buckets = get_card_buckets(afc["card_id"].to_numpy(), self.n_buckets)
+
+        n_new = 0
+        for (day, bucket), df in afc.groupby([days, buckets], sort=True):
+            path = self.get_partition_path(operator, day, bucket)
+            if path.is_file():
+                stored = pd.read_feather(path)
+                df = merge_records(stored, df)
+                n_new += len(df) - len(stored)
+            else:
+                df = merge_records(df)
+                n_new += len(df)
+            self._write_partition(path, df)
+
+        return n_new
+
+    def append_file(self, path, operator):
+        """
+        Appends the processed afc feather in `path`, one service day at
+        a time (the file is expected to be sorted by timestamp, which
+        bounds memory to a day of records).
+
+        Returns
+        -------
+        int
+            number of new records
+        """
+        reader = pa.ipc.open_file(path)
+        current_day = None
+        day_chunks = []
+        n_new = 0
+
+        for batch_idx in range(reader.num_record_batches):
+            df = reader.get_batch(batch_idx).to_pandas()
+            if not len(df):
+                continue
+            days = get_service_day(df["timestamp"]).to_numpy()
+
+            # the records of the days before the batch's last are complete
+            last_day = days[-1]
+            done = days != last_day
+            if done.any() or last_day != current_day:
+                day_chunks.append(df[done])
+                n_new += self.append(pd.concat(day_chunks), operator)
+                day_chunks = []
+                df = df[~done]
+            day_chunks.append(df)
+            current_day = last_day
+
+        if day_chunks:
+            n_new += self.append(pd.concat(day_chunks), operator)
+
+        logger.info(f"Appended {n_new} new {operator} records to {self}")
+        return n_new
+
+    def _write_partition(self, path, df):
+        """Writes a partition atomically, with the compact afc schema"""
+        table = to_afc_table(df)
+
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(path.name + ".tmp")
+        with pa.ipc.new_file(
+            tmp_path,
+            table.schema,
+            options=pa.ipc.IpcWriteOptions(compression="lz4"),
+        ) as writer:
+            writer.write_table(table)
+        os.replace(tmp_path, path)
+
+    def schema(self, operator):
+        """Arrow schema (with pandas metadata) of the records of `operator`"""
+        for path in self.path.glob(
+            f"operator={operator}/day=*/bucket=*.feather"
+        ):
+            return pa.ipc.open_file(path).schema
+        raise KeyError(f"No {operator} records in {self}")
+
+    def read_day(self, operator, day, columns=None, buckets=None):
+        """
+        Arrow table of the records of `operator` on service `day`,
+        sorted by timestamp, with only `columns` and card `buckets`
+        (all by default)
+        """
+        buckets = range(self.n_buckets) if buckets is None else buckets
+        tables = []
+        for bucket in buckets:
+            path = self.get_partition_path(operator, day, bucket)
+            if path.is_file():
+                with pa.memory_map(str(path)) as source:
+                    tables.append(pa.ipc.open_file(source).read_all())
+
+        if not tables:
+            return self.schema(operator).empty_table()
+
+        table = pa.concat_tables(tables)
+        if columns is not None:
+            table = table.select(
+                [col for col in columns if col in table.column_names]
+            )
+        if len(tables) > 1:
+            table = table.sort_by([("timestamp", "ascending")])
+        return table
+
+    def scan(
+        self,
+        operator,
+        start_day=None,
+        end_day=None,
+        columns=None,
+        buckets=None,
+    ):
+        """
+        Yields the (sorted) records of `operator` as one arrow table per
+        stored service day between `start_day` and `end_day` (included)
+        """
+        for day in self.days(operator, start_day, end_day):
+            yield self.read_day(operator, day, columns, buckets)
+
+    def read(
+        self,
+        operators,
+        start_day=None,
+        end_day=None,
+        columns=None,
+        buckets=None,
+    ):
+        """
+        Combined afc dataframe of the records between `start_day` and
+        `end_day` (included), sorted by timestamp.
+
+        Parameters
+        ----------
+        operators: dict
+            mode -> operator of the records to read, as in
+            `config.AFC_STORE_OPERATORS`. Records get a `mode` column.
+        """
+        dfs = []
+        for mode, operator in operators.items():
+            for table in self.scan(
+                operator, start_day, end_day, columns, buckets
+            ):
+                df = table.to_pandas()
+                df["mode"] = mode
+                dfs.append(df)
+
+        if not dfs:
+            return pd.DataFrame(columns=(columns or []) + ["mode"])
+        # concatenated categoricals with different categories are objects
+        afc = to_afc_frame(pd.concat(dfs, ignore_index=True))
+        return afc.sort_values(
+            by="timestamp", kind="stable", ignore_index=True
+        )
@@ -0,0 +1,120 @@
+"""
+Compiled schedule bundles.
+
+A bundle is a directory with one `.npy` file per array and a `meta.json`
+file holding the bundle version, a fingerprint of the source files
+it was compiled from and the parameters it was compiled with.
+Arrays are memory-mapped on load. A bundle is stale (and ignored) when
+its version, sources or parameters change.
+"""
+import json
+import shutil
+import hashlib
+from pathlib import Path
+import numpy as np
+from loguru import logger
+
+BUNDLE_VERSION = 2
+
+META_FILE = "meta.json"
+
+
+def get_sources_fingerprint(sources):
+    """
+    Hash of the name, size and modification time of every source file.
+    Directories contribute every file inside them.
+    """
+    entries = []
+    for source in sources:
+        source = Path(source)
+        files = sorted(source.rglob("*")) if source.is_dir() else [source]
+        for file_ in files:
+            if file_.is_file():
+                stat = file_.stat()
+                entries.append([str(file_), stat.st_size, stat.st_mtime_ns])
+
+    return hashlib.sha256(json.dumps(entries).encode()).hexdigest()
+
+
+def save_bundle(path, kind, arrays, sources, params=None):
+    """
+    Writes `arrays` (dict of name -> np.array) as a bundle in `path`,
+    compiled from `sources` with `params` (json serializable dict).
+    The bundle is written to a temporary directory first, and then moved,
+    so readers never see a partial bundle.
+    """
+    path = Path(path)
+    tmp_path = path.with_name(path.name + ".tmp")
+    if tmp_path.exists():
+        shutil.rmtree(tmp_path)
+    tmp_path.mkdir(parents=True)
+
+    for name, array in arrays.items():
+        np.save(tmp_path / f"{name}.npy", np.asarray(array))
+
+    meta = {
+        "version": BUNDLE_VERSION,
+        "kind": kind,
+        "fingerprint": get_sources_fingerprint(sources),
+        "params": params or {},
+        "arrays": list(arrays),
+    }
+    with open(tmp_path / META_FILE, "w") as f:
+        json.dump(meta, f)
+
+    if path.exists():
+        shutil.rmtree(path)
+    tmp_path.rename(path)
+    logger.info(f"Saved {kind} bundle to {path}")
+
+
+def load_bundle(path, kind, sources, params=None):
+    """
+    Loads the arrays of the bundle in `path`.
+    Returns None if there is no bundle, or if it is stale: compiled with
+    other `sources` or `params` (see `save_bundle`).
+    """
+    if path is None:
+        return None
+
+    path = Path(path)
+    try:
+        with open(path / META_FILE) as f:
+            meta = json.load(f)
+    except FileNotFoundError:
+        return None
+
+    if (
+        meta["version"] != BUNDLE_VERSION
+        or meta["kind"] != kind
+        or meta["fingerprint"] != get_sources_fingerprint(sources)
+        or meta["params"] != (params or {})
+    ):
+        logger.info(f"Ignoring stale {kind} bundle in {path}")
+        return None
+
+    logger.info(f"Loading {kind} bundle from {path}")
+    return {
+        name: np.load(path / f"{name}.npy", mmap_mode="r")
+        for name in meta["arrays"]
+    }
+
+
+def to_ragged(lists, dtype=None):
+    """Flattens a list of lists into (values, offsets) arrays"""
+    offsets = np.zeros(len(lists) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(l) for l in lists])
+    if lists and offsets[-1]:
+        values = np.concatenate([np.asarray(l, dtype=dtype) for l in lists])
+    else:
+        values = np.array([], dtype=dtype)
+    return values, offsets
+
+
+def from_ragged(values, offsets):
+    """Inverse of `to_ragged`, returns a list of lists"""
+    values = np.asarray(values).tolist()
+    return [
+        values[start:end]
+        for start, end in zip(offsets[:-1].tolist(), offsets[1:].tolist())
+    ]
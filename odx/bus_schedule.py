@@ -1,9 +1,13 @@
 import json
+import numpy as np
+import pandas as pd
 from collections import namedtuple
 from loguru import logger
 from .utils import Singleton
 from .common import Stop
-from .geo import StopsDistance
+from .geo import StopsDistance, StopsIndex, haversine
+from .bundle import load_bundle, save_bundle, to_ragged, from_ragged
+from .gtfs import GTFSReader, GTFSIndex
 from . import config
 
 BusRouteTuple = namedtuple(
@@ -11,10 +15,34 @@ BusRouteTuple = namedtuple(
 )
 
 
+SECONDS_PER_DAY = 24 * 3600
+
+
 def convert_gtfs_bus_stop_id(gtfs_stop_id):
     return int(gtfs_stop_id.split("_")[1])
 
 
+def get_time_bucket(timestamp, n_buckets):
+    """Time of day bucket of a timestamp, in a day of `n_buckets`"""
+    seconds = timestamp.hour * 3600 + timestamp.minute * 60 + timestamp.second
+    return seconds // (SECONDS_PER_DAY // n_buckets)
+
+
+def get_seconds_of_day(timestamps):
+    """Seconds after midnight of timestamps, -1 for missing ones"""
+    timestamps = np.asarray(timestamps, dtype="datetime64[s]")
+    seconds = (timestamps - timestamps.astype("datetime64[D]")).astype(
+        np.int64
+    )
+    return np.where(np.isnat(timestamps), -1, seconds)
+
+
+def get_time_buckets(timestamps, n_buckets):
+    """Vectorized `get_time_bucket`. Missing timestamps get bucket 0."""
+    seconds = get_seconds_of_day(timestamps)
+    return np.maximum(seconds, 0) // (SECONDS_PER_DAY // n_buckets)
+
+
 class BusRoute:
     class Directions:
         ASC = "ASC"
@@ -31,6 +59,7 @@ class BusRoute:
         self.route_variant = route_variant
         self.route_stop_ids = route_stop_ids
         self.stage_times = None
+        self.bucket_stage_times = None
         self.stage_dists = None
 
         self._sid_to_idx = {
@@ -55,6 +84,13 @@ class BusRoute:
     def set_stage_times(self, stage_times):
         self.stage_times = stage_times
 
+    def set_bucket_stage_times(self, bucket_stage_times):
+        """
+        Sets the cumulative stage times of every time of day bucket,
+        a (buckets x stages) array, each row like `stage_times`
+        """
+        self.bucket_stage_times = bucket_stage_times
+
     def set_stage_dists(self, dists):
         self.stage_dists = dists
 
@@ -105,7 +141,18 @@ class BusRoute:
 
         return stage_dist
 
-    def get_stage_time(self, entry_sid, exit_sid):
+    def get_stage_time(self, entry_sid, exit_sid, timestamp=None):
+        """
+        Stage time (in seconds) from `entry_sid` to `exit_sid`. Given the
+        boarding `timestamp`, the stage times of its time of day bucket
+        are used, if the route has them.
+        """
+        stage_times = self.stage_times
+        if timestamp is not None and self.bucket_stage_times is not None:
+            stage_times = self.bucket_stage_times[
+                get_time_bucket(timestamp, len(self.bucket_stage_times))
+            ]
+
         entry_idx = self._sid_to_idx[entry_sid]
         exit_idx = self._sid_to_idx[exit_sid]
 
@@ -114,24 +161,21 @@ class BusRoute:
                 raise RuntimeError()
 
             if exit_idx == 0:
-                stage_time = (
-                    self.stage_times[-1] - self.stage_times[entry_idx - 1]
-                )
+                stage_time = stage_times[-1] - stage_times[entry_idx - 1]
             else:
                 stage_time = (
-                    self.stage_times[-1]
-                    - self.stage_times[entry_idx - 1]
-                    + self.stage_times[exit_idx - 1]
+                    stage_times[-1]
+                    - stage_times[entry_idx - 1]
+                    + stage_times[exit_idx - 1]
                 )
 
         else:
             if entry_idx > 0:
                 stage_time = (
-                    self.stage_times[exit_idx - 1]
-                    - self.stage_times[entry_idx - 1]
+                    stage_times[exit_idx - 1] - stage_times[entry_idx - 1]
                 )
             else:
-                stage_time = self.stage_times[exit_idx - 1]
+                stage_time = stage_times[exit_idx - 1]
 
         return round(stage_time)
 
@@ -165,6 +209,219 @@ class BusRoute:
         return s
 
 
+class BusRouteArrays:
+    """
+    Array representation of a `BusRoute`, used for batched inference.
+
+    Attributes
+    ----------
+    stop_ids: np.array
+        route stop ids, by position
+    stop_idxs: np.array
+        for each position, the stop index used by `BusRoute.get_stage_time`
+        (circular routes repeat the first stop in the last position)
+    cum_times: np.array
+        cumulative stage time (in seconds) from the first stop to each index
+    bucket_cum_times: np.array
+        (buckets x indices) `cum_times` of every time of day bucket,
+        or None if the route has no bucketed stage times
+    """
+
+    def __init__(self, route, stop_lats, stop_lons):
+        self.is_circ = route.route_direction == route.Directions.CIRC
+        self.stop_ids = np.array(route.route_stop_ids, dtype=np.int64)
+        self.stop_lats = np.asarray(stop_lats, dtype=np.float64)
+        self.stop_lons = np.asarray(stop_lons, dtype=np.float64)
+
+        self._sid_index = pd.Index(list(route._sid_to_idx))
+        self._sid_idxs = np.array(
+            list(route._sid_to_idx.values()), dtype=np.int64
+        )
+        self.stop_idxs = self._sid_idxs[
+            self._sid_index.get_indexer(self.stop_ids)
+        ]
+        self.cum_times = np.concatenate([[0.0], route.stage_times])
+        self.bucket_cum_times = None
+        if route.bucket_stage_times is not None:
+            bucket_stage_times = np.asarray(route.bucket_stage_times)
+            self.bucket_cum_times = np.concatenate(
+                [np.zeros((len(bucket_stage_times), 1)), bucket_stage_times],
+                axis=1,
+            )
+
+    def __len__(self):
+        return len(self.stop_ids)
+
+    def get_stop_idxs(self, stop_ids):
+        """Stop index of each stop id in the route, or -1 if not in route"""
+        positions = self._sid_index.get_indexer(stop_ids)
+        return np.where(positions >= 0, self._sid_idxs[positions], -1)
+
+    def get_candidates(self, entry_idxs):
+        """
+        Returns a (entries x positions) mask of the stops subsequent to each
+        entry index, and the order in which they are visited.
+        Follows `BusRoute.get_subsequent_stop_ids`.
+        """
+        positions = np.arange(len(self))[None, :]
+        entry_idxs = np.asarray(entry_idxs)[:, None]
+
+        if self.is_circ:
+            # circ routes have the first stop_id twice, in indices 0 and -1
+            mask = np.where(
+                entry_idxs == 0,
+                (positions >= 1) & (positions < len(self) - 1),
+                positions != entry_idxs,
+            )
+            order = np.where(
+                entry_idxs == 0,
+                positions,
+                (positions - entry_idxs - 1) % len(self),
+            )
+        else:
+            mask = positions > entry_idxs
+            order = np.broadcast_to(positions, mask.shape)
+
+        return mask, order
+
+    def get_closest_subsequent(self, entry_idxs, lats, lons, direct_sids):
+        """
+        For each entry index, the position of the subsequent stop closest
+        to (lat, lon), and its distance.
+        If the stop in `direct_sids` is a subsequent stop, it is chosen
+        instead (direct transfer). Use -1 where there is no such stop.
+
+        Returns
+        -------
+        tuple
+            (positions, distances), with -1 and inf where there is
+            no subsequent stop
+        """
+        mask, order = self.get_candidates(entry_idxs)
+
+        dists = haversine(
+            self.stop_lats[None, :],
+            self.stop_lons[None, :],
+            np.asarray(lats)[:, None],
+            np.asarray(lons)[:, None],
+        )
+        dists = np.where(mask, dists, np.inf)
+
+        # direct (same stop) transfer
+        direct = mask & (self.stop_ids[None, :] == direct_sids[:, None])
+        is_direct = direct.any(axis=1)
+        dists[is_direct] = np.where(direct[is_direct], 0.0, np.inf)
+
+        # closest stop, ties broken by visiting order
+        min_dists = dists.min(axis=1, initial=np.inf)
+        is_closest = dists == min_dists[:, None]
+        positions = np.where(is_closest, order, np.iinfo(np.int64).max).argmin(
+            axis=1
+        )
+
+        return np.where(np.isfinite(min_dists), positions, -1), min_dists
+
+    def get_stage_times(self, entry_idxs, exit_idxs, timestamps=None):
+        """
+        Vectorized `BusRoute.get_stage_time`, before rounding, given the
+        boarding `timestamps` if any.
+        Returns nan when exit comes before entry in a non circular route.
+        """
+        if timestamps is None or self.bucket_cum_times is None:
+            cum_times = self.cum_times
+            entry_times = cum_times[entry_idxs]
+            exit_times = cum_times[exit_idxs]
+            total_times = cum_times[-1]
+        else:
+            cum_times = self.bucket_cum_times
+            buckets = get_time_buckets(timestamps, len(cum_times))
+            entry_times = cum_times[buckets, entry_idxs]
+            exit_times = cum_times[buckets, exit_idxs]
+            total_times = cum_times[buckets, -1]
+
+        forward = exit_times - entry_times
+        if self.is_circ:
+            wrapped = total_times + forward
+        else:
+            wrapped = np.nan
+
+        return np.where(exit_idxs >= entry_idxs, forward, wrapped)
+
+
+class AlightingTable:
+    """
+    Precomputed alighting stops of a route.
+
+    For every boarding stop index and every candidate next-boarding stop
+    (target), holds the position of the closest subsequent stop and its
+    distance, as `BusRouteArrays.get_closest_subsequent` would compute.
+    Only targets within `max_distance` of some route stop are kept,
+    since no alighting stop can be inferred for the others.
+
+    Parameters
+    ----------
+    route_arrays: BusRouteArrays
+    targets: StopsIndex
+        candidate next-boarding stops. Targets are identified by their
+        position in this index
+    direct_sids: np.array
+        for each target, the bus stop_id used for direct transfers,
+        or -1 if the target is not a bus stop
+    max_distance: float
+    """
+
+    def __init__(self, route_arrays, targets, direct_sids, max_distance):
+        self.max_distance = max_distance
+
+        _, target_pos, _ = targets.query_radius(
+            route_arrays.stop_lats, route_arrays.stop_lons, max_distance
+        )
+        self.target_pos = np.unique(target_pos)
+
+        entry_idxs = np.arange(len(route_arrays))
+        grid_entries = np.repeat(entry_idxs, len(self.target_pos))
+        grid_targets = np.tile(self.target_pos, len(entry_idxs))
+
+        positions, dists = route_arrays.get_closest_subsequent(
+            grid_entries,
+            targets.stop_lats[grid_targets],
+            targets.stop_lons[grid_targets],
+            direct_sids[grid_targets],
+        )
+        shape = (len(entry_idxs), len(self.target_pos))
+        self.positions = positions.astype(np.int32).reshape(shape)
+        self.dists = dists.reshape(shape)
+
+    @classmethod
+    def from_arrays(cls, max_distance, target_pos, positions, dists):
+        """Table from the arrays of a built one (e.g. memory-mapped)"""
+        table = cls.__new__(cls)
+        table.max_distance = max_distance
+        table.target_pos = target_pos
+        table.positions = positions
+        table.dists = dists
+        return table
+
+    def lookup(self, entry_idxs, target_pos):
+        """
+        Returns (positions, distances) of the alighting stop for each
+        (entry index, target position) pair, with -1 and inf for targets
+        not in the table.
+        """
+        positions = np.full(len(target_pos), -1, dtype=np.int64)
+        dists = np.full(len(target_pos), np.inf)
+        if not len(self.target_pos):
+            return positions, dists
+
+        rows = np.searchsorted(self.target_pos, target_pos)
+        rows = np.minimum(rows, len(self.target_pos) - 1)
+        found = self.target_pos[rows] == target_pos
+
+        positions[found] = self.positions[entry_idxs[found], rows[found]]
+        dists[found] = self.dists[entry_idxs[found], rows[found]]
+        return positions, dists
+
+
 class BusStop(Stop):
     def __init__(
         self, stop_id, stop_name, stop_lat, stop_lon, street_point=None
@@ -202,14 +459,65 @@ class BusStop(Stop):
 
 
 class BusSchedule(metaclass=Singleton):
+    """
+    Bus stops and routes.
+
+    Parameters
+    ----------
+    gtfs_path: str
+        Carris GTFS folder (e.g. `config.CARRIS_GTFS_PATH`). If not None,
+        the stage times of the routes are derived from its stop times,
+        instead of `stage_times_gtfs_path`
+    """
+
+    BUNDLE_KIND = "bus_schedule"
+
     def __init__(
         self,
         stops_path=config.BUS_STOPS_PATH,
         routes_path=config.BUS_ROUTES_PATH,
         # stage_times_osrm_path=config.BUS_STAGE_TIMES_OSRM_PATH,
         stage_times_gtfs_path=config.BUS_STAGE_TIMES_GTFS_PATH,
+        dense_stops_distance=config.DENSE_STOPS_DISTANCE,
+        bundle_path=config.BUS_SCHEDULE_BUNDLE_PATH,
+        gtfs_path=config.BUS_SCHEDULE_GTFS_PATH,
     ):
+        self._sources = [stops_path, routes_path]
+        self._sources.append(
+            stage_times_gtfs_path if gtfs_path is None else gtfs_path
+        )
+
+        # config the compiled stage times depend on
+        self._params = {
+            "stage_time_bucket": config.BUS_STAGE_TIME_BUCKET,
+            "stop_time": config.BUS_STOP_TIME,
+        }
+
+        arrays = load_bundle(
+            bundle_path, self.BUNDLE_KIND, self._sources, self._params
+        )
+        if arrays is None:
+            self._load_sources(
+                stops_path,
+                routes_path,
+                stage_times_gtfs_path,
+                dense_stops_distance,
+                gtfs_path,
+            )
+        else:
+            self._load_bundle(arrays, dense_stops_distance)
+
+        self._route_arrays = {}
+        self.set_alighting_targets()
 
+    def _load_sources(
+        self,
+        stops_path,
+        routes_path,
+        stage_times_gtfs_path,
+        dense_stops_distance,
+        gtfs_path=None,
+    ):
         logger.info(
             f"Initializing Schedule object. Loading routes in {routes_path} "
             f"and stops in {stops_path}.."
@@ -219,11 +527,9 @@ class BusSchedule(metaclass=Singleton):
 
         self.stops = [BusStop.from_dict(s) for s in self.stops_json]
 
-        self.stop_distances = StopsDistance(self.stops)
-
-        self._sid_to_idx = {}
-        for idx, stop in enumerate(self.stops):
-            self._sid_to_idx[stop.stop_id] = idx
+        self.stop_distances = StopsDistance(
+            self.stops, dense=dense_stops_distance
+        )
 
         with open(routes_path) as file:
             self.routes_json = json.load(file)
@@ -238,19 +544,23 @@ class BusSchedule(metaclass=Singleton):
             for r in self.routes_json
         ]
 
-        self._rid_to_idx = {}
-
-        for idx, route in enumerate(self.routes):
-            self._rid_to_idx[
-                (route.route_id, route.route_direction, route.route_variant)
-            ] = idx
+        self._build_indices()
 
         # SET STAGE TIMES
-        with open(stage_times_gtfs_path) as file:
-            stage_times_gtfs = json.load(file)
+        if gtfs_path is None:
+            with open(stage_times_gtfs_path) as file:
+                stage_times_gtfs = {
+                    (int(from_sid), int(to_sid)): stage_time
+                    for from_sid, to_times in json.load(file).items()
+                    for to_sid, stage_time in to_times.items()
+                }
+        else:
+            gtfs_index = GTFSIndex(GTFSReader(gtfs_path), times=True)
+            stage_times_gtfs = self._get_gtfs_stage_times(gtfs_index)
         # with open(stage_times_osrm_path) as file:
         #     stage_times_osrm = json.load(file)
 
+        routes_stage_times = []
         for r in self.routes:
             route_stage_times = []
             route_dists = []
@@ -265,7 +575,7 @@ class BusSchedule(metaclass=Singleton):
                     break
 
                 try:
-                    stage_time = stage_times_gtfs[str(from_sid)][str(to_sid)]
+                    stage_time = stage_times_gtfs[(from_sid, to_sid)]
                 except KeyError:
                     stage_time = (
                         30  # stage_times_osrm[str(from_sid)][str(to_sid)]
@@ -273,16 +583,387 @@ class BusSchedule(metaclass=Singleton):
 
                 route_dist_acc += self.get_distance(from_sid, to_sid)
                 route_dists.append(route_dist_acc)
+                routes_stage_times.append(stage_time)
 
                 if stage_time:
-                    stage_time_acc += stage_time + config.BUS_STOP_TIME
+                    stage_time_acc += stage_time + self._params["stop_time"]
                 route_stage_times.append(stage_time_acc)
             r.set_stage_times(route_stage_times)
             r.set_stage_dists(route_dists)
 
+        if gtfs_path is not None:
+            self._set_bucket_stage_times(
+                gtfs_index,
+                np.array(routes_stage_times, dtype=np.float64),
+                self._params["stage_time_bucket"],
+            )
+
+    def _get_gtfs_stage_times(self, gtfs_index):
+        """
+        (from stop id, to stop id) -> median stage time of the consecutive
+        stops of the trips of a `GTFSIndex` (with times)
+        """
+        pair_times = gtfs_index.get_stop_pair_times()
+        return dict(
+            zip(
+                zip(
+                    pair_times["from_stop_id"].map(convert_gtfs_bus_stop_id),
+                    pair_times["to_stop_id"].map(convert_gtfs_bus_stop_id),
+                ),
+                pair_times["stage_time"].tolist(),
+            )
+        )
+
+    def match_gtfs_trips(self, gtfs_index):
+        """
+        GTFS trips of every route: the trips of a `GTFSIndex` with the same
+        stops as the route.
+
+        Returns
+        -------
+        list
+            for every route of `self.routes`, the array of the codes of its
+            trips (positions in `gtfs_index.trip_ids`), empty if there are
+            none
+        """
+        patterns, trip_patterns = gtfs_index.get_patterns()
+        pattern_codes = {
+            tuple(convert_gtfs_bus_stop_id(sid) for sid in pattern): code
+            for code, pattern in enumerate(patterns)
+        }
+        pattern_trips = np.argsort(trip_patterns, kind="stable")
+        pattern_offsets = np.zeros(len(patterns) + 1, dtype=np.int64)
+        pattern_offsets[1:] = np.cumsum(
+            np.bincount(trip_patterns, minlength=len(patterns))
+        )
+
+        route_trips = []
+        for r in self.routes:
+            code = pattern_codes.get(tuple(r.route_stop_ids))
+            if code is None:
+                route_trips.append(np.array([], dtype=np.int64))
+            else:
+                route_trips.append(
+                    pattern_trips[
+                        pattern_offsets[code] : pattern_offsets[code + 1]
+                    ]
+                )
+
+        n_matched = sum(len(trips) > 0 for trips in route_trips)
+        logger.info(
+            f"Matched {n_matched}/{len(self.routes)} routes to GTFS trips"
+        )
+        return route_trips
+
+    def _set_bucket_stage_times(
+        self,
+        gtfs_index,
+        stage_times,
+        bucket_size=config.BUS_STAGE_TIME_BUCKET,
+    ):
+        """
+        Sets the stage times of every route by time of day bucket, from the
+        GTFS trips with the same stops as the route. A stage's time is the
+        mean of the trips that leave its first stop in the bucket, or else
+        the route's `stage_times` (every route's stage times, flattened).
+        """
+        n_buckets = SECONDS_PER_DAY // bucket_size
+        route_trips = self.match_gtfs_trips(gtfs_index)
+
+        stage_start = 0
+        for r, trips in zip(self.routes, route_trips):
+            n_stages = len(r.route_stop_ids) - 1
+            route_times = stage_times[stage_start : stage_start + n_stages]
+            stage_start += n_stages
+            bucket_times = np.tile(route_times, (n_buckets, 1))
+
+            if len(trips) and n_stages > 0:
+                # (trips x stops) stop time positions
+                positions = (
+                    gtfs_index.trip_offsets[trips][:, None]
+                    + np.arange(n_stages + 1)[None, :]
+                )
+                departures = gtfs_index.departure_times[positions[:, :-1]]
+                trip_times = (
+                    gtfs_index.arrival_times[positions[:, 1:]] - departures
+                )
+                valid = ~np.isnan(trip_times)
+                cells = (departures[valid] // bucket_size).astype(
+                    np.int64
+                ) % n_buckets * n_stages + np.nonzero(valid)[1]
+                sums = np.bincount(
+                    cells,
+                    weights=trip_times[valid],
+                    minlength=n_buckets * n_stages,
+                )
+                counts = np.bincount(cells, minlength=n_buckets * n_stages)
+                bucket_times = np.where(
+                    counts > 0,
+                    sums / np.maximum(counts, 1),
+                    bucket_times.ravel(),
+                ).reshape(n_buckets, n_stages)
+
+            # as `stage_times`, stops without a stage time are skipped
+            bucket_times = np.where(
+                bucket_times > 0, bucket_times + self._params["stop_time"], 0
+            )
+            r.set_bucket_stage_times(np.cumsum(bucket_times, axis=1))
+
+        logger.info(f"Set stage times of {n_buckets} time buckets")
+
+    def _load_bundle(self, arrays, dense_stops_distance):
+        self.stops = [
+            BusStop(sid, name, lat, lon, json.loads(street_point))
+            for sid, name, lat, lon, street_point in zip(
+                arrays["stop_ids"].tolist(),
+                arrays["stop_names"].tolist(),
+                arrays["stop_lats"].tolist(),
+                arrays["stop_lons"].tolist(),
+                arrays["stop_street_points"].tolist(),
+            )
+        ]
+
+        self.stop_distances = StopsDistance.from_arrays(
+            arrays["stop_ids"],
+            arrays["stop_lats"],
+            arrays["stop_lons"],
+            dense=dense_stops_distance,
+            dists=arrays.get("stop_dists") if dense_stops_distance else None,
+        )
+
+        self.routes = [
+            BusRoute(route_id, route_direction, route_variant, stop_ids)
+            for route_id, route_direction, route_variant, stop_ids in zip(
+                arrays["route_ids"].tolist(),
+                arrays["route_directions"].tolist(),
+                arrays["route_variants"].tolist(),
+                from_ragged(
+                    arrays["route_stop_ids"], arrays["route_stop_offsets"]
+                ),
+            )
+        ]
+
+        stage_times = from_ragged(
+            arrays["route_stage_times"], arrays["route_stage_offsets"]
+        )
+        stage_dists = from_ragged(
+            arrays["route_stage_dists"], arrays["route_stage_offsets"]
+        )
+        for r, route_stage_times, route_dists in zip(
+            self.routes, stage_times, stage_dists
+        ):
+            r.set_stage_times(route_stage_times)
+            r.set_stage_dists(route_dists)
+
+        if "route_bucket_stage_times" in arrays:
+            bucket_stage_times = arrays["route_bucket_stage_times"]
+            offsets = arrays["route_stage_offsets"].tolist()
+            for r, start, end in zip(self.routes, offsets[:-1], offsets[1:]):
+                r.set_bucket_stage_times(bucket_stage_times[:, start:end])
+
+        self._build_indices()
+
+    def _build_indices(self):
+        self._sid_to_idx = {}
+        for idx, stop in enumerate(self.stops):
+            self._sid_to_idx[stop.stop_id] = idx
+
+        self._rid_to_idx = {}
+
+        for idx, route in enumerate(self.routes):
+            self._rid_to_idx[
+                (route.route_id, route.route_direction, route.route_variant)
+            ] = idx
+
+    def compile(self, bundle_path=config.BUS_SCHEDULE_BUNDLE_PATH):
+        """
+        Saves the schedule as a bundle (see `odx.bundle`), which later
+        `BusSchedule` instances load instead of the source files,
+        for as long as the source files don't change.
+        """
+        route_stop_ids, route_stop_offsets = to_ragged(
+            [r.route_stop_ids for r in self.routes], dtype=np.int64
+        )
+        route_stage_times, route_stage_offsets = to_ragged(
+            [r.stage_times for r in self.routes], dtype=np.float64
+        )
+        route_stage_dists, _ = to_ragged(
+            [r.stage_dists for r in self.routes], dtype=np.float64
+        )
+
+        arrays = {
+            "stop_ids": np.array([s.stop_id for s in self.stops]),
+            "stop_names": np.array([str(s.stop_name) for s in self.stops]),
+            "stop_lats": np.array([s.stop_lat for s in self.stops]),
+            "stop_lons": np.array([s.stop_lon for s in self.stops]),
+            "stop_street_points": np.array(
+                [json.dumps(s.street_point) for s in self.stops]
+            ),
+            "route_ids": np.array([r.route_id for r in self.routes]),
+            "route_directions": np.array(
+                [r.route_direction for r in self.routes]
+            ),
+            "route_variants": np.array(
+                [r.route_variant for r in self.routes], dtype=np.int64
+            ),
+            "route_stop_ids": route_stop_ids,
+            "route_stop_offsets": route_stop_offsets,
+            "route_stage_times": route_stage_times,
+            "route_stage_dists": route_stage_dists,
+            "route_stage_offsets": route_stage_offsets,
+        }
+        if self.stop_distances.dense:
+            arrays["stop_dists"] = self.stop_distances._dists
+        if self.routes and self.routes[0].bucket_stage_times is not None:
+            # (buckets x stages), with the stages of `route_stage_offsets`
+            arrays["route_bucket_stage_times"] = np.concatenate(
+                [r.bucket_stage_times for r in self.routes], axis=1
+            )
+
+        save_bundle(
+            bundle_path, self.BUNDLE_KIND, arrays, self._sources, self._params
+        )
+
     def get_distance(self, sid1, sid2):
         return self.stop_distances.get_distance(sid1, sid2)
 
+    def set_alighting_targets(self, extra_stops=()):
+        """
+        Sets the candidate next-boarding stops of the alighting tables:
+        every bus stop, followed by `extra_stops` (e.g. metro stops).
+        Resets the cached tables.
+        """
+        self._extra_sid_to_idx = {}
+        for idx, stop in enumerate(extra_stops):
+            self._extra_sid_to_idx[stop.stop_id] = idx
+
+        targets = self.stops + list(extra_stops)
+        self._alighting_targets = StopsIndex(targets)
+        self._alighting_direct_sids = np.array(
+            [s.stop_id for s in self.stops] + [-1] * len(extra_stops),
+            dtype=np.int64,
+        )
+        self._alighting_tables = {}
+
+    def get_target_positions(self, stop_ids, is_bus):
+        """
+        Position of each stop in the alighting targets, or -1 if unknown.
+        Bus stops are looked up in the schedule, others in the extra stops.
+        """
+        bus_index = pd.Index(list(self._sid_to_idx))
+        bus_idxs = np.array(list(self._sid_to_idx.values()), dtype=np.int64)
+        extra_index = pd.Index(list(self._extra_sid_to_idx))
+        extra_idxs = np.array(
+            list(self._extra_sid_to_idx.values()), dtype=np.int64
+        )
+
+        bus_pos = bus_index.get_indexer(stop_ids)
+        extra_pos = extra_index.get_indexer(stop_ids)
+
+        return np.where(
+            is_bus,
+            np.where(bus_pos >= 0, bus_idxs[bus_pos], -1),
+            np.where(
+                extra_pos >= 0, len(self.stops) + extra_idxs[extra_pos], -1
+            ),
+        )
+
+    def get_route_arrays(self, route_idx):
+        """Cached `BusRouteArrays` of the route in `self.routes[route_idx]`"""
+        try:
+            return self._route_arrays[route_idx]
+        except KeyError:
+            pass
+
+        route = self.routes[route_idx]
+        route_stops = [self.get_stop(sid) for sid in route.route_stop_ids]
+        route_arrays = BusRouteArrays(
+            route,
+            [s.stop_lat if s else np.nan for s in route_stops],
+            [s.stop_lon if s else np.nan for s in route_stops],
+        )
+        self._route_arrays[route_idx] = route_arrays
+        return route_arrays
+
+    def get_alighting_table(
+        self,
+        route_idx,
+        max_distance=config.ODXConfig.MAX_BUS_ALIGTHING_BOARDING_DISTANCE,
+    ):
+        """
+        `AlightingTable` of the route in `self.routes[route_idx]`.
+        Built on first use, and rebuilt if a larger `max_distance`
+        is requested.
+        """
+        table = self._alighting_tables.get(route_idx)
+        if table is None or table.max_distance < max_distance:
+            table = AlightingTable(
+                self.get_route_arrays(route_idx),
+                self._alighting_targets,
+                self._alighting_direct_sids,
+                max_distance,
+            )
+            self._alighting_tables[route_idx] = table
+        return table
+
+    def build_alighting_tables(
+        self,
+        max_distance=config.ODXConfig.MAX_BUS_ALIGTHING_BOARDING_DISTANCE,
+    ):
+        """Builds the alighting tables of every route ahead of time"""
+        for route_idx in range(len(self.routes)):
+            self.get_alighting_table(route_idx, max_distance)
+
+    def get_alighting_arrays(self):
+        """
+        The alighting tables built so far, as flat arrays
+        (see `load_alighting_arrays`)
+        """
+        route_idxs = sorted(self._alighting_tables)
+        tables = [self._alighting_tables[idx] for idx in route_idxs]
+        target_pos, target_offsets = to_ragged(
+            [t.target_pos for t in tables], np.int64
+        )
+        return {
+            "alighting_route_idxs": np.array(route_idxs, dtype=np.int64),
+            "alighting_max_distances": np.array(
+                [t.max_distance for t in tables], dtype=np.float64
+            ),
+            "alighting_shapes": np.array(
+                [t.positions.shape for t in tables], dtype=np.int64
+            ).reshape(-1, 2),
+            "alighting_target_pos": target_pos,
+            "alighting_target_offsets": target_offsets,
+            "alighting_positions": to_ragged(
+                [t.positions.ravel() for t in tables], np.int32
+            )[0],
+            "alighting_dists": to_ragged(
+                [t.dists.ravel() for t in tables], np.float64
+            )[0],
+        }
+
+    def load_alighting_arrays(self, arrays):
+        """
+        Sets the alighting tables of `get_alighting_arrays`. Tables are
+        views of the arrays, so memory-mapped arrays are not copied
+        """
+        shapes = arrays["alighting_shapes"]
+        cell_offsets = np.zeros(len(shapes) + 1, dtype=np.int64)
+        cell_offsets[1:] = np.cumsum(shapes.prod(axis=1))
+        target_offsets = arrays["alighting_target_offsets"]
+
+        for i, route_idx in enumerate(arrays["alighting_route_idxs"].tolist()):
+            shape = tuple(shapes[i].tolist())
+            cells = slice(cell_offsets[i], cell_offsets[i + 1])
+            self._alighting_tables[route_idx] = AlightingTable.from_arrays(
+                float(arrays["alighting_max_distances"][i]),
+                arrays["alighting_target_pos"][
+                    target_offsets[i] : target_offsets[i + 1]
+                ],
+                arrays["alighting_positions"][cells].reshape(shape),
+                arrays["alighting_dists"][cells].reshape(shape),
+            )
+
     def get_route_by_id(self, rid):
         # ATTENTION: very slow!! to be used for debugging purposes!
         routes = []
@@ -326,6 +1007,21 @@ class BusSchedule(metaclass=Singleton):
             return None
         return self.stops[idx]
 
+    def get_stop_idx(self, sid):
+        """Index of stop `sid` in `self.stops`, or -1 if unknown"""
+        return self._sid_to_idx.get(sid, -1)
+
+    def get_route_idx(self, route_tuple):
+        """Index of `route_tuple` in `self.routes`, or -1 if unknown"""
+        return self._rid_to_idx.get(
+            (
+                route_tuple.route_id,
+                route_tuple.route_direction,
+                route_tuple.route_variant,
+            ),
+            -1,
+        )
+
     def get_route(self, *args):
 
         if len(args) == 1:
@@ -345,6 +1041,29 @@ class BusSchedule(metaclass=Singleton):
         except KeyError:
             return None
 
+    def get_route_indices(self, route_ids, route_directions, route_variants):
+        """
+        Vectorized route lookup.
+        Returns the index (in `self.routes`) of each route key,
+        or -1 if the route does not exist.
+        """
+        route_keys = pd.MultiIndex.from_tuples(
+            list(self._rid_to_idx), names=BusRouteTuple._fields
+        )
+        query_keys = pd.MultiIndex.from_arrays(
+            [
+                pd.Series(route_ids, dtype=object).to_numpy(),
+                pd.Series(route_directions, dtype=object).to_numpy(),
+                pd.Series(route_variants)
+                .astype("Int64")
+                .to_numpy(dtype=object, na_value=None),
+            ],
+            names=BusRouteTuple._fields,
+        )
+        positions = route_keys.get_indexer(query_keys)
+        route_idxs = np.array(list(self._rid_to_idx.values()), dtype=np.int64)
+        return np.where(positions >= 0, route_idxs[positions], -1)
+
     def get_route_stops(self, route):
         return self.routes[
             self._rid_to_idx[
@@ -1,3 +1,10 @@
+class ODX_ENUMS:
+    METRO = "metro"
+    BUS = "bus"
+    METRO_OUT = "OUT"
+    METRO_IN = "IN"
+
+
 class Stop(object):
     def __init__(self, stop_id, stop_name, stop_lat, stop_lon):
         self.stop_id = stop_id
@@ -14,22 +14,54 @@ BUS_STOPS_PATH = f"{PROCESSED_DATA_PATH}/stops.json"
 BUS_ROUTES_PATH = f"{PROCESSED_DATA_PATH}/routes.json"
 BUS_STAGE_TIMES_GTFS_PATH = f"{PROCESSED_DATA_PATH}/bus_stage_times_gtfs.json"
 BUS_STOP_TIME = 30
+# time of day bucket (seconds) of the stage times derived from a GTFS
+BUS_STAGE_TIME_BUCKET = 15 * 60
+BUS_SCHEDULE_BUNDLE_PATH = f"{PROCESSED_DATA_PATH}/bus_schedule_bundle"
+
+
+# GEO
+# precompute the (stops x stops) distance matrix. Disable for large
+# stop sets, where distances are computed on demand instead
+DENSE_STOPS_DISTANCE = True
 
 
 # GTFS
 METRO_GTFS_PATH = f"{RAW_DATA_PATH}/gtfs_metro_10_2019"
 CARRIS_GTFS_PATH = f"{RAW_DATA_PATH}/gtfs_carris_02_2020"
+# parsed GTFS files (see `gtfs.GTFSReader`)
+GTFS_CACHE_PATH = f"{PROCESSED_DATA_PATH}/gtfs_cache"
+# GTFS the bus stage times are derived from (e.g. CARRIS_GTFS_PATH),
+# instead of BUS_STAGE_TIMES_GTFS_PATH
+BUS_SCHEDULE_GTFS_PATH = None
 
 
 # METRO
 METRO_STOP_MAPPING_PATH = f"{PROCESSED_DATA_PATH}/metro_stop_mapping.json"
+METRO_SCHEDULE_BUNDLE_PATH = f"{PROCESSED_DATA_PATH}/metro_schedule_bundle"
 
 # AFC
 PROCESSED_BUS_AFC_PATH = f"{PROCESSED_DATA_PATH}/afc_carris_10_2019.feather"
 PROCESSED_METRO_AFC_PATH = f"{PROCESSED_DATA_PATH}/afc_metro_10_2019.feather"
+# partitioned afc store (see `afc_store`), and its operator of every mode
+AFC_STORE_PATH = f"{PROCESSED_DATA_PATH}/afc_store"
+AFC_STORE_OPERATORS = {"bus": "carris", "metro": "metro"}
+# card id of every card code (see `afc_schema.CardMapping`)
+CARD_MAPPING_PATH = f"{PROCESSED_DATA_PATH}/card_mapping.feather"
+
+
+# OD MATRIX
+# time of day bin (seconds) of the OD matrices (see `od_matrix.ODMatrix`)
+OD_MATRIX_BIN_SIZE = 15 * 60
+OD_MATRIX_PATH = f"{PROCESSED_DATA_PATH}/od_matrix.npz"
 
 
 # ODX
 class ODXConfig:
-    NEW_DAY_TIME = datetime.datetime.time(4, 0, 0)
+    NEW_DAY_TIME = datetime.time(4, 0, 0)
     MAX_BUS_ALIGTHING_BOARDING_DISTANCE = 0.75  # km
+    # max difference between a boarding and its trip's scheduled departure
+    MAX_TRIP_MATCH_DELAY = 15 * 60  # seconds
+    # max time and walking distance between an alighting and the next
+    # boarding of the same journey
+    MAX_TRANSFER_TIME = 45 * 60  # seconds
+    MAX_TRANSFER_DISTANCE = 0.75  # km
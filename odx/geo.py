@@ -1,4 +1,5 @@
 import numpy as np
+import pandas as pd
 
 
 EARTH_RADIUS_KM = 6371
@@ -44,22 +45,401 @@ def _broadcasting_based_haversine(data1, data2):
     return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(d))
 
 
+def haversine(lat1, lng1, lat2, lng2):
+    """Computes the haversine distance between points (lat1, lng1)
+    and points (lat2, lng2), in degrees.
+    Inputs are broadcast against each other, following numpy rules.
+    """
+    lat1, lng1, lat2, lng2 = map(np.deg2rad, (lat1, lng1, lat2, lng2))
+
+    d = (
+        np.sin((lat1 - lat2) / 2) ** 2
+        + np.cos(lat1) * np.cos(lat2) * np.sin((lng1 - lng2) / 2) ** 2
+    )
+
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(d))
+
+
+def _to_sphere_coords(lats, lngs):
+    """Converts lat,lon (in degrees) to 3d cartesian coordinates (in km)
+    on a sphere with the earth's radius."""
+    lats = np.deg2rad(np.asarray(lats, dtype=np.float64))
+    lngs = np.deg2rad(np.asarray(lngs, dtype=np.float64))
+
+    return EARTH_RADIUS_KM * np.stack(
+        [
+            np.cos(lats) * np.cos(lngs),
+            np.cos(lats) * np.sin(lngs),
+            np.sin(lats),
+        ],
+        axis=-1,
+    )
+
+
+def _arc_to_chord(dist):
+    """Straight line distance between two points `dist` km apart
+    on the earth's surface"""
+    dist = np.minimum(dist, np.pi * EARTH_RADIUS_KM)
+    return 2 * EARTH_RADIUS_KM * np.sin(dist / (2 * EARTH_RADIUS_KM))
+
+
+class StopsIndex:
+    """
+    Spatial index for nearest-stop and within-radius queries.
+
+    Stops are placed in a uniform grid of cubic cells over their 3d
+    coordinates on the earth's sphere, and cells are kept sorted by key,
+    so each query is a few binary searches instead of a scan over every stop.
+
+    Query results are positions in the `stops` used to build the index
+    (see `stop_ids`), with -1 (and infinite distance) where there is no result.
+
+    Parameters
+    ----------
+    stops: list
+        list of `Stop`
+    cell_size_km: float
+        grid cell size. Queries are fastest when their radius is
+        about the cell size
+    """
+
+    # cells per axis must fit in _KEY_BITS
+    _KEY_BITS = 21
+    # larger searches fall back to scanning every stop
+    _MAX_CELL_REACH = 8
+    # cells (or stops) searched at once, queries are split in chunks
+    # so that their candidate arrays stay within this many entries
+    _CHUNK_SIZE = 2**20
+
+    def __init__(self, stops: list, cell_size_km=0.5):
+        self._init_arrays(
+            [s.stop_id for s in stops],
+            [s.stop_lat for s in stops],
+            [s.stop_lon for s in stops],
+            cell_size_km,
+        )
+
+    @classmethod
+    def from_arrays(cls, stop_ids, stop_lats, stop_lons, cell_size_km=0.5):
+        index = cls.__new__(cls)
+        index._init_arrays(stop_ids, stop_lats, stop_lons, cell_size_km)
+        return index
+
+    def _init_arrays(self, stop_ids, stop_lats, stop_lons, cell_size_km):
+        if 2 * EARTH_RADIUS_KM / cell_size_km >= 2**self._KEY_BITS:
+            raise ValueError(f"cell_size_km too small: {cell_size_km}")
+
+        self.stop_ids = np.asarray(stop_ids)
+        self.stop_lats = np.asarray(stop_lats, dtype=np.float64)
+        self.stop_lons = np.asarray(stop_lons, dtype=np.float64)
+        self.cell_size_km = cell_size_km
+
+        self._coords = _to_sphere_coords(self.stop_lats, self.stop_lons)
+        keys = self._cell_keys(self._cells(self._coords))
+        self._order = np.argsort(keys, kind="stable")
+        self._keys = keys[self._order]
+
+    def __len__(self):
+        return len(self.stop_ids)
+
+    def subset(self, stop_ids):
+        """Returns a new index, over the stops in `stop_ids` only"""
+        mask = np.isin(self.stop_ids, stop_ids)
+        return self.from_arrays(
+            self.stop_ids[mask],
+            self.stop_lats[mask],
+            self.stop_lons[mask],
+            self.cell_size_km,
+        )
+
+    def _cells(self, coords):
+        return np.floor(coords / self.cell_size_km).astype(np.int64)
+
+    def _cell_keys(self, cells):
+        offset = 1 << (self._KEY_BITS - 1)
+        cells = cells + offset
+        return (
+            (cells[..., 0] << (2 * self._KEY_BITS))
+            | (cells[..., 1] << self._KEY_BITS)
+            | cells[..., 2]
+        )
+
+    def _candidates(self, coords, reach):
+        """
+        Stops in the cells up to `reach` cells away from each query point.
+        Returns (query positions, stop positions).
+        """
+        steps = np.arange(-reach, reach + 1)
+        offsets = np.stack(np.meshgrid(steps, steps, steps), axis=-1).reshape(
+            -1, 3
+        )
+        cells = self._cells(coords)
+        keys = self._cell_keys(cells[:, None, :] + offsets[None, :, :])
+
+        starts = np.searchsorted(self._keys, keys, side="left").ravel()
+        counts = (
+            np.searchsorted(self._keys, keys, side="right").ravel() - starts
+        )
+
+        total = counts.sum()
+        query_pos = np.repeat(
+            np.repeat(np.arange(len(coords)), len(offsets)), counts
+        )
+        within = np.arange(total) - np.repeat(
+            np.cumsum(counts) - counts, counts
+        )
+        stop_pos = self._order[np.repeat(starts, counts) + within]
+
+        return query_pos, stop_pos
+
+    def _brute_force(self, coords):
+        """Every (query, stop) pair. Used when searches cover too many cells"""
+        query_pos = np.repeat(np.arange(len(coords)), len(self))
+        stop_pos = np.tile(np.arange(len(self)), len(coords))
+        return query_pos, stop_pos
+
+    def _query_radius_chunks(self, lats, lngs, radius_km):
+        """
+        `query_radius` of chunks of the queries, so that a chunk searches
+        up to `_CHUNK_SIZE` cells (or stops, when scanning every stop).
+        Yields (chunk slice, query positions in the chunk, stop positions,
+        distances) for every chunk.
+        """
+        chord = _arc_to_chord(radius_km)
+        reach = int(np.ceil(chord / self.cell_size_km))
+        brute_force = reach > self._MAX_CELL_REACH
+        searched = len(self) if brute_force else (2 * reach + 1) ** 3
+        chunk_size = max(1, self._CHUNK_SIZE // max(searched, 1))
+
+        for start in range(0, len(lats), chunk_size):
+            chunk = slice(start, start + chunk_size)
+            chunk_lats, chunk_lngs = lats[chunk], lngs[chunk]
+            coords = _to_sphere_coords(chunk_lats, chunk_lngs)
+            if brute_force:
+                query_pos, stop_pos = self._brute_force(coords)
+            else:
+                query_pos, stop_pos = self._candidates(coords, reach)
+
+            # cheap straight line distance filter, before the haversine
+            chord_sq = ((coords[query_pos] - self._coords[stop_pos]) ** 2).sum(
+                axis=1
+            )
+            near = chord_sq <= (chord * (1 + 1e-9)) ** 2
+            query_pos, stop_pos = query_pos[near], stop_pos[near]
+
+            dists = haversine(
+                chunk_lats[query_pos],
+                chunk_lngs[query_pos],
+                self.stop_lats[stop_pos],
+                self.stop_lons[stop_pos],
+            )
+            within = dists <= radius_km
+            yield chunk, query_pos[within], stop_pos[within], dists[within]
+
+    def query_radius(self, lats, lngs, radius_km):
+        """
+        Stops within `radius_km` of each query point.
+
+        Returns
+        -------
+        tuple
+            (query positions, stop positions, distances), one entry per
+            (query, stop) pair, sorted by query position
+        """
+        lats = np.atleast_1d(np.asarray(lats, dtype=np.float64))
+        lngs = np.atleast_1d(np.asarray(lngs, dtype=np.float64))
+
+        query_pos = [np.array([], dtype=np.int64)]
+        stop_pos = [np.array([], dtype=np.int64)]
+        dists = [np.array([], dtype=np.float64)]
+        for chunk, q_pos, s_pos, q_dists in self._query_radius_chunks(
+            lats, lngs, radius_km
+        ):
+            query_pos.append(q_pos + chunk.start)
+            stop_pos.append(s_pos)
+            dists.append(q_dists)
+        return (
+            np.concatenate(query_pos),
+            np.concatenate(stop_pos),
+            np.concatenate(dists),
+        )
+
+    def query_nearest(self, lats, lngs, k=1):
+        """
+        The `k` stops closest to each query point.
+        The search radius grows until every query has `k` stops within it.
+
+        Returns
+        -------
+        tuple
+            (stop positions, distances), both with shape (queries, k),
+            sorted by distance
+        """
+        lats = np.atleast_1d(np.asarray(lats, dtype=np.float64))
+        lngs = np.atleast_1d(np.asarray(lngs, dtype=np.float64))
+
+        stop_pos = np.full((len(lats), k), -1, dtype=np.int64)
+        dists = np.full((len(lats), k), np.inf)
+        # can't find more stops than there are in the index
+        k_found = min(k, len(self))
+
+        pending = np.arange(len(lats))
+        radius = self.cell_size_km
+        while len(pending) and k_found:
+            done = np.zeros(len(pending), dtype=bool)
+            # chunk by chunk, so only a chunk's stops within radius are kept
+            for chunk, q_pos, s_pos, q_dists in self._query_radius_chunks(
+                lats[pending], lngs[pending], radius
+            ):
+                queries = pending[chunk]
+                found = np.bincount(q_pos, minlength=len(queries))
+                chunk_done = found >= k_found
+                if radius >= np.pi * EARTH_RADIUS_KM:
+                    # the whole sphere was searched
+                    chunk_done[:] = True
+                done[chunk] = chunk_done
+
+                # k closest of each finished query
+                keep = chunk_done[q_pos]
+                q_pos, s_pos, q_dists = q_pos[keep], s_pos[keep], q_dists[keep]
+                order = np.lexsort((q_dists, q_pos))
+                q_pos, s_pos = q_pos[order], s_pos[order]
+                q_dists = q_dists[order]
+                group_starts = np.searchsorted(q_pos, q_pos, side="left")
+                rank = np.arange(len(q_pos)) - group_starts
+                top = rank < k
+                stop_pos[queries[q_pos[top]], rank[top]] = s_pos[top]
+                dists[queries[q_pos[top]], rank[top]] = q_dists[top]
+
+            pending = pending[~done]
+            radius *= 2
+
+        return stop_pos, dists
+
+
 class StopsDistance:
-    def __init__(self, stops: list):
-        _stops_distance = {}
+    """
+    Haversine distance (in km) between every pair of stops.
+
+    When `dense`, distances are kept in a single (stops x stops) array, whose
+    rows and columns are indexed by stop_id through `_sid_to_idx`.
+    Otherwise distances are computed from the stops' coordinates on every
+    query, and memory grows linearly with the number of stops.
+
+    Parameters
+    ----------
+    stops: list
+        list of `Stop`
+    dtype:
+        dtype of the distance matrix. np.float32 halves its memory
+    dense: bool
+        whether to precompute the distance matrix
+    """
+
+    def __init__(self, stops: list, dtype=np.float64, dense=True):
+        self._init_arrays(
+            [s.stop_id for s in stops],
+            [s.stop_lat for s in stops],
+            [s.stop_lon for s in stops],
+            dtype,
+            dense,
+        )
+
+    @classmethod
+    def from_arrays(
+        cls,
+        stop_ids,
+        stop_lats,
+        stop_lons,
+        dtype=np.float64,
+        dense=True,
+        dists=None,
+    ):
+        """
+        Builds from stop arrays. `dists`, if given, is used as the
+        (possibly memory-mapped) distance matrix instead of computing it.
+        """
+        stops_distance = cls.__new__(cls)
+        stops_distance._init_arrays(
+            stop_ids, stop_lats, stop_lons, dtype, dense, dists
+        )
+        return stops_distance
+
+    def _init_arrays(
+        self, stop_ids, stop_lats, stop_lons, dtype, dense, dists=None
+    ):
+        self._lats = np.asarray(stop_lats, dtype=np.float64)
+        self._lons = np.asarray(stop_lons, dtype=np.float64)
 
-        points_array = np.array([[s.stop_lat, s.stop_lon] for s in stops])
-        dists = _broadcasting_based_haversine(points_array, points_array)
+        if dists is not None:
+            self._dists = dists
+        elif dense:
+            points_array = np.stack([self._lats, self._lons], axis=1)
+            self._dists = np.ascontiguousarray(
+                _broadcasting_based_haversine(points_array, points_array),
+                dtype=dtype,
+            )
+        else:
+            self._dists = None
 
-        for from_idx, from_stop in enumerate(stops):
-            _stops_distance[from_stop.stop_id] = {}
+        # if a stop_id is repeated, the last stop is used
+        self._sid_to_idx = {}
+        for idx, sid in enumerate(np.asarray(stop_ids).tolist()):
+            self._sid_to_idx[sid] = idx
 
-            for to_idx, to_stop in enumerate(stops):
-                _stops_distance[from_stop.stop_id][to_stop.stop_id] = dists[
-                    from_idx
-                ][to_idx]
+        self._sid_index = pd.Index(list(self._sid_to_idx))
+        self._sid_idxs = np.array(
+            list(self._sid_to_idx.values()), dtype=np.int64
+        )
+        self._index = None
 
-        self._stops_distance = _stops_distance
+    @property
+    def dense(self):
+        return self._dists is not None
+
+    @property
+    def index(self):
+        """`StopsIndex` over the same stops, built on first access"""
+        if self._index is None:
+            idxs = self._sid_idxs
+            self._index = StopsIndex.from_arrays(
+                self._sid_index.to_numpy(), self._lats[idxs], self._lons[idxs]
+            )
+        return self._index
+
+    def get_indices(self, sids):
+        """
+        Returns the row index of each stop_id in `sids`.
+        Raises KeyError if any stop_id is unknown.
+        """
+        positions = self._sid_index.get_indexer(np.asarray(sids).ravel())
+        if (positions < 0).any():
+            unknown = np.asarray(sids).ravel()[positions < 0]
+            raise KeyError(f"Unknown stop_ids: {unknown[:10].tolist()}")
+        return self._sid_idxs[positions].reshape(np.shape(sids))
+
+    def _get_distances(self, idxs1, idxs2):
+        if self._dists is not None:
+            return self._dists[idxs1, idxs2]
+        return haversine(
+            self._lats[idxs1],
+            self._lons[idxs1],
+            self._lats[idxs2],
+            self._lons[idxs2],
+        )
 
     def get_distance(self, sid1, sid2):
-        return self._stops_distance[sid1][sid2]
+        return self._get_distances(
+            self._sid_to_idx[sid1], self._sid_to_idx[sid2]
+        )
+
+    def get_distances(self, sids_a, sids_b):
+        """
+        Vectorized `get_distance`.
+        Returns the distance between each stop in `sids_a` and the stop
+        in the same position of `sids_b` (inputs are broadcast, following
+        numpy rules).
+        """
+        return self._get_distances(
+            self.get_indices(sids_a), self.get_indices(sids_b)
+        )
@@ -1,32 +1,506 @@
-import functools
+"""
+Typed GTFS reader, with a persistent columnar cache.
+
+Standard GTFS files are parsed with the column types of `GTFS_COLUMN_TYPES`
+(other columns are read as strings). The parsed tables are cached as
+uncompressed feather files in `cache_dir`, keyed by the path, modification
+time and size of the GTFS file, so later loads, in any process, are
+memory-mapped reads instead of csv parsing.
+Times (e.g. `arrival_time`) are kept as strings, since GTFS times
+may be past 24:00:00; see `gtfs_time_to_seconds`.
+
+`GTFSIndex` groups the trips and stop times of a feed, so schedules are
+built from it in linear time.
+"""
+import hashlib
+from pathlib import Path
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pv
+import pyarrow.compute as pc
+import pyarrow.feather as feather
 from loguru import logger
-from pathlib import Path
 
+from . import config
+
+_str = pa.string()
+_dict = pa.dictionary(pa.int32(), pa.string())
+
+# columns of the weekly patterns of `calendar`
+WEEKDAYS = [
+    "monday",
+    "tuesday",
+    "wednesday",
+    "thursday",
+    "friday",
+    "saturday",
+    "sunday",
+]
+
+GTFS_COLUMN_TYPES = {
+    "agency": {
+        "agency_id": _str,
+        "agency_name": _str,
+        "agency_url": _str,
+        "agency_timezone": _str,
+    },
+    "stops": {
+        "stop_id": _str,
+        "stop_code": _str,
+        "stop_name": _str,
+        "stop_lat": pa.float64(),
+        "stop_lon": pa.float64(),
+        "zone_id": _str,
+        "location_type": pa.int8(),
+        "parent_station": _str,
+        "wheelchair_boarding": pa.int8(),
+    },
+    "routes": {
+        "route_id": _str,
+        "agency_id": _str,
+        "route_short_name": _str,
+        "route_long_name": _str,
+        "route_type": pa.int16(),
+        "route_color": _str,
+        "route_text_color": _str,
+    },
+    "trips": {
+        "route_id": _str,
+        "service_id": _str,
+        "trip_id": _str,
+        "trip_headsign": _str,
+        "direction_id": pa.int8(),
+        "block_id": _str,
+        "shape_id": _str,
+    },
+    "stop_times": {
+        "trip_id": _dict,
+        "arrival_time": _str,
+        "departure_time": _str,
+        "stop_id": _dict,
+        "stop_sequence": pa.int32(),
+        "pickup_type": pa.int8(),
+        "drop_off_type": pa.int8(),
+        "shape_dist_traveled": pa.float64(),
+        "timepoint": pa.int8(),
+    },
+    "calendar": {
+        "service_id": _str,
+        **{day: pa.int8() for day in WEEKDAYS},
+        "start_date": _str,
+        "end_date": _str,
+    },
+    "calendar_dates": {
+        "service_id": _str,
+        "date": _str,
+        "exception_type": pa.int8(),
+    },
+    "shapes": {
+        "shape_id": _dict,
+        "shape_pt_lat": pa.float64(),
+        "shape_pt_lon": pa.float64(),
+        "shape_pt_sequence": pa.int32(),
+        "shape_dist_traveled": pa.float64(),
+    },
+    "frequencies": {
+        "trip_id": _str,
+        "start_time": _str,
+        "end_time": _str,
+        "headway_secs": pa.int32(),
+        "exact_times": pa.int8(),
+    },
+}
+
+
+def gtfs_time_to_seconds(times):
+    """
+    Vectorized conversion of GTFS times ('HH:MM:SS', hours may be
+    past 24) to seconds after midnight. Missing times become NaN.
+    """
+    if not isinstance(times, (pa.Array, pa.ChunkedArray)):
+        times = pa.array(
+            pd.Series(times, dtype=object), pa.string(), from_pandas=True
+        )
+    parts = pc.split_pattern(pc.utf8_trim_whitespace(times), ":")
+    valid = pc.fill_null(pc.equal(pc.list_value_length(parts), 3), False)
+
+    seconds = np.full(len(times), np.nan)
+    hms = pc.cast(pc.list_flatten(parts.filter(valid)), pa.float64())
+    seconds[valid.to_numpy(zero_copy_only=False)] = hms.to_numpy().reshape(
+        -1, 3
+    ) @ [3600, 60, 1]
+    return seconds
+
+
+def gtfs_date_to_day(dates):
+    """
+    Vectorized conversion of GTFS dates ('YYYYMMDD') to datetime64[D].
+    Missing or invalid dates become NaT.
+    """
+    return (
+        pd.to_datetime(
+            pd.Series(dates, dtype=object), format="%Y%m%d", errors="coerce"
+        )
+        .to_numpy()
+        .astype("datetime64[D]")
+    )
+
+
+def _to_pandas_type(arrow_type):
+    """Nullable pandas integer dtype of arrow integer types"""
+    if pa.types.is_signed_integer(arrow_type):
+        return pd.api.types.pandas_dtype(f"Int{arrow_type.bit_width}")
+    return None
 
-class RawGTFSReaderMeta(type):
-    @functools.lru_cache(maxsize=10, typed=False)
-    def __call__(cls, *args, **kwargs):
-        return super(RawGTFSReaderMeta, cls).__call__(*args, **kwargs)
 
+class GTFSReader:
+    """
+    Reads the GTFS files in `gtfs_path`.
 
-class RawGTFSReader(metaclass=RawGTFSReaderMeta):
-    def __init__(self, gtfs_path):
+    Files are read with `read`, or as attributes (`reader.stop_times`),
+    which read every column and are kept in memory.
+
+    Parameters
+    ----------
+    gtfs_path: str
+    cache_dir: str
+        directory of the columnar cache, None to disable it
+    """
+
+    def __init__(self, gtfs_path, cache_dir=config.GTFS_CACHE_PATH):
         self.path = Path(gtfs_path)
+        self.cache_dir = None if cache_dir is None else Path(cache_dir)
 
         if not self.path.exists():
             raise RuntimeError(f"No such folder: {self.path}")
-        logger.info(f"Initialized RawGTFSReader for path {gtfs_path}")
+        logger.info(f"Initialized GTFSReader for path {gtfs_path}")
 
     def __getattr__(self, attr):
-        val = self.file_to_df(attr)
+        if attr.startswith("_"):
+            raise AttributeError(attr)
+        val = self.read(attr)
         setattr(self, attr, val)
         return val
 
-    def file_to_df(self, attr):
-        file_ = self.path / f"{attr}.txt"
+    def has_file(self, name):
+        return (self.path / f"{name}.txt").exists()
 
+    def get_file(self, name):
+        file_ = self.path / f"{name}.txt"
         if not file_.exists():
-            raise RuntimeError(f"No such file {attr}")
+            raise RuntimeError(f"No such file {name}")
+        return file_
+
+    def get_cache_path(self, name):
+        """Cache file of `name`, for the current version of the GTFS file"""
+        file_ = self.get_file(name).resolve()
+        stat = file_.stat()
+        path_hash = hashlib.sha256(str(file_).encode()).hexdigest()[:16]
+        return self.cache_dir / (
+            f"{path_hash}_{name}_{stat.st_mtime_ns}_{stat.st_size}.feather"
+        )
+
+    def read_table(self, name, columns=None):
+        """
+        Arrow table of the GTFS file `name`, with only `columns`
+        (all by default), through the cache
+        """
+        if self.cache_dir is None:
+            table = self._parse(name)
+            return table if columns is None else table.select(columns)
+
+        cache_path = self.get_cache_path(name)
+        if not cache_path.exists():
+            table = self._parse(name)
+            self._write_cache(cache_path, table)
+
+        return feather.read_table(cache_path, columns=columns, memory_map=True)
+
+    def read(self, name, columns=None):
+        """
+        Dataframe of the GTFS file `name`, with only `columns`
+        (all by default). Integer columns are nullable,
+        dictionary columns are categoricals.
+        """
+        return self.read_table(name, columns).to_pandas(
+            types_mapper=_to_pandas_type
+        )
+
+    def _parse(self, name):
+        file_ = self.get_file(name)
+        with open(file_, encoding="utf-8-sig") as f:
+            header = f.readline().rstrip("\r\n").split(",")
+        header = [col.strip().strip('"') for col in header]
+
+        column_types = GTFS_COLUMN_TYPES.get(name, {})
+        logger.info(f"Parsing GTFS file {file_}")
+        # the csv reader skips the byte order mark, if any
+        return pv.read_csv(
+            file_,
+            convert_options=pv.ConvertOptions(
+                column_types={
+                    col: column_types.get(col, pa.string()) for col in header
+                },
+                strings_can_be_null=True,
+            ),
+        )
+
+    def _write_cache(self, cache_path, table):
+        """Writes `table` to the cache, removing older versions of the file"""
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        prefix = "_".join(cache_path.name.split("_")[:-2])
+        for stale in self.cache_dir.glob(f"{prefix}_*.feather"):
+            stale.unlink()
+
+        tmp_path = cache_path.with_name(cache_path.name + ".tmp")
+        # uncompressed, so it can be memory-mapped
+        feather.write_feather(table, tmp_path, compression="uncompressed")
+        tmp_path.replace(cache_path)
+        logger.info(f"Cached GTFS file in {cache_path}")
+
+
+class ServiceCalendar:
+    """
+    Days on which the services of a GTFS feed run: the weekly patterns
+    of `calendar`, between their start and end dates, with the dates
+    added and removed by `calendar_dates`. In a feed with neither file,
+    every service runs every day.
+
+    Parameters
+    ----------
+    reader: GTFSReader
+    service_ids: pd.Index
+        services, by code
+    """
+
+    def __init__(self, reader, service_ids):
+        self.service_ids = service_ids
+        n_services = len(service_ids)
+        self.has_calendar = reader.has_file("calendar") or reader.has_file(
+            "calendar_dates"
+        )
+
+        # (services x weekdays), monday first
+        self.weekdays = np.zeros((n_services, 7), dtype=bool)
+        self.start_days = np.full(n_services, "NaT", dtype="datetime64[D]")
+        self.end_days = np.full(n_services, "NaT", dtype="datetime64[D]")
+        if reader.has_file("calendar"):
+            calendar = reader.read("calendar")
+            codes = service_ids.get_indexer(calendar["service_id"])
+            known = codes >= 0
+            self.weekdays[codes[known]] = (
+                calendar[WEEKDAYS].to_numpy(dtype=np.float64, na_value=0) == 1
+            )[known]
+            self.start_days[codes[known]] = gtfs_date_to_day(
+                calendar["start_date"]
+            )[known]
+            self.end_days[codes[known]] = gtfs_date_to_day(
+                calendar["end_date"]
+            )[known]
+
+        self.exception_services = np.array([], dtype=np.int64)
+        self.exception_days = np.array([], dtype="datetime64[D]")
+        self.exception_added = np.array([], dtype=bool)
+        if reader.has_file("calendar_dates"):
+            dates = reader.read("calendar_dates")
+            codes = service_ids.get_indexer(dates["service_id"])
+            days = gtfs_date_to_day(dates["date"])
+            known = (codes >= 0) & ~np.isnat(days)
+            self.exception_services = codes[known].astype(np.int64)
+            self.exception_days = days[known]
+            # 1: service added on the date, 2: removed
+            self.exception_added = (
+                dates["exception_type"].to_numpy(dtype=np.float64, na_value=0)
+                == 1
+            )[known]
+
+    def get_active(self, days):
+        """
+        Whether every service runs on `days` (datetime64[D] array),
+        as a (days x services) boolean array
+        """
+        days = np.asarray(days, dtype="datetime64[D]")
+        if not self.has_calendar or not len(days):
+            return np.ones((len(days), len(self.service_ids)), dtype=bool)
+        days, day_codes = np.unique(days, return_inverse=True)
+
+        # 1970-01-01 was a thursday
+        weekdays = (days.astype(np.int64) + 3) % 7
+        active = (
+            self.weekdays[:, weekdays].T
+            & (days[:, None] >= self.start_days[None, :])
+            & (days[:, None] <= self.end_days[None, :])
+        )
+        day_idxs = np.minimum(
+            np.searchsorted(days, self.exception_days), len(days) - 1
+        )
+        found = days[day_idxs] == self.exception_days
+        active[day_idxs[found], self.exception_services[found]] = (
+            self.exception_added[found]
+        )
+        return active[day_codes]
+
+
+class GTFSIndex:
+    """
+    Trips and stop times of a GTFS feed, grouped with a single sort of
+    `stop_times` into offset arrays:
+
+    - trip -> stops, in `stop_sequence` order (`get_trip_stops`)
+    - route -> trips, in `trips.txt` order (`get_route_trips`)
+    - stop -> trips (`get_stop_trips`)
+
+    Trips, routes, stops and services are identified by their position
+    (code) in `trip_ids`, `route_ids`, `stop_ids` and `service_ids`, and
+    the days services run on are given by `calendar` (`ServiceCalendar`).
+    Stop times of trips that are not in `trips.txt` are ignored.
+
+    Parameters
+    ----------
+    reader: GTFSReader
+    times: bool
+        whether to also index the arrival and departure times
+        (seconds after midnight) of the stop times
+    """
+
+    def __init__(self, reader, times=False):
+        trips = reader.read("trips", ["route_id", "service_id", "trip_id"])
+        self.trip_ids = pd.Index(trips["trip_id"])
+        route_codes, self.route_ids = pd.factorize(trips["route_id"])
+        self.trip_routes = route_codes.astype(np.int64)
+        service_codes, self.service_ids = pd.factorize(trips["service_id"])
+        self.trip_services = service_codes.astype(np.int64)
+        self.calendar = ServiceCalendar(reader, self.service_ids)
+
+        time_columns = ["arrival_time", "departure_time"] if times else []
+        stop_times = reader.read(
+            "stop_times",
+            ["trip_id", "stop_id", "stop_sequence"] + time_columns,
+        )
+
+        trip_ids = stop_times["trip_id"].astype("category").cat
+        trip_codes = self.trip_ids.get_indexer(trip_ids.categories)
+        codes = trip_ids.codes.to_numpy()
+        trip_codes = np.where(codes >= 0, trip_codes[codes], -1)
+        stop_ids = stop_times["stop_id"].astype("category").cat
+        self.stop_ids = pd.Index(stop_ids.categories)
+        stop_codes = stop_ids.codes.to_numpy(dtype=np.int64)
+
+        valid = (trip_codes >= 0) & (stop_codes >= 0)
+        sequence = stop_times["stop_sequence"].to_numpy(
+            dtype=np.float64, na_value=np.nan
+        )
+        order = np.lexsort((sequence[valid], trip_codes[valid]))
+        self.stop_time_trips = trip_codes[valid][order].astype(np.int64)
+        self.stop_time_stops = stop_codes[valid][order]
+        if times:
+            self.arrival_times, self.departure_times = (
+                gtfs_time_to_seconds(stop_times[col].to_numpy()[valid][order])
+                for col in time_columns
+            )
+
+        n_trips = len(self.trip_ids)
+        self.trip_offsets = self._get_offsets(self.stop_time_trips, n_trips)
+
+        self.route_trips = np.argsort(self.trip_routes, kind="stable")
+        self.route_offsets = self._get_offsets(
+            self.trip_routes, len(self.route_ids)
+        )
+
+        visits = np.unique(
+            self.stop_time_stops * n_trips + self.stop_time_trips
+        )
+        self.stop_visit_trips = visits % n_trips
+        self.stop_offsets = self._get_offsets(
+            visits // n_trips, len(self.stop_ids)
+        )
+        logger.info(
+            f"Indexed {n_trips} trips of {len(self.route_ids)} routes, "
+            f"{len(self.stop_time_stops)} stop times"
+        )
+
+    @staticmethod
+    def _get_offsets(codes, n_codes):
+        offsets = np.zeros(n_codes + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(np.bincount(codes, minlength=n_codes))
+        return offsets
+
+    def get_trip_stops(self, trip_id):
+        """Stop ids of a trip, in `stop_sequence` order"""
+        trip = self.trip_ids.get_loc(trip_id)
+        start, end = self.trip_offsets[trip], self.trip_offsets[trip + 1]
+        return self.stop_ids[self.stop_time_stops[start:end]]
+
+    def get_route_trips(self, route_id):
+        """Trip ids of a route, in `trips.txt` order"""
+        route = self.route_ids.get_loc(route_id)
+        start, end = self.route_offsets[route], self.route_offsets[route + 1]
+        return self.trip_ids[self.route_trips[start:end]]
+
+    def get_stop_trips(self, stop_id):
+        """Ids of the trips that stop at a stop"""
+        stop = self.stop_ids.get_loc(stop_id)
+        start, end = self.stop_offsets[stop], self.stop_offsets[stop + 1]
+        return self.trip_ids[self.stop_visit_trips[start:end]]
+
+    def get_patterns(self):
+        """
+        Distinct stop sequences of the trips.
+
+        Returns
+        -------
+        tuple
+            (patterns, trip_patterns): the list of patterns (tuples of
+            stop ids), and the pattern code of every trip
+        """
+        stop_ids = self.stop_ids.to_numpy()[self.stop_time_stops].tolist()
+        offsets = self.trip_offsets.tolist()
+        pattern_codes = {}
+        trip_patterns = np.empty(len(self.trip_ids), dtype=np.int64)
+        for trip, (start, end) in enumerate(zip(offsets[:-1], offsets[1:])):
+            pattern = tuple(stop_ids[start:end])
+            trip_patterns[trip] = pattern_codes.setdefault(
+                pattern, len(pattern_codes)
+            )
+        return list(pattern_codes), trip_patterns
+
+    def get_stop_pair_times(self):
+        """
+        Median travel time (seconds, from departure to arrival) between
+        every pair of consecutive stops of the trips.
+        Requires an index with times.
+
+        Returns
+        -------
+        pd.DataFrame
+            with `from_stop_id`, `to_stop_id` and `stage_time` columns
+        """
+        same_trip = self.stop_time_trips[1:] == self.stop_time_trips[:-1]
+        stage_times = pd.DataFrame(
+            {
+                "from_stop": self.stop_time_stops[:-1][same_trip],
+                "to_stop": self.stop_time_stops[1:][same_trip],
+                "stage_time": (
+                    self.arrival_times[1:] - self.departure_times[:-1]
+                )[same_trip],
+            }
+        ).dropna()
+        stage_times = (
+            stage_times.groupby(["from_stop", "to_stop"], sort=False)[
+                "stage_time"
+            ]
+            .median()
+            .reset_index()
+        )
+        return pd.DataFrame(
+            {
+                "from_stop_id": self.stop_ids[stage_times["from_stop"]],
+                "to_stop_id": self.stop_ids[stage_times["to_stop"]],
+                "stage_time": stage_times["stage_time"].to_numpy(),
+            }
+        )
+
 
-        return pd.read_csv(file_, parse_dates=True)
+# previous name of `GTFSReader`
+RawGTFSReader = GTFSReader
@@ -0,0 +1,234 @@
+"""
+Incremental (near real-time) ODX over a stream of afc events.
+
+Builds the same stages as `ODX.get_stages` and infers the same
+destinations as `ODX.infer_destinations`, one event at a time:
+a bus stage is completed as soon as the same card taps again, and
+the last stage of a card's day is completed at the end of the service day,
+using the first stage of that day (wrap-around).
+"""
+from collections import OrderedDict
+
+from .common import ODX_ENUMS
+from .odx import ODX, BusStage, MetroStage
+from .report import SkipReason
+
+
+class CardState:
+    """Open stages of a card, for the current service day"""
+
+    __slots__ = (
+        "day",
+        "first_stage",
+        "pending_bus",
+        "pending_metro_in",
+        "n_stages",
+        "last_ts",
+    )
+
+    def __init__(self, day):
+        self.day = day
+        # first stage of the day, used for wrap-around
+        self.first_stage = None
+        # last bus stage, waiting for the next stage to infer its destination
+        self.pending_bus = None
+        # metro IN record, waiting for a possible metro OUT
+        self.pending_metro_in = None
+        self.n_stages = 0
+        self.last_ts = None
+
+
+class IncrementalODX:
+    """
+    Incremental ODX engine.
+
+    Events are afc records (with the attributes of the combined afc
+    columns, e.g. rows of `afc.itertuples()`), fed in timestamp order
+    with `process`, `process_batch` or `process_stream`.
+    Completed stages are returned as (card_id, service day, stage) tuples.
+
+    Parameters
+    ----------
+    odx: ODX
+    max_idle: datetime.timedelta
+        state of cards without events for longer than `max_idle` is
+        completed (as if their day was over) and evicted, bounding memory
+        to the recently active cards. By default, state is kept until
+        the end of the service day, which matches `ODX.infer_destinations`
+    """
+
+    def __init__(self, odx=None, max_idle=None):
+        self.odx = odx or ODX()
+        self.max_idle = max_idle
+        self._cards = OrderedDict()
+        self._day = None
+        self._watermark = None
+
+    def __len__(self):
+        """Number of cards with open state"""
+        return len(self._cards)
+
+    def process(self, event):
+        """Processes a single afc event, returns the completed stages"""
+        completed = []
+        day = self.odx.get_record_day(event)
+
+        if self._watermark is None or event.timestamp > self._watermark:
+            self._watermark = event.timestamp
+        if self._day is None or day > self._day:
+            # new service day, every open day is over
+            completed.extend(self.flush())
+            self._day = day
+
+        state = self._cards.pop(event.card_id, None)
+        if state is not None and state.day != day:
+            completed.extend(self._close(event.card_id, state))
+            state = None
+        if state is None:
+            state = CardState(day)
+        self._cards[event.card_id] = state
+        state.last_ts = event.timestamp
+
+        completed.extend(self._add_record(event.card_id, state, event))
+        completed.extend(self.evict_idle())
+        return completed
+
+    def process_batch(self, afc):
+        """Processes a micro-batch (dataframe) of afc events"""
+        completed = []
+        for event in afc.itertuples():
+            completed.extend(self.process(event))
+        return completed
+
+    async def process_stream(self, events):
+        """
+        Processes an async iterable of afc events or micro-batches
+        (dataframes), yielding completed stages as soon as they are known.
+        Open state is completed when the stream ends.
+        """
+        async for item in events:
+            if hasattr(item, "itertuples"):
+                completed = self.process_batch(item)
+            else:
+                completed = self.process(item)
+            for stage in completed:
+                yield stage
+
+        for stage in self.flush():
+            yield stage
+
+    def flush(self):
+        """Completes and removes the open state of every card"""
+        completed = []
+        while self._cards:
+            card_id, state = self._cards.popitem(last=False)
+            completed.extend(self._close(card_id, state))
+        return completed
+
+    def evict_idle(self):
+        """Completes and removes the state of cards idle for `max_idle`"""
+        completed = []
+        if self.max_idle is None:
+            return completed
+
+        # cards are kept in last event order, so idle ones come first
+        while self._cards:
+            card_id, state = next(iter(self._cards.items()))
+            if self._watermark - state.last_ts <= self.max_idle:
+                break
+            del self._cards[card_id]
+            completed.extend(self._close(card_id, state))
+        return completed
+
+    def _add_record(self, card_id, state, record):
+        """Builds stages from `record`, as `ODX.get_stages` does"""
+        completed = []
+        is_metro = record.mode == ODX_ENUMS.METRO
+
+        if state.pending_metro_in is not None:
+            metro_in = state.pending_metro_in
+            state.pending_metro_in = None
+            if is_metro and record.way == ODX_ENUMS.METRO_OUT:
+                return self._add_stage(
+                    card_id, state, self._metro_stage(metro_in, record)
+                )
+            completed.extend(
+                self._add_stage(
+                    card_id, state, self._metro_stage(metro_in, None)
+                )
+            )
+
+        if is_metro and record.way == ODX_ENUMS.METRO_IN:
+            state.pending_metro_in = record
+        elif is_metro and record.way == ODX_ENUMS.METRO_OUT:
+            completed.extend(
+                self._add_stage(
+                    card_id, state, self._metro_stage(None, record)
+                )
+            )
+        elif record.mode == ODX_ENUMS.BUS:
+            completed.extend(
+                self._add_stage(
+                    card_id,
+                    state,
+                    BusStage.from_record(record, self.odx.bus_schedule),
+                )
+            )
+        return completed
+
+    def _metro_stage(self, boarding, alighting):
+        return MetroStage.from_records(
+            boarding, alighting, self.odx.metro_schedule
+        )
+
+    def _add_stage(self, card_id, state, stage):
+        """
+        Appends `stage` to the card's day. Completes the pending bus
+        stage, whose next stage is now known.
+        """
+        if (stage.mode == ODX_ENUMS.METRO) and (
+            stage.entry_stop_idx == stage.exit_stop_idx
+        ):
+            return []
+
+        completed = []
+        state.n_stages += 1
+        if state.first_stage is None:
+            state.first_stage = stage
+
+        if state.pending_bus is not None:
+            self.odx.infer_stage_destination(state.pending_bus, stage)
+            completed.append((card_id, state.day, state.pending_bus))
+            state.pending_bus = None
+
+        if stage.mode == ODX_ENUMS.BUS:
+            state.pending_bus = stage
+        else:
+            completed.append((card_id, state.day, stage))
+        return completed
+
+    def _close(self, card_id, state):
+        """Completes the open stages of a card's day"""
+        completed = []
+        if state.pending_metro_in is not None:
+            completed.extend(
+                self._add_stage(
+                    card_id,
+                    state,
+                    self._metro_stage(state.pending_metro_in, None),
+                )
+            )
+            state.pending_metro_in = None
+
+        if state.pending_bus is not None:
+            # the last stage of the day is followed by the first one,
+            # unless it is the only one
+            if state.n_stages > 1:
+                self.odx.infer_stage_destination(
+                    state.pending_bus, state.first_stage
+                )
+            else:
+                self.odx.add_report(SkipReason.SINGLE_STAGE, state.pending_bus)
+            completed.append((card_id, state.day, state.pending_bus))
+            state.pending_bus = None
+        return completed
@@ -0,0 +1,198 @@
+"""
+Batched destination inference over a stage table (see `stages`).
+
+Infers the same bus alighting stops and times as `ODX.infer_destinations`,
+processing every bus stage of a route at once with numpy operations.
+"""
+import numpy as np
+import pandas as pd
+
+from .common import ODX_ENUMS
+from .config import ODXConfig
+from .stages import NO_STOP, NO_ROUTE
+from .report import SkipReason, get_skip_code
+
+
+def get_next_stage_idx(stages):
+    """
+    For each stage, returns the index of the next stage of the same card
+    and day, and the number of stages in that day.
+    The last stage of the day is followed by the first one (wrap-around).
+
+    `stages` must be sorted by card and day, as returned by
+    `stages.build_stage_table`.
+    """
+    n = len(stages)
+    card_codes, _ = pd.factorize(stages["card_id"])
+    days = stages["day"].to_numpy()
+
+    new_group = np.ones(n, dtype=bool)
+    new_group[1:] = (card_codes[1:] != card_codes[:-1]) | (
+        days[1:] != days[:-1]
+    )
+    group_ids = np.cumsum(new_group) - 1
+    group_starts = np.flatnonzero(new_group)
+    group_sizes = np.diff(np.append(group_starts, n))
+
+    last_in_group = np.append(new_group[1:], True)
+    next_idx = np.where(
+        last_in_group, group_starts[group_ids], np.arange(n) + 1
+    )
+    return next_idx, group_sizes[group_ids]
+
+
+def infer_route_destinations(
+    route_arrays,
+    alighting_table,
+    entry_sids,
+    target_pos,
+    max_distance=ODXConfig.MAX_BUS_ALIGTHING_BOARDING_DISTANCE,
+    entry_ts=None,
+):
+    """
+    Infers the alighting stop of several stages of the same route.
+    Stage times are those of the boarding times `entry_ts`, if given
+    (see `BusRouteArrays.get_stage_times`).
+
+    The alighting stop is the next stage's entry stop, if it is
+    a subsequent stop of the route (direct transfer), or else
+    the subsequent stop closest to the next stage's entry stop,
+    as found in the route's `AlightingTable`.
+
+    Returns
+    -------
+    tuple
+        (exit stop ids, stage times in seconds, skip reason codes).
+        Stages whose destination cannot be inferred get `NO_STOP`, nan and
+        the code of the reason (see `report.SKIP_REASON_CODES`), others 0.
+    """
+    entry_idxs = route_arrays.get_stop_idxs(entry_sids)
+    in_route = entry_idxs >= 0
+    entry_idxs = np.where(in_route, entry_idxs, 0)
+
+    exit_pos, dists = alighting_table.lookup(entry_idxs, target_pos)
+    found = in_route & (exit_pos >= 0)
+    exit_pos = np.where(found, exit_pos, 0)
+
+    exit_sids = route_arrays.stop_ids[exit_pos]
+    stage_times = route_arrays.get_stage_times(
+        entry_idxs, route_arrays.stop_idxs[exit_pos], entry_ts
+    )
+
+    # in the order `ODX.infer_stage_destination` checks them
+    skip_codes = np.select(
+        [
+            (entry_sids == route_arrays.stop_ids[-1])
+            & (not route_arrays.is_circ),
+            target_pos < 0,
+            ~in_route,
+            ~found | (dists > max_distance),
+            np.isnan(stage_times),
+        ],
+        [
+            get_skip_code(SkipReason.LAST_STOP),
+            get_skip_code(SkipReason.NO_NEXT_ENTRY_STOP),
+            get_skip_code(SkipReason.ENTRY_NOT_IN_ROUTE),
+            get_skip_code(SkipReason.DISTANCE),
+            get_skip_code(SkipReason.NO_STAGE_TIME),
+        ],
+        0,
+    )
+    inferred = skip_codes == 0
+
+    return (
+        np.where(inferred, exit_sids, NO_STOP),
+        np.where(inferred, stage_times, np.nan),
+        skip_codes,
+    )
+
+
+def infer_destinations_table(
+    stages,
+    bus_schedule,
+    max_distance=ODXConfig.MAX_BUS_ALIGTHING_BOARDING_DISTANCE,
+    report=None,
+):
+    """
+    Batched version of `ODX.infer_destinations`, over a stage table.
+    Bus stages are grouped by route, and alighting stops are looked up
+    in each route's `AlightingTable`.
+
+    Metro stops must be in the schedule's alighting targets
+    (see `BusSchedule.set_alighting_targets`) for stages followed
+    by a metro stage to be inferred.
+    Inferred and skipped stages are counted in `report` (`ODXReport`),
+    if given.
+
+    Returns
+    -------
+    pd.DataFrame
+        copy of `stages` with `exit_stop_id` and `exit_ts` filled
+        for every bus stage whose destination was inferred
+    """
+    stages = stages.copy()
+    next_idx, group_sizes = get_next_stage_idx(stages)
+
+    modes = stages["mode"].to_numpy()
+    entry_sids = stages["entry_stop_id"].to_numpy()
+    route_idxs = stages["route_idx"].to_numpy()
+    next_sids = entry_sids[next_idx]
+    target_pos = bus_schedule.get_target_positions(
+        next_sids, modes[next_idx] == ODX_ENUMS.BUS
+    )
+
+    is_bus = modes == ODX_ENUMS.BUS
+    skip_codes = np.select(
+        [
+            group_sizes == 1,
+            entry_sids == NO_STOP,
+            route_idxs == NO_ROUTE,
+        ],
+        [
+            get_skip_code(SkipReason.SINGLE_STAGE),
+            get_skip_code(SkipReason.NO_ENTRY_STOP),
+            get_skip_code(SkipReason.UNKNOWN_ROUTE),
+        ],
+        0,
+    )
+    to_infer = is_bus & (skip_codes == 0)
+
+    rows = np.flatnonzero(to_infer)
+    rows = rows[np.argsort(route_idxs[rows], kind="stable")]
+    route_bounds = np.flatnonzero(np.diff(route_idxs[rows])) + 1
+
+    exit_sids = stages["exit_stop_id"].to_numpy().copy()
+    entry_ts = stages["entry_ts"].to_numpy()
+    stage_times = np.full(len(stages), np.nan)
+
+    for route_rows in np.split(rows, route_bounds):
+        if not len(route_rows):
+            continue
+        route_idx = route_idxs[route_rows[0]]
+
+        (
+            exit_sids[route_rows],
+            stage_times[route_rows],
+            skip_codes[route_rows],
+        ) = infer_route_destinations(
+            bus_schedule.get_route_arrays(route_idx),
+            bus_schedule.get_alighting_table(route_idx, max_distance),
+            entry_sids[route_rows],
+            target_pos[route_rows],
+            max_distance,
+            entry_ts[route_rows],
+        )
+
+    if report is not None:
+        report.count_skip_codes(skip_codes[is_bus])
+
+    inferred = ~np.isnan(stage_times)
+    stage_deltas = pd.to_timedelta(
+        np.round(np.where(inferred, stage_times, 0)), unit="s"
+    )
+
+    stages["exit_stop_id"] = exit_sids
+    stages["exit_ts"] = stages["exit_ts"].mask(
+        inferred, stages["entry_ts"] + stage_deltas
+    )
+    return stages
@@ -0,0 +1,159 @@
+"""
+Journey linking over a stage table with inferred destinations
+(see `inference.infer_destinations_table`).
+
+Consecutive stages of a card and service day are chained into a journey
+(the later being a transfer) when the next stage boards within
+`MAX_TRANSFER_TIME` of the alighting, and within `MAX_TRANSFER_DISTANCE`
+of the alighting stop, and is not a ride back on the same bus route.
+Every condition is a comparison of the stage arrays with themselves
+shifted by one stage, and journeys are aggregated from the positions of
+their first and last stages.
+"""
+import numpy as np
+import pandas as pd
+
+from .common import ODX_ENUMS
+from .config import ODXConfig
+from .stages import NO_STOP
+
+JOURNEY_TABLE_COLUMNS = [
+    "journey_id",
+    "card_id",
+    "day",
+    "origin_stop_id",
+    "origin_mode",
+    "destination_stop_id",
+    "destination_mode",
+    "start_ts",
+    "end_ts",
+    "duration",
+    "n_stages",
+    "n_transfers",
+]
+
+
+def get_transfers(
+    stages,
+    stops_distance,
+    max_transfer_time=ODXConfig.MAX_TRANSFER_TIME,
+    max_transfer_distance=ODXConfig.MAX_TRANSFER_DISTANCE,
+):
+    """
+    Whether every stage is a transfer from the previous stage.
+
+    Parameters
+    ----------
+    stages: pd.DataFrame
+        stage table, sorted by card, service day and time
+    stops_distance: StopsDistance
+        distances between the bus and metro stops
+    max_transfer_time: int
+        seconds
+    max_transfer_distance: float
+        km
+    """
+    n = len(stages)
+    is_transfer = np.zeros(n, dtype=bool)
+    if n < 2:
+        return is_transfer
+
+    card_ids = stages["card_id"].to_numpy()
+    days = stages["day"].to_numpy()
+    modes = stages["mode"].to_numpy()
+    route_ids = stages["route_id"].to_numpy()
+    exit_sids = stages["exit_stop_id"].to_numpy()
+    entry_sids = stages["entry_stop_id"].to_numpy()
+    gaps = (
+        stages["entry_ts"].to_numpy()[1:] - stages["exit_ts"].to_numpy()[:-1]
+    ) / np.timedelta64(1, "s")
+
+    # a stage and the next one, which is a transfer candidate
+    candidate = (
+        (card_ids[1:] == card_ids[:-1])
+        & (days[1:] == days[:-1])
+        & (exit_sids[:-1] != NO_STOP)
+        & (entry_sids[1:] != NO_STOP)
+        & (gaps >= 0)
+        & (gaps <= max_transfer_time)
+        & ~(
+            (modes[1:] == ODX_ENUMS.BUS)
+            & (modes[:-1] == ODX_ENUMS.BUS)
+            & (route_ids[1:] == route_ids[:-1])
+        )
+    )
+
+    distances = np.full(n - 1, np.inf)
+    distances[candidate] = stops_distance.get_distances(
+        exit_sids[:-1][candidate], entry_sids[1:][candidate]
+    )
+    is_transfer[1:] = candidate & (distances <= max_transfer_distance)
+    return is_transfer
+
+
+def link_journeys(
+    stages,
+    stops_distance,
+    max_transfer_time=ODXConfig.MAX_TRANSFER_TIME,
+    max_transfer_distance=ODXConfig.MAX_TRANSFER_DISTANCE,
+    first_journey_id=0,
+):
+    """
+    Assigns the stages of a stage table to journeys (see `get_transfers`).
+
+    Returns
+    -------
+    pd.DataFrame
+        copy of `stages` with a `journey_id` column, numbered from
+        `first_journey_id` in stage order
+    """
+    is_transfer = get_transfers(
+        stages, stops_distance, max_transfer_time, max_transfer_distance
+    )
+    stages = stages.copy()
+    stages["journey_id"] = first_journey_id + np.cumsum(~is_transfer) - 1
+    return stages
+
+
+def get_journeys(stages):
+    """
+    Journeys of a stage table linked by `link_journeys`, whose stages
+    are contiguous.
+
+    Returns
+    -------
+    pd.DataFrame
+        one row per journey, with columns `JOURNEY_TABLE_COLUMNS`: the
+        entry stop (and mode) of the first stage, the exit stop of the
+        last one (`NO_STOP` if unknown), their times and the number of
+        stages and transfers
+    """
+    journey_ids = stages["journey_id"].to_numpy()
+    if not len(journey_ids):
+        return pd.DataFrame(columns=JOURNEY_TABLE_COLUMNS)
+
+    first = np.flatnonzero(
+        np.append(True, journey_ids[1:] != journey_ids[:-1])
+    )
+    last = np.append(first[1:], len(journey_ids)) - 1
+
+    start_ts = stages["entry_ts"].to_numpy()[first]
+    end_ts = stages["exit_ts"].to_numpy()[last]
+    n_stages = last - first + 1
+    return pd.DataFrame(
+        {
+            "journey_id": journey_ids[first],
+            "card_id": stages["card_id"].to_numpy()[first],
+            "day": stages["day"].to_numpy()[first],
+            "origin_stop_id": stages["entry_stop_id"].to_numpy()[first],
+            "origin_mode": stages["mode"].to_numpy()[first],
+            "destination_stop_id": stages["exit_stop_id"].to_numpy()[last],
+            "destination_mode": stages["mode"].to_numpy()[last],
+            "start_ts": start_ts,
+            "end_ts": end_ts,
+            "duration": end_ts - start_ts,
+            "n_stages": n_stages,
+            "n_transfers": n_stages - 1,
+        },
+        columns=JOURNEY_TABLE_COLUMNS,
+    )
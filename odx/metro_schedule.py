@@ -1,8 +1,10 @@
+import numpy as np
 from .common import Stop
 from . import config
-from .gtfs import RawGTFSReader
+from .gtfs import GTFSReader, GTFSIndex
 from .utils import Singleton
 from .geo import StopsDistance
+from .bundle import load_bundle, save_bundle, to_ragged, from_ragged
 
 
 class MetroStop(Stop):
@@ -52,8 +54,24 @@ class MetroRoute:
 
 
 class MetroSchedule(metaclass=Singleton):
-    def __init__(self, gtfs_path=config.METRO_GTFS_PATH):
-        reader = RawGTFSReader(gtfs_path)
+    BUNDLE_KIND = "metro_schedule"
+
+    def __init__(
+        self,
+        gtfs_path=config.METRO_GTFS_PATH,
+        dense_stops_distance=config.DENSE_STOPS_DISTANCE,
+        bundle_path=config.METRO_SCHEDULE_BUNDLE_PATH,
+    ):
+        self._sources = [gtfs_path]
+
+        arrays = load_bundle(bundle_path, self.BUNDLE_KIND, self._sources)
+        if arrays is None:
+            self._load_sources(gtfs_path, dense_stops_distance)
+        else:
+            self._load_bundle(arrays, dense_stops_distance)
+
+    def _load_sources(self, gtfs_path, dense_stops_distance):
+        reader = GTFSReader(gtfs_path)
         self.routes = []
 
         self.stops = [
@@ -63,29 +81,30 @@ class MetroSchedule(metaclass=Singleton):
                 r.stop_lat,
                 r.stop_lon,
             )
-            for r in reader.stops.itertuples()
+            for r in reader.read(
+                "stops", ["stop_id", "stop_name", "stop_lat", "stop_lon"]
+            ).itertuples()
         ]
 
         self._sid_to_idx = {}
         for idx, stop in enumerate(self.stops):
             self._sid_to_idx[stop.stop_id] = idx
 
-        self.stops_distance = StopsDistance(self.stops)
+        self.stops_distance = StopsDistance(
+            self.stops, dense=dense_stops_distance
+        )
+
+        routes = reader.read("routes", ["route_id", "route_long_name"])
+        route_names = routes.drop_duplicates("route_id").set_index("route_id")[
+            "route_long_name"
+        ]
+        gtfs_index = GTFSIndex(reader)
 
         line_stops = {}
         self._name_to_route_idx = {}
-        for route_id in reader.routes.route_id.unique():
-            route_name = reader.routes[
-                reader.routes.route_id == route_id
-            ].route_long_name.iloc[0]
-            trip_id = reader.trips[
-                reader.trips.route_id == route_id
-            ].trip_id.iloc[-1]
-            stop_sequence = (
-                reader.stop_times[reader.stop_times.trip_id == trip_id]
-                .sort_values(by="stop_sequence")["stop_id"]
-                .tolist()
-            )
+        for route_id, route_name in route_names.items():
+            trip_id = gtfs_index.get_route_trips(route_id)[-1]
+            stop_sequence = gtfs_index.get_trip_stops(trip_id).tolist()
             line = route_name.split(" - ")[0].lower()
 
             # need this ugly 'if' because the gtfs is bad. amarela->odivelas is repeated..
@@ -118,9 +137,83 @@ class MetroSchedule(metaclass=Singleton):
                 route_dists.append(route_dist_acc)
             ml.set_stage_dists(route_dists)
 
+    def _load_bundle(self, arrays, dense_stops_distance):
+        self.stops = [
+            MetroStop(sid, name, lat, lon)
+            for sid, name, lat, lon in zip(
+                arrays["stop_ids"].tolist(),
+                arrays["stop_names"].tolist(),
+                arrays["stop_lats"].tolist(),
+                arrays["stop_lons"].tolist(),
+            )
+        ]
+
+        self._sid_to_idx = {}
+        for idx, stop in enumerate(self.stops):
+            self._sid_to_idx[stop.stop_id] = idx
+
+        self.stops_distance = StopsDistance.from_arrays(
+            arrays["stop_ids"],
+            arrays["stop_lats"],
+            arrays["stop_lons"],
+            dense=dense_stops_distance,
+            dists=arrays.get("stop_dists") if dense_stops_distance else None,
+        )
+
+        self.routes = []
+        self._name_to_route_idx = {}
+        for idx, (line_name, stops, route_dists) in enumerate(
+            zip(
+                arrays["route_names"].tolist(),
+                from_ragged(
+                    arrays["route_stop_ids"], arrays["route_stop_offsets"]
+                ),
+                from_ragged(
+                    arrays["route_stage_dists"], arrays["route_stage_offsets"]
+                ),
+            )
+        ):
+            ml = MetroRoute(line_name, stops)
+            ml.set_stage_dists(route_dists)
+            self.routes.append(ml)
+            self._name_to_route_idx[line_name] = idx
+
+    def compile(self, bundle_path=config.METRO_SCHEDULE_BUNDLE_PATH):
+        """
+        Saves the schedule as a bundle (see `odx.bundle`), which later
+        `MetroSchedule` instances load instead of the GTFS,
+        for as long as the GTFS files don't change.
+        """
+        route_stop_ids, route_stop_offsets = to_ragged(
+            [r.line_stop_ids for r in self.routes], dtype=np.int64
+        )
+        route_stage_dists, route_stage_offsets = to_ragged(
+            [r.stage_dists for r in self.routes], dtype=np.float64
+        )
+
+        arrays = {
+            "stop_ids": np.array([s.stop_id for s in self.stops]),
+            "stop_names": np.array([str(s.stop_name) for s in self.stops]),
+            "stop_lats": np.array([s.stop_lat for s in self.stops]),
+            "stop_lons": np.array([s.stop_lon for s in self.stops]),
+            "route_names": np.array([r.name for r in self.routes]),
+            "route_stop_ids": route_stop_ids,
+            "route_stop_offsets": route_stop_offsets,
+            "route_stage_dists": route_stage_dists,
+            "route_stage_offsets": route_stage_offsets,
+        }
+        if self.stops_distance.dense:
+            arrays["stop_dists"] = self.stops_distance._dists
+
+        save_bundle(bundle_path, self.BUNDLE_KIND, arrays, self._sources)
+
     def get_route(self, name):
         return self.routes[self._name_to_route_idx[name]]
 
+    def get_stop_idx(self, sid):
+        """Index of stop `sid` in `self.stops`, or -1 if unknown"""
+        return self._sid_to_idx.get(sid, -1)
+
     def get_stop(self, sid):
         try:
             idx = self._sid_to_idx[sid]
@@ -0,0 +1,257 @@
+"""
+Sparse origin-destination matrices by time of day.
+
+`ODMatrix` accumulates counts of (time bin, origin, destination) cells,
+origins and destinations being indices of stops (or of the zones stops
+belong to). Only non-empty cells are stored, in COO form: sorted unique
+int64 keys
+
+    (time bin * n + origin) * n + destination
+
+and their counts. Adding records maps them to keys and sums them with
+`np.unique` and `np.bincount`. Since keys sort by time bin and origin,
+a bin's CSR (see `ODMatrix.to_csr`) is read off the keys directly.
+"""
+import os
+from pathlib import Path
+import numpy as np
+import pandas as pd
+from loguru import logger
+
+from .bus_schedule import SECONDS_PER_DAY, get_time_buckets
+from .config import OD_MATRIX_BIN_SIZE
+
+
+class ODMatrix:
+    """
+    OD counts of every time of day bin.
+
+    Parameters
+    ----------
+    stop_ids: list
+        ids of the stops that can be origins and destinations
+    bin_size: int
+        seconds, must divide a day (`config.OD_MATRIX_BIN_SIZE` by default)
+    zones: list
+        zone id of every stop of `stop_ids`. If given, origins and
+        destinations are zones instead of stops
+    """
+
+    def __init__(self, stop_ids, bin_size=OD_MATRIX_BIN_SIZE, zones=None):
+        if SECONDS_PER_DAY % bin_size:
+            raise ValueError(f"Bin size {bin_size}s does not divide a day")
+        self.bin_size = int(bin_size)
+        self.n_bins = SECONDS_PER_DAY // self.bin_size
+
+        self.stop_ids = np.asarray(stop_ids, dtype=np.int64)
+        if zones is None:
+            self.ids, self._stop_cells = np.unique(
+                self.stop_ids, return_inverse=True
+            )
+        else:
+            self.ids, self._stop_cells = np.unique(
+                np.asarray(zones), return_inverse=True
+            )
+        self._stop_index = pd.Index(self.stop_ids)
+
+        self.keys = np.array([], dtype=np.int64)
+        self.counts = np.array([], dtype=np.float64)
+
+    @classmethod
+    def from_schedules(
+        cls,
+        bus_schedule,
+        metro_schedule,
+        bin_size=OD_MATRIX_BIN_SIZE,
+        zones=None,
+    ):
+        """`ODMatrix` of the bus and metro stops"""
+        stops = bus_schedule.stops + metro_schedule.stops
+        return cls([s.stop_id for s in stops], bin_size, zones)
+
+    @property
+    def n(self):
+        """Number of origins (and destinations)"""
+        return len(self.ids)
+
+    @property
+    def shape(self):
+        return (self.n_bins, self.n, self.n)
+
+    @property
+    def total(self):
+        return float(self.counts.sum())
+
+    def __len__(self):
+        """Number of non-empty cells"""
+        return len(self.keys)
+
+    def __repr__(self):
+        return (
+            f"ODMatrix({self.n_bins} bins x {self.n} x {self.n}, "
+            f"{len(self)} cells, {self.total:.0f} trips)"
+        )
+
+    def get_cells(self, stop_ids):
+        """Origin (destination) index of every stop id, -1 if unknown"""
+        positions = self._stop_index.get_indexer(
+            np.asarray(stop_ids, dtype=np.int64)
+        )
+        return np.where(positions >= 0, self._stop_cells[positions], -1)
+
+    def _merge(self, keys, counts):
+        keys, inverse = np.unique(
+            np.concatenate([self.keys, keys]), return_inverse=True
+        )
+        self.counts = np.bincount(
+            inverse, weights=np.concatenate([self.counts, counts])
+        )
+        self.keys = keys
+
+    def add(self, origins, destinations, timestamps, weights=None):
+        """
+        Adds records of stop ids `origins` to `destinations`, binned by
+        their `timestamps`, each counting its weight (1 by default).
+        Records with unknown stops or timestamps are ignored.
+
+        Returns
+        -------
+        int
+            number of records added
+        """
+        origins = self.get_cells(origins)
+        destinations = self.get_cells(destinations)
+        timestamps = np.asarray(timestamps, dtype="datetime64[ns]")
+        valid = (origins >= 0) & (destinations >= 0) & ~np.isnat(timestamps)
+
+        bins = get_time_buckets(timestamps[valid], self.n_bins)
+        keys = (bins * self.n + origins[valid]) * self.n + destinations[valid]
+        if weights is None:
+            weights = np.ones(len(keys))
+        else:
+            weights = np.asarray(weights, dtype=np.float64)[valid]
+
+        keys, inverse = np.unique(keys, return_inverse=True)
+        self._merge(keys, np.bincount(inverse, weights=weights))
+        return int(valid.sum())
+
+    def add_stages(self, stages):
+        """
+        Adds the stages of a stage table with an entry and exit stop,
+        binned by entry time
+        """
+        return self.add(
+            stages["entry_stop_id"].to_numpy(),
+            stages["exit_stop_id"].to_numpy(),
+            stages["entry_ts"].to_numpy(),
+        )
+
+    def add_journeys(self, journeys):
+        """
+        Adds the journeys of a journey table (see `journeys.get_journeys`)
+        with an origin and destination, binned by start time
+        """
+        return self.add(
+            journeys["origin_stop_id"].to_numpy(),
+            journeys["destination_stop_id"].to_numpy(),
+            journeys["start_ts"].to_numpy(),
+        )
+
+    def update(self, other):
+        """Adds the counts of another `ODMatrix` with the same cells"""
+        if not (
+            self.bin_size == other.bin_size
+            and np.array_equal(self.ids, other.ids)
+        ):
+            raise ValueError("OD matrices have different bins or ids")
+        self._merge(other.keys, other.counts)
+
+    def to_coo(self):
+        """(bins, origins, destinations, counts) of the non-empty cells"""
+        rows, destinations = np.divmod(self.keys, self.n)
+        bins, origins = np.divmod(rows, self.n)
+        return bins, origins, destinations, self.counts
+
+    def to_csr(self, time_bin=None):
+        """
+        CSR form of the counts of `time_bin`, or of every bin summed
+
+        Returns
+        -------
+        tuple
+            (indptr, destinations, counts) of the (origins x destinations)
+            matrix
+        """
+        if time_bin is None:
+            _, origins, destinations, counts = self.to_coo()
+            keys = origins * self.n + destinations
+            keys, inverse = np.unique(keys, return_inverse=True)
+            counts = np.bincount(inverse, weights=counts)
+        else:
+            start, end = np.searchsorted(
+                self.keys,
+                [
+                    time_bin * self.n * self.n,
+                    (time_bin + 1) * self.n * self.n,
+                ],
+            )
+            keys = self.keys[start:end] - time_bin * self.n * self.n
+            counts = self.counts[start:end]
+
+        origins, destinations = np.divmod(keys, self.n)
+        indptr = np.zeros(self.n + 1, dtype=np.int64)
+        indptr[1:] = np.cumsum(np.bincount(origins, minlength=self.n))
+        return indptr, destinations, counts
+
+    def to_dense(self, time_bin=None):
+        """(origins x destinations) array of `time_bin`, see `to_csr`"""
+        indptr, destinations, counts = self.to_csr(time_bin)
+        dense = np.zeros((self.n, self.n))
+        origins = np.repeat(np.arange(self.n), np.diff(indptr))
+        dense[origins, destinations] = counts
+        return dense
+
+    def to_frame(self):
+        """Dataframe of the non-empty cells, with ids and bin start times"""
+        bins, origins, destinations, counts = self.to_coo()
+        return pd.DataFrame(
+            {
+                "time_bin": bins,
+                "start_time": pd.to_timedelta(bins * self.bin_size, unit="s"),
+                "origin": self.ids[origins],
+                "destination": self.ids[destinations],
+                "count": counts,
+            }
+        )
+
+    def save(self, path):
+        """Saves the matrix as an uncompressed npz file, atomically"""
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(path.name + ".tmp")
+        with open(tmp_path, "wb") as f:
+            np.savez(
+                f,
+                bin_size=self.bin_size,
+                stop_ids=self.stop_ids,
+                ids=self.ids,
+                stop_cells=self._stop_cells,
+                keys=self.keys,
+                counts=self.counts,
+            )
+        os.replace(tmp_path, path)
+        logger.info(f"Saved {self} to {path}")
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path, allow_pickle=False) as arrays:
+            od_matrix = cls.__new__(cls)
+            od_matrix.bin_size = int(arrays["bin_size"])
+            od_matrix.n_bins = SECONDS_PER_DAY // od_matrix.bin_size
+            od_matrix.stop_ids = arrays["stop_ids"]
+            od_matrix.ids = arrays["ids"]
+            od_matrix._stop_cells = arrays["stop_cells"]
+            od_matrix._stop_index = pd.Index(od_matrix.stop_ids)
+            od_matrix.keys = arrays["keys"]
+            od_matrix.counts = arrays["counts"]
+        return od_matrix
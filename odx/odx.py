@@ -4,68 +4,155 @@ from collections import defaultdict
 from rich import print
 from .bus_schedule import BusSchedule, BusRouteTuple
 from .metro_schedule import MetroSchedule
+from . import config
 from .config import ODXConfig
+from .common import ODX_ENUMS
 from .geo import StopsDistance
+from .stages import build_stage_table
+from .inference import infer_destinations_table
+from .trips import TripIndex, match_trips
+from .journeys import link_journeys, get_journeys
+from .od_matrix import ODMatrix
+from .report import ODXReport, SkipReason, timed_phase
 from .utils import ddict2dict
 
 
-class ODX_ENUMS:
-    METRO = "metro"
-    BUS = "bus"
-    METRO_OUT = "OUT"
-    METRO_IN = "IN"
+def count_stages(stages):
+    """Number of stages in the nested dicts returned by `ODX.get_stages`"""
+    return sum(
+        len(day_stages)
+        for cid in stages
+        for day_stages in stages[cid].values()
+    )
 
 
 class BusStage:
+    """
+    Bus stage, built from a single afc record (boarding).
+
+    Stops and route are kept as indices in `schedule.stops` and
+    `schedule.routes` (-1 if unknown), and resolved on access.
+    """
+
+    __slots__ = (
+        "schedule",
+        "entry_ts",
+        "exit_ts",
+        "entry_stop_idx",
+        "exit_stop_idx",
+        "route_idx",
+        "route_key",
+    )
     mode = "bus"
 
     def __init__(
         self,
-        boarding,
+        schedule,
+        entry_ts,
+        entry_stop_idx,
+        route_idx,
+        route_key=None,
     ):
-        self.boarding = boarding
-        self.entry_ts = boarding.timestamp
-        self.entry_stop = BusSchedule().get_stop(boarding.stop_id)
-        self.route = self.route_from_transaction(boarding)
+        self.schedule = schedule
+        self.entry_ts = entry_ts
+        self.entry_stop_idx = entry_stop_idx
+        self.route_idx = route_idx
+        # afc route key, only kept when the route is not in the schedule
+        self.route_key = route_key
         self.exit_ts = None
-        self.exit_stop = None
-
-    @staticmethod
-    def route_from_transaction(transaction):
-        route_tup = BusRouteTuple(
-            transaction.route_id,
-            transaction.route_direction,
-            transaction.route_variant,
+        self.exit_stop_idx = -1
+
+    @classmethod
+    def from_record(cls, boarding, schedule):
+        route_key = BusRouteTuple(
+            boarding.route_id,
+            boarding.route_direction,
+            boarding.route_variant,
+        )
+        route_idx = schedule.get_route_idx(route_key)
+        return cls(
+            schedule,
+            boarding.timestamp,
+            schedule.get_stop_idx(boarding.stop_id),
+            route_idx,
+            route_key if route_idx < 0 else None,
         )
-        return BusSchedule().get_route(route_tup)
+
+    @property
+    def entry_stop(self):
+        if self.entry_stop_idx < 0:
+            return None
+        return self.schedule.stops[self.entry_stop_idx]
+
+    @property
+    def exit_stop(self):
+        if self.exit_stop_idx < 0:
+            return None
+        return self.schedule.stops[self.exit_stop_idx]
+
+    @property
+    def route(self):
+        if self.route_idx < 0:
+            return None
+        return self.schedule.routes[self.route_idx]
 
     def __repr__(self):
         return f"[BUS] [{self.entry_ts}] ({self.entry_stop}) -> [{self.exit_ts }] ({self.exit_stop}) [{self.route}]"
 
 
 class MetroStage:
+    """
+    Metro stage, built from an entry and an exit afc record,
+    either of which may be missing.
+
+    Stops are kept as indices in `schedule.stops` (-1 if unknown or
+    missing), and resolved on access.
+    """
+
+    __slots__ = (
+        "schedule",
+        "entry_ts",
+        "exit_ts",
+        "entry_stop_idx",
+        "exit_stop_idx",
+    )
     mode = "metro"
 
     def __init__(
         self,
-        boarding,
-        alighting,
+        schedule,
+        entry_ts,
+        entry_stop_idx,
+        exit_ts,
+        exit_stop_idx,
     ):
-        self.boarding = boarding
-        self.alighting = alighting
-        if boarding:
-            self.entry_ts = boarding.timestamp
-            self.entry_stop = MetroSchedule().get_stop(boarding.stop_id)
-        else:
-            self.entry_ts = None
-            self.entry_stop = None
+        self.schedule = schedule
+        self.entry_ts = entry_ts
+        self.entry_stop_idx = entry_stop_idx
+        self.exit_ts = exit_ts
+        self.exit_stop_idx = exit_stop_idx
+
+    @classmethod
+    def from_records(cls, boarding, alighting, schedule):
+        return cls(
+            schedule,
+            boarding.timestamp if boarding else None,
+            schedule.get_stop_idx(boarding.stop_id) if boarding else -1,
+            alighting.timestamp if alighting else None,
+            schedule.get_stop_idx(alighting.stop_id) if alighting else -1,
+        )
 
-        if alighting:
-            self.exit_ts = alighting.timestamp
-            self.exit_stop = MetroSchedule().get_stop(alighting.stop_id)
-        else:
-            self.exit_ts = None
-            self.exit_stop = None
+    @property
+    def entry_stop(self):
+        if self.entry_stop_idx < 0:
+            return None
+        return self.schedule.stops[self.entry_stop_idx]
+
+    @property
+    def exit_stop(self):
+        if self.exit_stop_idx < 0:
+            return None
+        return self.schedule.stops[self.exit_stop_idx]
 
     def __repr__(self):
         return f"[METRO] [{self.entry_ts}] ({self.entry_stop}) -> [{self.exit_ts }] ({self.exit_stop})"
@@ -74,12 +161,32 @@ class MetroStage:
 class ODX:
     """
     Computes odx using bus and metro afc data.
+
+    Parameters
+    ----------
+    stop_dists: np.array
+        distance matrix of the bus and metro stops, e.g. memory-mapped
+        (see `odx.parallel`). Computed if None
     """
 
-    def __init__(self):
-        self.stops_distance = StopsDistance(self.stops)
-        self.bus_schedule = BusSchedule()
-        self.metro_schedule = MetroSchedule()
+    def __init__(self, stop_dists=None):
+        self.report = ODXReport()
+        with self.report.phase("load_schedules"):
+            self.bus_schedule = BusSchedule()
+            self.metro_schedule = MetroSchedule()
+        with self.report.phase("stops_distance"):
+            stops = self.bus_schedule.stops + self.metro_schedule.stops
+            self.stops_distance = StopsDistance.from_arrays(
+                [s.stop_id for s in stops],
+                [s.stop_lat for s in stops],
+                [s.stop_lon for s in stops],
+                dense=config.DENSE_STOPS_DISTANCE,
+                dists=stop_dists,
+            )
+            self.bus_schedule.set_alighting_targets(self.metro_schedule.stops)
+        # built on first use, see `match_trips_table`
+        self.trip_index = None
+        self._trip_index_path = None
 
     @staticmethod
     def get_record_day(row):
@@ -92,6 +199,7 @@ class ODX:
         else:
             return date
 
+    @timed_phase("get_stages", len)
     def get_stages(self, afc):
         """
         Builds stages
@@ -122,66 +230,153 @@ class ODX:
                                 and next_transaction.mode == ODX_ENUMS.METRO
                                 and next_transaction.way == ODX_ENUMS.METRO_OUT
                             ):
-                                stage = MetroStage(
-                                    transaction, next_transaction
+                                stage = MetroStage.from_records(
+                                    transaction,
+                                    next_transaction,
+                                    self.metro_schedule,
                                 )
                                 # since we already processed
                                 # the next transaction, skip it
                                 next(iter_)
                             else:
-                                stage = MetroStage(transaction, None)
+                                stage = MetroStage.from_records(
+                                    transaction, None, self.metro_schedule
+                                )
 
                         if transaction.way == ODX_ENUMS.METRO_OUT:
-                            stage = MetroStage(None, transaction)
+                            stage = MetroStage.from_records(
+                                None, transaction, self.metro_schedule
+                            )
                     elif transaction.mode == ODX_ENUMS.BUS:
-                        stage = BusStage(transaction)
+                        stage = BusStage.from_record(
+                            transaction, self.bus_schedule
+                        )
 
                     if (stage.mode == "metro") and (
-                        stage.entry_stop == stage.exit_stop
+                        stage.entry_stop_idx == stage.exit_stop_idx
                     ):
                         continue
 
                     stages[cid][date].append(stage)
 
+        self.report.count("afc_records", len(afc))
+        self.report.count("stages", count_stages(stages))
         return stages
 
-    def add_report(self, message, stage):
-        pass
+    @timed_phase("get_stage_table", len)
+    def get_stage_table(self, afc):
+        """
+        Vectorized alternative to `get_stages`.
+        Builds the same stages, as a DataFrame with one row per stage
+        (see `stages.build_stage_table`).
+        """
+        print(
+            f"Building stage table from {len(afc)} transactions, between {afc.timestamp.min()} and {afc.timestamp.max()}.."
+        )
+        stages = build_stage_table(afc, self.bus_schedule, self.metro_schedule)
+        self.report.count("afc_records", len(afc))
+        self.report.count("stages", len(stages))
+        return stages
 
-    def get_closest_stop(self, stage, next_stage):
-        route_stops = self.bus_schedule.get_route_stops(stage.route)
+    @timed_phase("infer_destinations_table", len)
+    def infer_destinations_table(self, stages):
+        """
+        Batched alternative to `infer_destinations`, over a stage table
+        built by `get_stage_table` (see `inference.infer_destinations_table`).
+        """
+        print(f"Inferring destinations of {len(stages)} stages..")
+        return infer_destinations_table(
+            stages, self.bus_schedule, report=self.report
+        )
 
-        try:
-            stop_number = route_stops.index(stage.stop.stop_id)
+    @timed_phase("link_journeys_table", len)
+    def link_journeys_table(self, stages):
+        """
+        Links the stages of a stage table with inferred destinations into
+        journeys (see `journeys`).
 
-        except ValueError:
-            raise RuntimeError(
-                f"Stop {stage.stop.stop_id} not in route {stage.route}"
+        Returns
+        -------
+        tuple
+            (stages with a `journey_id` column, journey table)
+        """
+        print(f"Linking {len(stages)} stages into journeys..")
+        stages = link_journeys(stages, self.stops_distance)
+        journeys = get_journeys(stages)
+        self.report.count("journeys", len(journeys))
+        self.report.count("transfers", int(journeys["n_transfers"].sum()))
+        return stages, journeys
+
+    @timed_phase("od_matrix_table", len)
+    def od_matrix_table(self, journeys, od_matrix=None):
+        """
+        Adds the journeys of a journey table to an OD matrix of the bus
+        and metro stops (see `od_matrix.ODMatrix`), a new one by default,
+        e.g. to accumulate the journeys of several days
+
+        Returns
+        -------
+        ODMatrix
+        """
+        if od_matrix is None:
+            od_matrix = ODMatrix.from_schedules(
+                self.bus_schedule, self.metro_schedule
             )
+        n = od_matrix.add_journeys(journeys)
+        self.report.count("od_matrix_journeys", n)
+        return od_matrix
 
+    @timed_phase("match_trips_table", len)
+    def match_trips_table(self, stages, gtfs_path=None):
+        """
+        Matches the bus stages of a stage table to their scheduled trips,
+        from the Carris GTFS in `gtfs_path` (by default the schedule's,
+        `config.BUS_SCHEDULE_GTFS_PATH`), see `trips.match_trips`
+        """
+        gtfs_path = gtfs_path or config.BUS_SCHEDULE_GTFS_PATH
+        if gtfs_path is None:
+            raise RuntimeError("Matching trips requires a bus GTFS")
+        if self.trip_index is None or self._trip_index_path != gtfs_path:
+            self.trip_index = TripIndex.from_gtfs(self.bus_schedule, gtfs_path)
+            self._trip_index_path = gtfs_path
+
+        print(f"Matching {len(stages)} stages to bus trips..")
+        stages = match_trips(stages, self.trip_index)
+        self.report.count(
+            "matched_trips", int(stages["trip_id"].notna().sum())
+        )
+        return stages
+
+    def add_report(self, message, stage):
+        """
+        Reports that the destination of `stage` was not inferred,
+        `message` being the `SkipReason`
+        """
+        self.report.skip(message)
+
+    def get_closest_stop(self, stage, next_stage):
         # get stop_ids in the trip, after previous transaction's stop.
         # if the route is circular, every stop is subsequent to the current one
-        if stage.route.route_direction == "CIRC":
-            subsequent_stop_ids = (
-                route_stops[stop_number + 1 :] + route_stops[:stop_number]
-            )
-
-        else:
-            subsequent_stop_ids = route_stops[stop_number + 1 :]
+        subsequent_stop_ids = stage.route.get_subsequent_stop_ids(
+            stage.entry_stop.stop_id
+        )
 
         if not subsequent_stop_ids:
             raise RuntimeError(
-                f"Boarding stop ({stage.stop.stop_id}) is route's last stop"
+                f"Boarding stop ({stage.entry_stop.stop_id}) is route's last stop"
             )
 
         # direct (same stop) transfer
-        if next_stage.entry_stop.stop_id in subsequent_stop_ids:
+        if (
+            next_stage.mode == ODX_ENUMS.BUS
+            and next_stage.entry_stop.stop_id in subsequent_stop_ids
+        ):
             closest_sid = next_stage.entry_stop.stop_id
 
         else:
             distances = {}
             for sid in subsequent_stop_ids:
-                distances[sid] = self.bus_schedule.get_stops_distance(
+                distances[sid] = self.get_stops_distance(
                     sid, next_stage.entry_stop.stop_id
                 )
 
@@ -190,7 +385,7 @@ class ODX:
         return self.bus_schedule.get_stop(closest_sid)
 
     def get_stops_distance(self, sid1, sid2):
-        return self.stop_distances.get_distance(sid1, sid2)
+        return self.stops_distance.get_distance(sid1, sid2)
 
     @staticmethod
     def is_boarding_last_stop(stage):
@@ -204,10 +399,51 @@ class ODX:
         stage_time_sec = stage.route.get_stage_time(
             stage.entry_stop.stop_id,
             stage.exit_stop.stop_id,
+            stage.entry_ts,
         )
 
         return datetime.timedelta(seconds=stage_time_sec)
 
+    def infer_stage_destination(self, stage, next_stage):
+        """
+        Infers the alighting stop and time of bus `stage`, given the
+        stage that follows it. Leaves the stage unchanged if it can't.
+        """
+        if stage.mode != ODX_ENUMS.BUS:
+            return
+
+        if not stage.entry_stop:
+            return self.add_report(SkipReason.NO_ENTRY_STOP, stage)
+        if not stage.route:
+            return self.add_report(SkipReason.UNKNOWN_ROUTE, stage)
+        # check if boarding is on route's last stop
+        if self.is_boarding_last_stop(stage):
+            return self.add_report(SkipReason.LAST_STOP, stage)
+
+        if not next_stage.entry_stop:
+            return self.add_report(SkipReason.NO_NEXT_ENTRY_STOP, stage)
+
+        if not stage.route.has_stop(stage.entry_stop.stop_id):
+            return self.add_report(SkipReason.ENTRY_NOT_IN_ROUTE, stage)
+
+        closest_stop = self.get_closest_stop(stage, next_stage)
+
+        if (
+            self.get_stops_distance(
+                closest_stop.stop_id,
+                next_stage.entry_stop.stop_id,
+            )
+            > ODXConfig.MAX_BUS_ALIGTHING_BOARDING_DISTANCE
+        ):
+            return self.add_report(SkipReason.DISTANCE, stage)
+
+        stage.exit_stop_idx = self.bus_schedule.get_stop_idx(
+            closest_stop.stop_id
+        )
+        stage.exit_ts = stage.entry_ts + self.get_stage_time(stage)
+        self.report.count("inferred")
+
+    @timed_phase("infer_destinations", count_stages)
     def infer_destinations(self, stages):
         for cid in tqdm(stages):
             for date in stages[cid]:
@@ -215,40 +451,16 @@ class ODX:
 
                 # check if only one stage in day
                 if len(day_stages) == 1:
+                    if day_stages[0].mode == ODX_ENUMS.BUS:
+                        self.add_report(SkipReason.SINGLE_STAGE, day_stages[0])
                     continue
 
                 for idx, stage in enumerate(day_stages):
-                    if stage.mode != ODX_ENUMS.BUS:
-                        continue
-
-                    if not (stage.entry_stop and stage.route):
-                        continue
-                    # check if boarding is on route's last stop
-                    if self.is_boarding_last_stop(stage):
-                        continue
-
                     try:
                         next_stage = day_stages[idx + 1]
                     except IndexError:
                         next_stage = day_stages[0]
 
-                    if not next_stage.entry_stop:
-                        continue
-
-                    closest_stop = self.get_closest_stop(stage, next_stage)
-
-                    if (
-                        self.get_stops_distance(
-                            closest_stop.stop_id,
-                            next_stage.entry_stop.stop_id,
-                        )
-                        > ODXConfig.MAX_BUS_ALIGTHING_BOARDING_DISTANCE
-                    ):
-                        continue
-
-                    stage.exit_stop = closest_stop
-                    stage.exit_ts = stage.entry_ts + self.get_stage_time(
-                        stage
-                    )
+                    self.infer_stage_destination(stage, next_stage)
 
         return stages
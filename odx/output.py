@@ -0,0 +1,267 @@
+"""
+Arrow/Parquet output of inferred stages.
+
+Stages are written as typed Arrow tables (see `STAGES_SCHEMA`), to a single
+Parquet file or to a Parquet dataset partitioned by service day, one chunk
+at a time, so the whole output never has to be in memory.
+"""
+import shutil
+import datetime
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+from pathlib import Path
+
+from .common import ODX_ENUMS
+from .stages import NO_STOP, STAGE_TABLE_COLUMNS
+
+
+class StageStatus:
+    # bus
+    INFERRED = "inferred"
+    NOT_INFERRED = "not_inferred"
+    # metro
+    COMPLETE = "complete"
+    NO_ENTRY = "no_entry"
+    NO_EXIT = "no_exit"
+
+
+STAGES_SCHEMA = pa.schema(
+    [
+        ("card_id", pa.int64()),
+        ("day", pa.date32()),
+        ("mode", pa.dictionary(pa.int8(), pa.string())),
+        ("route_id", pa.dictionary(pa.int32(), pa.string())),
+        ("route_direction", pa.dictionary(pa.int8(), pa.string())),
+        ("route_variant", pa.int32()),
+        ("entry_stop_id", pa.int64()),
+        ("exit_stop_id", pa.int64()),
+        ("entry_ts", pa.timestamp("ns")),
+        ("exit_ts", pa.timestamp("ns")),
+        ("status", pa.dictionary(pa.int8(), pa.string())),
+    ]
+)
+
+
+def get_stage_status(modes, entry_stop_ids, exit_stop_ids):
+    """Vectorized `StageStatus` of each stage"""
+    is_bus = modes == ODX_ENUMS.BUS
+    has_entry = entry_stop_ids != NO_STOP
+    has_exit = exit_stop_ids != NO_STOP
+
+    return np.select(
+        [
+            is_bus & has_exit,
+            is_bus,
+            ~has_entry,
+            ~has_exit,
+        ],
+        [
+            StageStatus.INFERRED,
+            StageStatus.NOT_INFERRED,
+            StageStatus.NO_ENTRY,
+            StageStatus.NO_EXIT,
+        ],
+        StageStatus.COMPLETE,
+    )
+
+
+def _dictionary_array(values, index_type):
+    return pa.array(values, type=pa.string(), from_pandas=True).cast(
+        pa.dictionary(index_type, pa.string())
+    )
+
+
+def stage_table_to_arrow(stages):
+    """
+    Converts a stage table (see `stages.build_stage_table`) to an
+    Arrow table with `STAGES_SCHEMA`. Missing stops become nulls.
+    """
+    modes = stages["mode"].to_numpy()
+    entry_stop_ids = stages["entry_stop_id"].to_numpy()
+    exit_stop_ids = stages["exit_stop_id"].to_numpy()
+    days = pd.to_datetime(stages["day"]).to_numpy().astype("datetime64[D]")
+
+    columns = [
+        pa.Array.from_pandas(stages["card_id"], type=pa.int64()),
+        pa.array(days, type=pa.date32()),
+        _dictionary_array(modes, pa.int8()),
+        _dictionary_array(stages["route_id"], pa.int32()),
+        _dictionary_array(stages["route_direction"], pa.int8()),
+        pa.Array.from_pandas(stages["route_variant"], type=pa.int32()),
+        pa.array(entry_stop_ids, mask=entry_stop_ids == NO_STOP),
+        pa.array(exit_stop_ids, mask=exit_stop_ids == NO_STOP),
+        pa.Array.from_pandas(stages["entry_ts"], type=pa.timestamp("ns")),
+        pa.Array.from_pandas(stages["exit_ts"], type=pa.timestamp("ns")),
+        _dictionary_array(
+            get_stage_status(modes, entry_stop_ids, exit_stop_ids),
+            pa.int8(),
+        ),
+    ]
+    return pa.Table.from_arrays(columns, schema=STAGES_SCHEMA)
+
+
+def iter_stages(stages):
+    """
+    Yields (card_id, day, stage) from the nested dicts returned by
+    `ODX.get_stages` and `ODX.infer_destinations`.
+    """
+    for cid in stages:
+        for day in stages[cid]:
+            for stage in stages[cid][day]:
+                yield cid, day, stage
+
+
+def stages_to_table(records):
+    """
+    Builds a stage table (see `stages.build_stage_table`) from
+    (card_id, day, stage) tuples of `BusStage`/`MetroStage` objects.
+    """
+    rows = []
+    for cid, day, stage in records:
+        route = None
+        if stage.mode == ODX_ENUMS.BUS:
+            # unknown routes keep the afc route key
+            route = stage.route or stage.route_key
+        rows.append(
+            (
+                cid,
+                day,
+                stage.mode,
+                stage.entry_stop.stop_id if stage.entry_stop else NO_STOP,
+                stage.exit_stop.stop_id if stage.exit_stop else NO_STOP,
+                stage.entry_ts,
+                stage.exit_ts,
+                route.route_id if route else None,
+                route.route_direction if route else None,
+                route.route_variant if route else None,
+            )
+        )
+
+    table = pd.DataFrame(rows, columns=STAGE_TABLE_COLUMNS[:-1])
+    table["card_id"] = table["card_id"].astype("Int64")
+    table["day"] = pd.to_datetime(table["day"])
+    table["entry_stop_id"] = table["entry_stop_id"].astype(np.int64)
+    table["exit_stop_id"] = table["exit_stop_id"].astype(np.int64)
+    table["entry_ts"] = pd.to_datetime(table["entry_ts"])
+    table["exit_ts"] = pd.to_datetime(table["exit_ts"])
+    table["route_variant"] = table["route_variant"].astype("Int64")
+    return table
+
+
+class StagesWriter:
+    """
+    Writes stages to Parquet, one chunk at a time.
+
+    Parameters
+    ----------
+    path: str
+        output file, or dataset directory if `partition_by_day`
+    partition_by_day: bool
+        whether to write a dataset partitioned by service day
+        (`day=YYYY-MM-DD` directories), instead of a single file.
+        The existing partition of a day is replaced by the first write
+        of that day, so re-runs do not leave stale parts, and the other
+        days of the dataset are kept
+    card_mapping: CardMapping
+        mapping of the card codes of the processed afc
+        (see `afc_schema.CardMapping`). If given, the card codes of
+        the stages are written as the original card ids
+    """
+
+    def __init__(self, path, partition_by_day=False, card_mapping=None):
+        self.path = Path(path)
+        self.partition_by_day = partition_by_day
+        self.card_mapping = card_mapping
+        self._writer = None
+        self._n_chunks = 0
+        # days whose partition was written by this writer
+        self._days = set()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def write(self, stages):
+        """Writes a stage table (dataframe) or Arrow table"""
+        if isinstance(stages, pd.DataFrame):
+            stages = stage_table_to_arrow(stages)
+        if not len(stages):
+            return
+        if self.card_mapping is not None:
+            stages = stages.set_column(
+                stages.schema.get_field_index("card_id"),
+                STAGES_SCHEMA.field("card_id"),
+                self.card_mapping.decode(stages["card_id"]),
+            )
+
+        if self.partition_by_day:
+            for day in pc.unique(stages["day"]).to_pylist():
+                if day not in self._days:
+                    shutil.rmtree(self.path / f"day={day}", ignore_errors=True)
+                    self._days.add(day)
+            ds.write_dataset(
+                stages,
+                self.path,
+                format="parquet",
+                partitioning=ds.partitioning(
+                    pa.schema([("day", pa.date32())]), flavor="hive"
+                ),
+                basename_template=f"part-{self._n_chunks}-{{i}}.parquet",
+                existing_data_behavior="overwrite_or_ignore",
+            )
+        else:
+            if self._writer is None:
+                self.path.parent.mkdir(parents=True, exist_ok=True)
+                self._writer = pq.ParquetWriter(self.path, STAGES_SCHEMA)
+            self._writer.write_table(stages)
+        self._n_chunks += 1
+
+    def write_records(self, records, chunk_size=100_000):
+        """
+        Writes (card_id, day, stage) tuples of stage objects,
+        converting `chunk_size` stages at a time.
+        """
+        chunk = []
+        for record in records:
+            chunk.append(record)
+            if len(chunk) >= chunk_size:
+                self.write(stages_to_table(chunk))
+                chunk = []
+        if chunk:
+            self.write(stages_to_table(chunk))
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+
+def read_stages(path, days=None):
+    """
+    Reads stages written by `StagesWriter`, as an Arrow table.
+    `days` (list of datetime.date) restricts the read to those service days.
+    """
+    path = Path(path)
+    if path.is_dir():
+        dataset = ds.dataset(
+            path,
+            format="parquet",
+            partitioning=ds.partitioning(
+                pa.schema([("day", pa.date32())]), flavor="hive"
+            ),
+        )
+    else:
+        dataset = ds.dataset(path, format="parquet")
+
+    filter_ = None
+    if days is not None:
+        filter_ = ds.field("day").isin(
+            [d.date() if isinstance(d, datetime.datetime) else d for d in days]
+        )
+    return dataset.to_table(filter=filter_)
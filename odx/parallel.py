@@ -0,0 +1,163 @@
+"""
+Multi-process ODX, sharded by card_id.
+
+Stages of different cards are independent, so the AFC is hash-partitioned
+by card_id and each shard is processed by a worker of a process pool.
+Workers share the schedules built by the parent process when processes
+are forked, and otherwise load them from the compiled schedule bundles
+(memory-mapped, see `odx.bundle`), instead of rebuilding them from source.
+The distances between stops and the alighting tables are built once by
+the parent, and memory-mapped by spawned workers from a temporary bundle.
+"""
+import tempfile
+import multiprocessing
+from pathlib import Path
+import numpy as np
+import pandas as pd
+from rich import print
+
+from . import config
+from .odx import ODX
+from .bundle import load_bundle, save_bundle
+from .bus_schedule import BusSchedule
+from .metro_schedule import MetroSchedule
+
+SHARED_BUNDLE_KIND = "odx_shared"
+
+# ODX instance used by the workers of this process
+_worker_odx = None
+
+
+def partition_by_card(afc, n_shards):
+    """
+    Splits `afc` in `n_shards` dataframes, such that every record
+    of a card is in the same shard. Assignment is deterministic.
+    """
+    hashes = pd.util.hash_pandas_object(afc["card_id"], index=False)
+    shard_ids = hashes.to_numpy() % n_shards
+    return [afc.loc[shard_ids == shard] for shard in range(n_shards)]
+
+
+def _get_stop_ids(odx):
+    return np.array(
+        [s.stop_id for s in odx.bus_schedule.stops + odx.metro_schedule.stops],
+        dtype=np.int64,
+    )
+
+
+def _save_shared(odx, path):
+    """
+    Saves the arrays of `odx` built once for every worker: the distances
+    between stops and the alighting tables (see `_init_worker`)
+    """
+    arrays = {
+        "stop_ids": _get_stop_ids(odx),
+        "n_routes": np.array(len(odx.bus_schedule.routes)),
+        **odx.bus_schedule.get_alighting_arrays(),
+    }
+    if odx.stops_distance.dense:
+        arrays["stop_dists"] = odx.stops_distance._dists
+    save_bundle(path, SHARED_BUNDLE_KIND, arrays, [])
+
+
+def _init_worker(bus_bundle_path, metro_bundle_path, shared_path):
+    global _worker_odx
+    BusSchedule(bundle_path=bus_bundle_path)
+    MetroSchedule(bundle_path=metro_bundle_path)
+
+    # memory-mapped, so workers share the pages of the parent's arrays
+    arrays = load_bundle(shared_path, SHARED_BUNDLE_KIND, [])
+    _worker_odx = ODX(stop_dists=arrays.get("stop_dists"))
+    if not (
+        np.array_equal(_get_stop_ids(_worker_odx), arrays["stop_ids"])
+        and len(_worker_odx.bus_schedule.routes) == arrays["n_routes"]
+    ):
+        raise RuntimeError(
+            "The schedule bundles differ from the schedules of the parent "
+            "process, compile them again"
+        )
+    _worker_odx.bus_schedule.load_alighting_arrays(arrays)
+
+
+def _run_shard(afc):
+    _worker_odx.report.reset()
+    stages = _worker_odx.get_stage_table(afc)
+    stages = _worker_odx.infer_destinations_table(stages)
+    return stages, _worker_odx.report.to_dict()
+
+
+def run_odx_parallel(
+    afc,
+    n_workers=None,
+    n_shards=None,
+    bus_bundle_path=config.BUS_SCHEDULE_BUNDLE_PATH,
+    metro_bundle_path=config.METRO_SCHEDULE_BUNDLE_PATH,
+    report=None,
+):
+    """
+    Builds the stage table and infers destinations, as
+    `ODX.get_stage_table` followed by `ODX.infer_destinations_table`,
+    with `n_workers` processes.
+
+    Parameters
+    ----------
+    afc: pd.DataFrame
+        combined afc
+    n_workers: int
+        number of processes, defaults to the number of cpus
+    n_shards: int
+        number of card_id partitions, defaults to 4 per worker,
+        so that workers finishing early pick up more work
+    bus_bundle_path, metro_bundle_path:
+        schedule bundles, loaded by workers that are not forked. They must
+        be up to date with the schedules of this process
+    report: ODXReport
+        if given, the reports of every shard are merged into it
+        (phase times are summed over workers)
+
+    Returns
+    -------
+    pd.DataFrame
+        the same stage table a single process would build
+    """
+    global _worker_odx
+
+    n_workers = n_workers or multiprocessing.cpu_count()
+    n_shards = n_shards or 4 * n_workers
+
+    odx = ODX()
+    odx.bus_schedule.build_alighting_tables()
+
+    shards = partition_by_card(afc, n_shards)
+    print(
+        f"Running ODX on {len(afc)} transactions, in {n_shards} shards and {n_workers} processes.."
+    )
+
+    with tempfile.TemporaryDirectory() as shared_dir:
+        if "fork" in multiprocessing.get_all_start_methods():
+            # workers inherit the schedules (and this ODX) from the parent
+            context = multiprocessing.get_context("fork")
+            _worker_odx = odx
+            initializer, initargs = None, ()
+        else:
+            context = multiprocessing.get_context("spawn")
+            shared_path = Path(shared_dir) / "shared"
+            _save_shared(odx, shared_path)
+            initializer = _init_worker
+            initargs = (bus_bundle_path, metro_bundle_path, shared_path)
+
+        with context.Pool(
+            n_workers, initializer=initializer, initargs=initargs
+        ) as pool:
+            # imap keeps shard order, so results don't depend on timing
+            results = list(pool.imap(_run_shard, shards))
+
+    if report is not None:
+        for _, shard_report in results:
+            report.merge(shard_report)
+
+    stages = pd.concat([shard for shard, _ in results], ignore_index=True)
+    order = np.lexsort(
+        (np.arange(len(stages)), pd.factorize(stages["card_id"], sort=True)[0])
+    )
+    return stages.iloc[order].reset_index(drop=True)
@@ -0,0 +1,298 @@
+"""
+Instrumentation of ODX runs.
+
+`ODXReport` collects per-phase wall time and peak memory, throughput
+counters, and the number of bus stages whose destination was not inferred,
+by reason (see `SkipReason`). Counting is a dict increment, cheap enough
+for the per-stage loops; batched code counts whole arrays at once.
+"""
+import sys
+import json
+import time
+import inspect
+import resource
+import functools
+from collections import Counter
+from contextlib import contextmanager
+import numpy as np
+from rich import print
+from rich.table import Table
+
+
+class SkipReason:
+    """Why the destination of a bus stage was not inferred"""
+
+    # the stage is the only one of the card's day
+    SINGLE_STAGE = "single_stage"
+    NO_ENTRY_STOP = "no_entry_stop"
+    UNKNOWN_ROUTE = "unknown_route"
+    ENTRY_NOT_IN_ROUTE = "entry_not_in_route"
+    # boarding on the route's last stop
+    LAST_STOP = "last_stop"
+    NO_NEXT_ENTRY_STOP = "no_next_entry_stop"
+    # closest subsequent stop too far from the next entry stop
+    DISTANCE = "distance"
+    NO_STAGE_TIME = "no_stage_time"
+
+
+# integer codes of the reasons, for batched inference. 0 is inferred
+SKIP_REASON_CODES = [
+    None,
+    SkipReason.SINGLE_STAGE,
+    SkipReason.NO_ENTRY_STOP,
+    SkipReason.UNKNOWN_ROUTE,
+    SkipReason.ENTRY_NOT_IN_ROUTE,
+    SkipReason.LAST_STOP,
+    SkipReason.NO_NEXT_ENTRY_STOP,
+    SkipReason.DISTANCE,
+    SkipReason.NO_STAGE_TIME,
+]
+
+
+def get_skip_code(reason):
+    return SKIP_REASON_CODES.index(reason)
+
+
+# peak memory of the process before the last `reset_peak_rss`, which also
+# resets ru_maxrss on linux
+_max_rss_before_reset_mb = 0.0
+
+
+def get_max_rss_mb():
+    """Peak resident memory of this process so far, in MB"""
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macos, kilobytes elsewhere
+    max_rss_mb = (
+        max_rss / 2**20 if sys.platform == "darwin" else max_rss / 2**10
+    )
+    return max(max_rss_mb, _max_rss_before_reset_mb)
+
+
+def get_rss_mb():
+    """Resident memory of this process, in MB (None if unavailable)"""
+    try:
+        with open("/proc/self/statm") as f:
+            resident_pages = int(f.read().split()[1])
+    except OSError:
+        return None
+    return resident_pages * resource.getpagesize() / 2**20
+
+
+def get_peak_rss_mb():
+    """
+    Peak resident memory of this process since the last
+    `reset_peak_rss` (linux), or since it started, in MB
+    """
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 2**10
+    except OSError:
+        pass
+    return get_max_rss_mb()
+
+
+def reset_peak_rss():
+    """
+    Resets the peak of `get_peak_rss_mb` to the current memory (linux),
+    keeping the peak of the process for `get_max_rss_mb`
+    """
+    global _max_rss_before_reset_mb
+    _max_rss_before_reset_mb = max(get_max_rss_mb(), get_peak_rss_mb())
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+def timed_phase(name, get_items=None):
+    """
+    Decorator timing a method of an object with a `report` (`ODXReport`)
+    as phase `name`. `get_items(data)` returns the number of items of the
+    first argument of the method, passed by position or keyword.
+    """
+
+    def decorator(method):
+        signature = inspect.signature(method)
+        # the first argument after self
+        data_arg = list(signature.parameters)[1]
+
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            items = 0
+            if get_items:
+                arguments = signature.bind(self, *args, **kwargs).arguments
+                items = get_items(arguments[data_arg])
+            with self.report.phase(name, items):
+                return method(self, *args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+class ODXReport:
+    """
+    Structured report of one or more ODX runs.
+
+    Attributes
+    ----------
+    phases: dict
+        phase name -> dict with the total `seconds`, number of `calls`,
+        number of `items` processed, the peak memory during the phase
+        (`peak_rss_mb`, max over calls), the change of resident memory
+        (`rss_delta_mb`, summed over calls) and the peak memory of the
+        process so far (`process_max_rss_mb`). Without /proc (e.g. on
+        macos), `peak_rss_mb` is the peak of the process so far
+    counters: Counter
+        throughput counters (afc records, stages, inferred stages..)
+    skips: Counter
+        number of bus stages not inferred, by `SkipReason`
+    """
+
+    def __init__(self):
+        self.phases = {}
+        self.counters = Counter()
+        self.skips = Counter()
+        # running peak memory of the phases being timed, outermost first
+        self._open_peaks = []
+
+    @contextmanager
+    def phase(self, name, items=0):
+        """
+        Times the code in the `with` block as phase `name`.
+        Yields a dict whose `items` may be updated inside the block,
+        when the number of processed items is not known beforehand.
+        """
+        stats = {"items": items}
+        # the peak so far belongs to the enclosing phases, before reset
+        self._fold_peak(get_peak_rss_mb())
+        reset_peak_rss()
+        start_rss = get_rss_mb()
+        self._open_peaks.append(start_rss or 0.0)
+        start = time.perf_counter()
+        try:
+            yield stats
+        finally:
+            seconds = time.perf_counter() - start
+            peak = max(self._open_peaks.pop(), get_peak_rss_mb())
+            self._fold_peak(peak)
+            end_rss = get_rss_mb()
+
+            phase = self.phases.setdefault(
+                name,
+                {
+                    "seconds": 0.0,
+                    "calls": 0,
+                    "items": 0,
+                    "peak_rss_mb": 0.0,
+                    "rss_delta_mb": 0.0,
+                },
+            )
+            phase["seconds"] += seconds
+            phase["calls"] += 1
+            phase["items"] += stats["items"]
+            phase["peak_rss_mb"] = max(phase["peak_rss_mb"], peak)
+            if start_rss is not None and end_rss is not None:
+                phase["rss_delta_mb"] += end_rss - start_rss
+            phase["process_max_rss_mb"] = get_max_rss_mb()
+
+    def _fold_peak(self, peak):
+        self._open_peaks = [max(p, peak) for p in self._open_peaks]
+
+    def count(self, name, n=1):
+        self.counters[name] += n
+
+    def skip(self, reason, n=1):
+        self.skips[reason] += n
+
+    def count_skip_codes(self, codes):
+        """
+        Counts an array of `SKIP_REASON_CODES` codes,
+        the inferred ones (0) as the `inferred` counter
+        """
+        counts = np.bincount(codes, minlength=len(SKIP_REASON_CODES))
+        self.count("inferred", int(counts[0]))
+        for reason, n in zip(SKIP_REASON_CODES[1:], counts[1:]):
+            if n:
+                self.skip(reason, int(n))
+
+    def merge(self, other):
+        """Adds the phases and counts of `other` (report or dict)"""
+        if isinstance(other, ODXReport):
+            other = other.to_dict()
+
+        for name, other_phase in other["phases"].items():
+            phase = self.phases.setdefault(
+                name, {"seconds": 0.0, "calls": 0, "items": 0}
+            )
+            for key in ["seconds", "calls", "items", "rss_delta_mb"]:
+                phase[key] = phase.get(key, 0) + other_phase.get(key, 0)
+            for key in ["peak_rss_mb", "process_max_rss_mb"]:
+                phase[key] = max(phase.get(key, 0), other_phase.get(key, 0))
+        self.counters.update(other["counters"])
+        self.skips.update(other["skips"])
+
+    def reset(self):
+        self.__init__()
+
+    def to_dict(self):
+        phases = {}
+        for name, phase in self.phases.items():
+            phases[name] = dict(phase)
+            if phase["items"] and phase["seconds"]:
+                phases[name]["items_per_second"] = (
+                    phase["items"] / phase["seconds"]
+                )
+        return {
+            "phases": phases,
+            "counters": dict(self.counters),
+            "skips": dict(self.skips),
+        }
+
+    def to_json(self, path=None, **kwargs):
+        """Returns the report as json, and writes it to `path` if given"""
+        report_json = json.dumps(self.to_dict(), **kwargs)
+        if path is not None:
+            with open(path, "w") as f:
+                f.write(report_json)
+        return report_json
+
+    def show(self):
+        """Prints the report as tables"""
+        table = Table(title="ODX phases")
+        for col in [
+            "phase",
+            "seconds",
+            "calls",
+            "items/s",
+            "peak rss (MB)",
+            "rss change (MB)",
+        ]:
+            table.add_column(
+                col, justify="left" if col == "phase" else "right"
+            )
+        for name, phase in self.to_dict()["phases"].items():
+            table.add_row(
+                name,
+                f"{phase['seconds']:.3f}",
+                str(phase["calls"]),
+                f"{phase.get('items_per_second', 0):.0f}",
+                f"{phase['peak_rss_mb']:.0f}",
+                f"{phase['rss_delta_mb']:+.0f}",
+            )
+        print(table)
+
+        counts = Table(title="ODX counters")
+        counts.add_column("counter")
+        counts.add_column("count", justify="right")
+        for name, n in self.counters.items():
+            counts.add_row(name, str(n))
+        for reason, n in self.skips.items():
+            counts.add_row(f"skipped: {reason}", str(n))
+        print(counts)
+
+    def __repr__(self):
+        return f"ODXReport({self.to_json()})"
@@ -0,0 +1,185 @@
+"""
+Columnar (vectorized) stage building.
+
+Builds the same stages as `ODX.get_stages`, but as a single DataFrame
+with one row per stage instead of nested dicts of stage objects.
+"""
+import datetime
+import numpy as np
+import pandas as pd
+
+from .common import ODX_ENUMS
+from .config import ODXConfig
+
+# stop id used in the stage table when a stop is unknown (or missing)
+NO_STOP = -1
+# route index used in the stage table when a route is unknown (or missing)
+NO_ROUTE = -1
+
+STAGE_TABLE_COLUMNS = [
+    "card_id",
+    "day",
+    "mode",
+    "entry_stop_id",
+    "exit_stop_id",
+    "entry_ts",
+    "exit_ts",
+    "route_id",
+    "route_direction",
+    "route_variant",
+    "route_idx",
+]
+
+
+def get_service_day(timestamps, new_day_time=ODXConfig.NEW_DAY_TIME):
+    """
+    Vectorized version of `ODX.get_record_day`.
+    Records before `new_day_time` belong to the previous service day.
+
+    Parameters
+    ----------
+    timestamps: pd.Series
+        datetime64 series
+    new_day_time: datetime.time
+
+    Returns
+    -------
+    pd.Series
+        datetime64 series, normalized to midnight of the service day
+    """
+    offset = datetime.datetime.combine(
+        datetime.date.min, new_day_time
+    ) - datetime.datetime.combine(datetime.date.min, datetime.time())
+
+    return (pd.Series(timestamps) - offset).dt.normalize()
+
+
+def _known_or_missing(stop_ids, known_stop_ids):
+    """Replaces stop ids not in `known_stop_ids` with `NO_STOP`"""
+    return np.where(np.isin(stop_ids, known_stop_ids), stop_ids, NO_STOP)
+
+
+def build_stage_table(afc, bus_schedule, metro_schedule):
+    """
+    Builds stages from combined afc data, as `ODX.get_stages` does,
+    using array operations only.
+
+    Metro stages are built from 2 afc records (entry and exit), by
+    comparing each record with the next one of the same card and day.
+    Bus stages are built from a single afc record (boarding).
+
+    Returns
+    -------
+    pd.DataFrame
+        one row per stage, with columns `STAGE_TABLE_COLUMNS`,
+        sorted by card_id, service day and timestamp.
+        Unknown stops are `NO_STOP`, unknown routes are `NO_ROUTE`.
+    """
+    if pd.api.types.is_integer_dtype(afc["card_id"]) and not (
+        afc["card_id"].hasnans
+    ):
+        # integer card ids (e.g. the dense codes of `afc_schema`)
+        # sort like their factorization, which is not needed
+        card_codes = afc["card_id"].to_numpy(dtype=np.int64)
+    else:
+        card_codes, _ = pd.factorize(afc["card_id"], sort=True)
+    order = np.lexsort((afc["timestamp"].to_numpy(), card_codes))
+    afc = afc.iloc[order].reset_index(drop=True)
+    card_codes = card_codes[order]
+
+    days = get_service_day(afc["timestamp"]).to_numpy()
+    mode = afc["mode"].to_numpy()
+    if "way" in afc:
+        way = afc["way"].to_numpy()
+    else:
+        way = np.full(len(afc), None, dtype=object)
+    stop_ids = (
+        afc["stop_id"]
+        .astype("Int64")
+        .to_numpy(dtype=np.int64, na_value=NO_STOP)
+    )
+
+    is_bus = mode == ODX_ENUMS.BUS
+    is_metro = mode == ODX_ENUMS.METRO
+    is_in = is_metro & (way == ODX_ENUMS.METRO_IN)
+    is_out = is_metro & (way == ODX_ENUMS.METRO_OUT)
+
+    # next record belongs to the same card and service day
+    same_group_next = np.zeros(len(afc), dtype=bool)
+    same_group_next[:-1] = (card_codes[1:] == card_codes[:-1]) & (
+        days[1:] == days[:-1]
+    )
+
+    # metro IN followed by metro OUT form a single stage
+    next_is_out = np.zeros(len(afc), dtype=bool)
+    next_is_out[:-1] = is_out[1:]
+    pair_start = is_in & same_group_next & next_is_out
+    consumed = np.zeros(len(afc), dtype=bool)
+    consumed[1:] = pair_start[:-1]
+
+    next_idx = np.minimum(np.arange(len(afc)) + 1, max(len(afc) - 1, 0))
+
+    bus_sids = [s.stop_id for s in bus_schedule.stops]
+    metro_sids = [s.stop_id for s in metro_schedule.stops]
+    bus_stop_ids = _known_or_missing(stop_ids, bus_sids)
+    metro_stop_ids = _known_or_missing(stop_ids, metro_sids)
+
+    entry_stop_id = np.select(
+        [is_bus, is_in], [bus_stop_ids, metro_stop_ids], NO_STOP
+    )
+    exit_stop_id = np.select(
+        [pair_start, is_out],
+        [metro_stop_ids[next_idx], metro_stop_ids],
+        NO_STOP,
+    )
+
+    timestamps = afc["timestamp"].to_numpy()
+    nat = np.datetime64("NaT", "ns")
+    entry_ts = np.where(is_bus | is_in, timestamps, nat)
+    exit_ts = np.where(
+        pair_start,
+        timestamps[next_idx],
+        np.where(is_out, timestamps, nat),
+    )
+
+    route_idx = np.full(len(afc), NO_ROUTE, dtype=np.int64)
+    if is_bus.any():
+        bus_afc = afc.loc[is_bus]
+        route_idx[is_bus] = bus_schedule.get_route_indices(
+            bus_afc["route_id"],
+            bus_afc["route_direction"],
+            bus_afc["route_variant"],
+        )
+
+    # a stage that starts at every bus and metro IN record,
+    # and at metro OUT records that were not paired with an IN
+    # metro stages with the same entry and exit stop are discarded
+    keep = (is_bus | is_in | (is_out & ~consumed)) & ~(
+        is_metro & (entry_stop_id == exit_stop_id)
+    )
+
+    stages = pd.DataFrame(
+        {
+            "card_id": afc["card_id"].array,
+            "day": days,
+            "mode": mode,
+            "entry_stop_id": entry_stop_id,
+            "exit_stop_id": exit_stop_id,
+            "entry_ts": entry_ts,
+            "exit_ts": exit_ts,
+            "route_id": afc["route_id"].where(is_bus, None)
+            if "route_id" in afc
+            else None,
+            "route_direction": afc["route_direction"].where(is_bus, None)
+            if "route_direction" in afc
+            else None,
+            "route_variant": afc["route_variant"]
+            .astype("Int64")
+            .where(is_bus, pd.NA)
+            if "route_variant" in afc
+            else pd.NA,
+            "route_idx": route_idx,
+        },
+        columns=STAGE_TABLE_COLUMNS,
+    )
+    return stages.loc[keep].reset_index(drop=True)
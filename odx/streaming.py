@@ -0,0 +1,115 @@
+"""
+Day-by-day (streaming) ODX.
+
+The combined afc is read one record batch at a time, and split
+into service days (see `stages.get_service_day`). Each day is processed
+and yielded before the next one is read, so memory scales with
+a single day of data instead of the whole period.
+"""
+from pathlib import Path
+import pandas as pd
+import pyarrow as pa
+
+from . import config
+from .afc_store import AFCStore
+from .odx import ODX
+from .stages import get_service_day
+
+
+def iter_afc_days(path, columns=None):
+    """
+    Yields (service day, afc of that day) from the combined afc
+    feather file in `path`, which must be sorted by timestamp
+    (as written by `combine_afc`).
+
+    Parameters
+    ----------
+    path: str
+        combined afc feather path
+    columns: list
+        columns to read, all by default
+    """
+    reader = pa.ipc.open_file(path)
+    current_day = None
+    day_chunks = []
+
+    for batch_idx in range(reader.num_record_batches):
+        batch = reader.get_batch(batch_idx)
+        if columns is not None:
+            batch = pa.Table.from_batches([batch]).select(columns)
+        batch_df = batch.to_pandas()
+        if not len(batch_df):
+            continue
+
+        days = get_service_day(batch_df["timestamp"])
+        for day, day_df in batch_df.groupby(days.to_numpy(), sort=True):
+            if current_day is not None and day < current_day:
+                raise RuntimeError(
+                    f"AFC in {path} is not sorted by timestamp: "
+                    f"{day} after {current_day}"
+                )
+            if current_day is not None and day != current_day:
+                yield current_day, pd.concat(day_chunks, ignore_index=True)
+                day_chunks = []
+            current_day = day
+            day_chunks.append(day_df)
+
+    if day_chunks:
+        yield current_day, pd.concat(day_chunks, ignore_index=True)
+
+
+def iter_store_days(
+    path,
+    start_day=None,
+    end_day=None,
+    operators=config.AFC_STORE_OPERATORS,
+    columns=None,
+):
+    """
+    Yields (service day, afc of that day) from the afc store in `path`
+    (see `afc_store`), reading only the partitions of the days between
+    `start_day` and `end_day` (included). The afc of a day combines the
+    records of every operator, with their `mode`, sorted by timestamp.
+
+    Parameters
+    ----------
+    path: str
+        afc store path
+    operators: dict
+        mode -> operator of the records to read
+    columns: list
+        columns to read, all by default
+    """
+    store = AFCStore(path)
+    days = sorted(
+        {
+            day
+            for operator in operators.values()
+            for day in store.days(operator, start_day, end_day)
+        }
+    )
+    for day in days:
+        yield pd.Timestamp(day), store.read(operators, day, day, columns)
+
+
+def run_odx_streaming(
+    path, odx=None, columns=None, start_day=None, end_day=None
+):
+    """
+    Yields (service day, inferred stage table of that day) for every
+    service day in the combined afc in `path`, in order.
+    `path` may also be an afc store, of which only the days between
+    `start_day` and `end_day` are read.
+    Stages are built and inferred as in `ODX.get_stage_table` and
+    `ODX.infer_destinations_table`, which only depend on a day's records.
+    """
+    odx = odx or ODX()
+
+    if Path(path).is_dir():
+        days = iter_store_days(path, start_day, end_day, columns=columns)
+    else:
+        days = iter_afc_days(path, columns)
+
+    for day, afc in days:
+        stages = odx.get_stage_table(afc)
+        yield day, odx.infer_destinations_table(stages)
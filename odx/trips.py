@@ -0,0 +1,262 @@
+"""
+Vehicle trip matching of bus boardings.
+
+`TripIndex` holds the scheduled departures of the GTFS trips of every bus
+route (see `BusSchedule.match_gtfs_trips`), by service, route and stop,
+as a single sorted int64 array of keys:
+
+    (service group) * KEY_STRIDE + departure (seconds after midnight)
+
+where a service group is a GTFS service and a stop index of a route,
+the groups of a route being consecutive. The trips of the boardings of
+a stage table are then found with an `np.searchsorted` per service, over
+the boardings of the days the service runs on (see `ServiceCalendar`).
+"""
+import numpy as np
+import pandas as pd
+from loguru import logger
+
+from .bus_schedule import SECONDS_PER_DAY, get_seconds_of_day
+from .common import ODX_ENUMS
+from .config import ODXConfig
+from .gtfs import GTFSReader, GTFSIndex
+from .stages import NO_STOP, NO_ROUTE
+
+# GTFS times may be past 24:00:00, up to 48:00:00
+KEY_STRIDE = 2 * SECONDS_PER_DAY
+
+NO_TRIP = -1
+
+
+class TripIndex:
+    """
+    Scheduled departures of the bus routes of `bus_schedule`, from the
+    trips of a `GTFSIndex` (with times).
+
+    Parameters
+    ----------
+    bus_schedule: BusSchedule
+    gtfs_index: GTFSIndex
+    """
+
+    def __init__(self, bus_schedule, gtfs_index):
+        routes = bus_schedule.routes
+        self.trip_ids = gtfs_index.trip_ids
+        self.calendar = gtfs_index.calendar
+        self._rid_to_idx = bus_schedule._rid_to_idx
+
+        # (route, stop id) -> stop index, as sorted keys
+        self.stop_stride = 1 + max(
+            (max(r.route_stop_ids) for r in routes if r.route_stop_ids),
+            default=0,
+        )
+        stop_keys, stop_idxs = [], []
+        for route_idx, r in enumerate(routes):
+            stop_keys.append(
+                route_idx * self.stop_stride
+                + np.array(list(r._sid_to_idx), dtype=np.int64)
+            )
+            stop_idxs.append(np.array(list(r._sid_to_idx.values())))
+        order = np.argsort(np.concatenate(stop_keys))
+        self.stop_keys = np.concatenate(stop_keys)[order]
+        self.stop_idxs = np.concatenate(stop_idxs).astype(np.int64)[order]
+
+        # a group per stop index, the last stop (no departures) included
+        self.group_offsets = np.zeros(len(routes) + 1, dtype=np.int64)
+        self.group_offsets[1:] = np.cumsum(
+            [len(r.route_stop_ids) for r in routes]
+        )
+        # stop index groups of every service
+        self.n_groups = int(self.group_offsets[-1])
+
+        keys, key_trips = [], []
+        route_trips = bus_schedule.match_gtfs_trips(gtfs_index)
+        for route_idx, (r, trips) in enumerate(zip(routes, route_trips)):
+            n_stops = len(r.route_stop_ids) - 1
+            if not len(trips) or n_stops < 1:
+                continue
+            # (trips x stops) stop time positions, the last stop excluded
+            positions = (
+                gtfs_index.trip_offsets[trips][:, None]
+                + np.arange(n_stops)[None, :]
+            )
+            departures = gtfs_index.departure_times[positions]
+            valid = ~np.isnan(departures) & (departures < KEY_STRIDE)
+            groups = (
+                gtfs_index.trip_services[trips][:, None] * self.n_groups
+                + self.group_offsets[route_idx]
+                + np.arange(n_stops)[None, :]
+            )
+            keys.append(
+                (groups * KEY_STRIDE + departures)[valid].astype(np.int64)
+            )
+            key_trips.append(
+                np.broadcast_to(trips[:, None], valid.shape)[valid]
+            )
+
+        keys = np.concatenate(keys) if keys else np.array([], np.int64)
+        order = np.argsort(keys, kind="stable")
+        self.keys = keys[order]
+        self.key_trips = (
+            np.concatenate(key_trips)[order].astype(np.int64)
+            if key_trips
+            else np.array([], np.int64)
+        )
+        logger.info(f"Indexed {len(self.keys)} scheduled bus departures")
+
+    @classmethod
+    def from_gtfs(cls, bus_schedule, gtfs_path):
+        """`TripIndex` of the trips of the GTFS in `gtfs_path`"""
+        return cls(bus_schedule, GTFSIndex(GTFSReader(gtfs_path), times=True))
+
+    def get_stop_idxs(self, route_idxs, stop_ids):
+        """
+        Stop index of every stop id in its route, as
+        `BusRouteArrays.get_stop_idxs`, or -1 if not in the route
+        """
+        route_idxs = np.asarray(route_idxs, dtype=np.int64)
+        stop_ids = np.asarray(stop_ids, dtype=np.int64)
+        valid = (
+            (route_idxs >= 0) & (stop_ids >= 0) & (stop_ids < self.stop_stride)
+        )
+        keys = route_idxs * self.stop_stride + stop_ids
+        positions = np.minimum(
+            np.searchsorted(self.stop_keys, keys), len(self.stop_keys) - 1
+        )
+        found = valid & (self.stop_keys[positions] == keys)
+        return np.where(found, self.stop_idxs[positions], -1)
+
+    def get_departures(self, route_tuple, stop_id, day=None):
+        """
+        Sorted scheduled departures (seconds after midnight) from a stop of
+        a route, given as a `BusRouteTuple`, of the trips that run on
+        `day` (datetime.date), or of every trip
+        """
+        route_idx = self._rid_to_idx[tuple(route_tuple)]
+        stop_idx = self.get_stop_idxs([route_idx], [stop_id])[0]
+        if stop_idx < 0:
+            return np.array([], dtype=np.int64)
+
+        n_services = len(self.calendar.service_ids)
+        if day is None:
+            services = np.arange(n_services)
+        else:
+            services = np.flatnonzero(self.calendar.get_active([day])[0])
+        departures = []
+        for service in services:
+            group = (
+                service * self.n_groups
+                + self.group_offsets[route_idx]
+                + stop_idx
+            )
+            start, end = np.searchsorted(
+                self.keys, [group * KEY_STRIDE, (group + 1) * KEY_STRIDE]
+            )
+            departures.append(self.keys[start:end] - group * KEY_STRIDE)
+        return np.sort(np.concatenate(departures + [np.array([], np.int64)]))
+
+    def match(
+        self,
+        route_idxs,
+        stop_ids,
+        timestamps,
+        max_delay=ODXConfig.MAX_TRIP_MATCH_DELAY,
+    ):
+        """
+        Most likely trip of every boarding: the trip of its route, running
+        on the boarding's day, with the scheduled departure from its stop
+        closest to its timestamp, within `max_delay` seconds. Boardings
+        after midnight are also matched to the trips of the previous day
+        (GTFS times past 24:00:00).
+
+        Returns
+        -------
+        tuple
+            (trip codes, delays): positions in `trip_ids`, `NO_TRIP` where
+            no trip matches, and the delays (seconds) of the boardings to
+            the scheduled departures, nan where no trip matches
+        """
+        route_idxs = np.asarray(route_idxs, dtype=np.int64)
+        stop_idxs = self.get_stop_idxs(route_idxs, stop_ids)
+        seconds = get_seconds_of_day(timestamps)
+        days = np.asarray(timestamps, dtype="datetime64[ns]").astype(
+            "datetime64[D]"
+        )
+        valid = (stop_idxs >= 0) & (seconds >= 0)
+        boardings = np.flatnonzero(valid)
+        groups = (
+            self.group_offsets[route_idxs[boardings]] + stop_idxs[boardings]
+        )
+
+        trips = np.full(len(route_idxs), NO_TRIP, dtype=np.int64)
+        delays = np.full(len(route_idxs), np.inf)
+        if not len(self.keys):
+            return trips, np.full(len(route_idxs), np.nan)
+
+        for n_days in [0, 1]:
+            # the day the trips start on
+            active = self.calendar.get_active(
+                days[boardings] - np.timedelta64(n_days, "D")
+            )
+            for service in np.flatnonzero(active.any(axis=0)):
+                runs = active[:, service]
+                service_groups = service * self.n_groups + groups[runs]
+                selected = boardings[runs]
+                queries = (
+                    service_groups * KEY_STRIDE
+                    + seconds[selected]
+                    + n_days * SECONDS_PER_DAY
+                )
+                after = np.searchsorted(self.keys, queries)
+                for candidates in [after - 1, after]:
+                    candidates = np.clip(candidates, 0, len(self.keys) - 1)
+                    candidate_delays = queries - self.keys[candidates]
+                    better = (
+                        self.keys[candidates] // KEY_STRIDE == service_groups
+                    ) & (np.abs(candidate_delays) < np.abs(delays[selected]))
+                    trips[selected[better]] = self.key_trips[
+                        candidates[better]
+                    ]
+                    delays[selected[better]] = candidate_delays[better]
+
+        matched = np.abs(delays) <= max_delay
+        return (
+            np.where(matched, trips, NO_TRIP),
+            np.where(matched, delays, np.nan),
+        )
+
+
+def match_trips(stages, trip_index, max_delay=ODXConfig.MAX_TRIP_MATCH_DELAY):
+    """
+    Matches the bus stages of a stage table (see `stages`) to their
+    scheduled trips (see `TripIndex.match`).
+
+    Returns
+    -------
+    pd.DataFrame
+        copy of `stages` with the GTFS `trip_id` of every matched bus
+        stage (None otherwise), and its `trip_delay` in seconds
+    """
+    stages = stages.copy()
+    route_idxs = stages["route_idx"].to_numpy()
+    entry_sids = stages["entry_stop_id"].to_numpy()
+    is_bus = (
+        (stages["mode"].to_numpy() == ODX_ENUMS.BUS)
+        & (route_idxs != NO_ROUTE)
+        & (entry_sids != NO_STOP)
+    )
+
+    trips, delays = trip_index.match(
+        np.where(is_bus, route_idxs, -1),
+        np.where(is_bus, entry_sids, -1),
+        stages["entry_ts"].to_numpy(),
+        max_delay,
+    )
+    trip_ids = trip_index.trip_ids.to_numpy()
+    stages["trip_id"] = pd.Series(
+        np.where(trips >= 0, trip_ids[np.maximum(trips, 0)], None),
+        index=stages.index,
+        dtype=object,
+    )
+    stages["trip_delay"] = delays
+    return stages
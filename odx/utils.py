@@ -4,6 +4,12 @@ from . import config
 
 
 class Singleton(type):
+    """
+    One instance per class and per process.
+    Forked processes inherit the instances created before the fork,
+    so they don't rebuild them (see `odx.parallel`).
+    """
+
     _instances = {}
 
     def __call__(cls, *args, force=False, **kwargs):
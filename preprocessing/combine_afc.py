@@ -1,43 +1,183 @@
+import os
 import argparse
 import datetime
-import pandas as pd
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
 from rich import print
+from tqdm.auto import tqdm
 
 from odx import config
+from odx.afc_store import AFCStore
+from odx.afc_schema import (
+    encode_dictionaries,
+    get_afc_schema,
+    get_batch_range,
+    get_dictionaries,
+    open_afc_file,
+)
+from odx.stages import get_service_day
 
 
-def load_afc(mode, path):
-    df = pd.read_feather(path)
-    df["mode"] = mode
-    return df
-
-
-def filter_df(
-    df,
+def get_time_bounds(
     start_date=None,
     end_date=None,
     start_time=None,
     end_time=None,
 ):
-    if start_date and end_date:
-        if start_time and end_time:
-            df = df[
-                (
-                    df.timestamp
-                    >= datetime.datetime.combine(start_date, start_time)
+    """
+    (start, end) timestamps of the records to keep, end excluded.
+    With times, from `start_date` at `start_time` to `end_date` at
+    `end_time` (included); otherwise every record of those dates.
+    None if there are no dates.
+    """
+    if not (start_date and end_date):
+        return None
+    if start_time and end_time:
+        return (
+            datetime.datetime.combine(start_date, start_time),
+            datetime.datetime.combine(end_date, end_time)
+            + datetime.timedelta(microseconds=1),
+        )
+    return (
+        datetime.datetime.combine(start_date, datetime.time()),
+        datetime.datetime.combine(
+            end_date + datetime.timedelta(days=1), datetime.time()
+        ),
+    )
+
+
+def scan_afc(mode, path, columns=None, time_bounds=None):
+    """
+    Yields the record batches of the processed afc feather in `path`
+    (or of the list of feather files, in order) as tables with a `mode`
+    column, reading only `columns` (all by default) of the records within
+    `time_bounds` (see `get_time_bounds`). Files are sorted by timestamp,
+    so only the batches that overlap `time_bounds` are read
+    (see `get_batch_range`).
+    """
+    paths = [path] if isinstance(path, (str, os.PathLike)) else path
+    if columns is not None and "timestamp" not in columns:
+        columns = ["timestamp", *columns]
+    if time_bounds is not None:
+        start, end = (pa.scalar(t, pa.timestamp("ns")) for t in time_bounds)
+
+    for path in paths:
+        first, end_batch = get_batch_range(path, time_bounds)
+        reader = open_afc_file(path, columns)
+        for i in range(first, end_batch):
+            batch = reader.get_batch(i)
+            if time_bounds is not None:
+                timestamps = batch.column("timestamp")
+                batch = batch.filter(
+                    pc.and_(
+                        pc.greater_equal(timestamps, start),
+                        pc.less(timestamps, end),
+                    )
                 )
-                & (
-                    df.timestamp
-                    <= datetime.datetime.combine(end_date, end_time)
+            if batch.num_rows:
+                table = pa.Table.from_batches([batch])
+                yield table.append_column(
+                    "mode", pa.array([mode] * batch.num_rows, pa.string())
                 )
-            ]
+
+
+def merge_sorted(sources, key="timestamp"):
+    """
+    k-way merge of `sources` (dict of name -> iterator of tables sorted
+    by `key`). Yields sorted tables, ties being kept in `sources` order.
+
+    Every source keeps a buffered table. The rows up to the smallest last
+    key among the buffers of the sources that are not exhausted are final:
+    they are merged and yielded, and emptied buffers are refilled.
+    Memory is bounded by a table per source.
+    """
+    iterators = dict(sources)
+    buffers = {}
+    last_keys = {}
+
+    while True:
+        for name in list(iterators):
+            if name in buffers:
+                continue
+            table = next(iterators[name], None)
+            if table is None:
+                del iterators[name]
+                continue
+
+            keys = table[key].to_numpy()
+            if np.any(keys[1:] < keys[:-1]) or (
+                name in last_keys and keys[0] < last_keys[name]
+            ):
+                raise ValueError(f"{name} AFC is not sorted by {key}")
+            last_keys[name] = keys[-1]
+            buffers[name] = table
+
+        if not buffers:
+            return
+
+        # later rows of the buffers may be preceded by unread rows
+        bounds = [last_keys[name] for name in iterators if name in buffers]
+        bound = min(bounds) if bounds else None
+
+        chunks = []
+        for name in list(buffers):
+            table = buffers[name]
+            n_final = (
+                len(table)
+                if bound is None
+                else np.searchsorted(table[key].to_numpy(), bound, "right")
+            )
+            chunks.append(table.slice(0, n_final))
+            if n_final == len(table):
+                del buffers[name]
+            else:
+                buffers[name] = table.slice(n_final)
+
+        merged = pa.concat_tables(chunks, promote_options="default")
+        # stable, so ties keep the sources order
+        yield merged.take(pc.sort_indices(merged, [(key, "ascending")]))
+
+
+def conform_table(table, schema, dictionaries):
+    """
+    `table` with the columns and types of `schema` (missing columns as
+    nulls), its dictionary columns encoded with `dictionaries`
+    """
+    columns = {}
+    for field in schema:
+        value_type = (
+            field.type.value_type
+            if pa.types.is_dictionary(field.type)
+            else field.type
+        )
+        if field.name in table.column_names:
+            columns[field.name] = table[field.name].cast(value_type)
         else:
-            df = df[
-                (df.timestamp.dt.date >= start_date)
-                & (df.timestamp.dt.date <= end_date)
-            ]
-    df = df.reset_index().drop("index", axis=1)
-    return df
+            columns[field.name] = pa.nulls(len(table), value_type)
+
+    table = encode_dictionaries(pa.table(columns), dictionaries)
+    return pa.Table.from_arrays(table.columns, schema=schema)
+
+
+def get_combined_columns(afc_sources, columns=None):
+    """
+    Columns of the afc sources (and `mode`), in the order
+    of the concatenation of their dataframes
+    """
+    names = []
+    for idx, path in enumerate(afc_sources.values()):
+        names += [
+            name
+            for name in pa.ipc.open_file(path).schema.names
+            if name not in names
+        ]
+        if idx == 0:
+            names.append("mode")
+    if columns is not None:
+        names = [name for name in names if name in [*columns, "mode"]]
+    return names
 
 
 def get_combined_afc(
@@ -51,29 +191,128 @@ def get_combined_afc(
     end_time=datetime.time(23, 59, 59),
     save=True,
     output_path=None,
+    columns=None,
+    output_format="feather",
+    chunk_size=2**20,
+    store_path=None,
+    operators=config.AFC_STORE_OPERATORS,
 ):
-    dfs = []
-    for mode, path in afc_sources.items():
-        print(f"Loading {mode} AFC from {path}")
-        dfs.append(load_afc(mode, path))
-
-    print(f"Concatenating and sorting {len(dfs)} AFC dataframes..")
-    afc = pd.concat(dfs, ignore_index=True)
-    afc = afc.sort_values(by="timestamp", ignore_index=True)
+    """
+    Combines the processed afc sources (each sorted by timestamp) into
+    a single afc sorted by timestamp, with the records between the dates
+    (and times). The time filter and column projection are pushed down to
+    the reads, and the sources are streamed through a k-way merge,
+    written in chunks of up to `chunk_size` rows, so memory does not grow
+    with the size of the sources or of the period.
 
+    Parameters
+    ----------
+    columns: list
+        columns to keep, all by default
+    output_format: str
+        'feather' or 'parquet'
+    store_path: str
+        afc store (see `odx.afc_store`) to read, instead of `afc_sources`.
+        Only the partitions of the service days of the period are read.
+    operators: dict
+        mode -> operator of the records to read from the store
+    """
+    time_bounds = get_time_bounds(start_date, end_date, start_time, end_time)
     print(f"Filtering AFC for rows between dates {start_date} and {end_date}")
     if start_time and end_time:
         print(f"and between times {start_time} and {end_time}")
-    subset_afc = filter_df(afc, start_date, end_date, start_time, end_time)
 
-    print(subset_afc.timestamp.iloc[0])
+    sources = {}
+    source_paths = {}
+    if store_path is None:
+        for mode, path in afc_sources.items():
+            print(f"Loading {mode} AFC from {path}")
+            sources[mode] = scan_afc(mode, path, columns, time_bounds)
+            source_paths[mode] = [path]
+    else:
+        store = AFCStore(store_path)
+        start_day = end_day = None
+        if time_bounds is not None:
+            start_day, end_day = get_service_day(
+                [
+                    time_bounds[0],
+                    time_bounds[1] - datetime.timedelta(microseconds=1),
+                ]
+            )
+        afc_sources = {}
+        for mode, operator in operators.items():
+            print(f"Loading {mode} AFC from {store} ({operator})")
+            # buckets are sorted on their own, and merged as sources
+            for bucket in range(store.n_buckets):
+                paths = store.get_partition_paths(
+                    operator, start_day, end_day, bucket
+                )
+                if paths:
+                    afc_sources.setdefault(mode, paths[0])
+                    source_paths.setdefault(mode, []).extend(paths)
+                    sources[f"{mode} (bucket {bucket})"] = scan_afc(
+                        mode, paths, columns, time_bounds
+                    )
+
+    # the compact afc schema, with the same dictionaries for every chunk
+    schema = get_afc_schema(get_combined_columns(afc_sources, columns))
+    dictionaries = get_dictionaries(
+        [path for paths in source_paths.values() for path in paths],
+        [
+            field.name
+            for field in schema
+            if pa.types.is_dictionary(field.type) and field.name != "mode"
+        ],
+        time_bounds,
+    )
+    dictionaries["mode"] = list(source_paths)
+
+    if not save:
+        return
+
+    print(f"Merging {len(sources)} AFC sources..")
+    suffix = f".{output_format}"
+    tmp_path = f"{output_path or 'combined_afc'}{suffix}.tmp"
+
+    if output_format == "parquet":
+        writer = pq.ParquetWriter(tmp_path, schema)
+    elif output_format == "feather":
+        writer = pa.ipc.new_file(
+            tmp_path,
+            schema,
+            options=pa.ipc.IpcWriteOptions(compression="lz4"),
+        )
+    else:
+        raise ValueError(f"Unknown output format: {output_format}")
 
-    if save:
-        if output_path is None:
-            output_path = f"combined_afc_{str(subset_afc.timestamp.iloc[0]).replace(' ', '_')}__{str(subset_afc.timestamp.iloc[-1]).replace(' ', '_')}"
-        output_path += ".feather"
-        print(f"Saving combined dataframe to {output_path}")
-        subset_afc.to_feather(output_path)
+    first_timestamp = last_timestamp = None
+    n_rows = 0
+    with writer:
+        for table in tqdm(merge_sorted(sources), unit="chunk"):
+            table = conform_table(table, schema, dictionaries)
+            for batch in table.to_batches(max_chunksize=chunk_size):
+                writer.write_batch(batch)
+
+            if first_timestamp is None:
+                first_timestamp = table["timestamp"][0].as_py()
+            last_timestamp = table["timestamp"][-1].as_py()
+            n_rows += len(table)
+
+    if not n_rows:
+        os.remove(tmp_path)
+        print(
+            f"[red]No AFC records between {start_date} and {end_date}, "
+            "nothing saved"
+        )
+        return
+
+    print(f"{n_rows} rows, from {first_timestamp} to {last_timestamp}")
+
+    if output_path is None:
+        output_path = f"combined_afc_{str(first_timestamp).replace(' ', '_')}__{str(last_timestamp).replace(' ', '_')}"
+    output_path += suffix
+    print(f"Saving combined dataframe to {output_path}")
+    os.replace(tmp_path, output_path)
 
 
 if __name__ == "__main__":
@@ -108,18 +347,28 @@ if __name__ == "__main__":
         required=False,
     )
     parser.add_argument("-o", "--output", help="output path", default=None)
+    parser.add_argument(
+        "--store",
+        help="afc store to read, instead of the processed afc files",
+        default=None,
+    )
+    parser.add_argument(
+        "-f",
+        "--format",
+        choices=["feather", "parquet"],
+        help="output format",
+        default="feather",
+    )
 
     args = parser.parse_args()
 
-    date_parser = (
-        lambda s: None
+    date_parser = lambda s: (
+        None
         if s is None
         else datetime.date(*[int(s) for s in s.split("-")][::-1])
     )
-    time_parser = (
-        lambda s: None
-        if s is None
-        else datetime.time(*[int(s) for s in s.split(":")])
+    time_parser = lambda s: (
+        None if s is None else datetime.time(*[int(s) for s in s.split(":")])
     )
 
     start_date = date_parser(args.start_date)
@@ -133,4 +382,6 @@ if __name__ == "__main__":
         start_time=start_time,
         end_time=end_time,
         output_path=args.output,
+        output_format=args.format,
+        store_path=args.store,
     )
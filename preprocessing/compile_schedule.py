@@ -0,0 +1,43 @@
+"""
+Compiles the bus and metro schedules into binary bundles, which
+`BusSchedule` and `MetroSchedule` load instead of parsing the source files.
+Bundles are ignored (and schedules built from source) once the source files change.
+"""
+import argparse
+from rich import print
+
+from odx.bus_schedule import BusSchedule
+from odx.metro_schedule import MetroSchedule
+from odx import config
+
+
+def compile_schedules(
+    bus_bundle_path=config.BUS_SCHEDULE_BUNDLE_PATH,
+    metro_bundle_path=config.METRO_SCHEDULE_BUNDLE_PATH,
+):
+    print("Building bus schedule from source..")
+    bus_schedule = BusSchedule(bundle_path=None, force=True)
+    print(f"Compiling {bus_schedule} to {bus_bundle_path}..")
+    bus_schedule.compile(bus_bundle_path)
+
+    print("Building metro schedule from source..")
+    metro_schedule = MetroSchedule(bundle_path=None, force=True)
+    print(f"Compiling {metro_schedule} to {metro_bundle_path}..")
+    metro_schedule.compile(metro_bundle_path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compile schedule bundles")
+    parser.add_argument(
+        "--bus-output",
+        help="bus schedule bundle path",
+        default=config.BUS_SCHEDULE_BUNDLE_PATH,
+    )
+    parser.add_argument(
+        "--metro-output",
+        help="metro schedule bundle path",
+        default=config.METRO_SCHEDULE_BUNDLE_PATH,
+    )
+
+    args = parser.parse_args()
+    compile_schedules(args.bus_output, args.metro_output)
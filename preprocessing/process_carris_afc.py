@@ -1,8 +1,22 @@
 import argparse
+import tempfile
 from pathlib import Path
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pv
+import pyarrow.compute as pc
+from pandas.tseries.api import guess_datetime_format
 from rich import print
+from tqdm.auto import tqdm
 from odx import config
+from odx.afc_store import AFCStore
+from odx.afc_schema import (
+    CardMapping,
+    get_afc_schema,
+    parse_ints,
+    to_afc_table,
+)
 
 carris_col_mapping = {
     "timestamp": "Data/Hora",
@@ -16,6 +30,105 @@ carris_col_mapping = {
     # 'description': 'Descrição'
 }
 
+# Final column names
+cols_to_save = [
+    "timestamp",
+    "card_id",
+    "stop_id",
+    "route_id",
+    "route_variant",
+    "route_direction",
+    "stop_number",
+]
+
+# schema of the temporary files, as `AFC_FIELDS` without dictionaries
+spill_schema = pa.schema(
+    [
+        ("timestamp", pa.timestamp("ns")),
+        ("card_id", pa.int32()),
+        ("stop_id", pa.int32()),
+        ("route_id", pa.string()),
+        ("route_variant", pa.int16()),
+        ("route_direction", pa.string()),
+        ("stop_number", pa.int16()),
+    ]
+)
+
+# columns written as dictionaries, whose values are collected while reading
+dictionary_cols = ["route_id", "route_direction"]
+
+
+def parse_stop_ids(array):
+    """Vectorized stop_id parsing: '1234,5' -> 1234, '' -> <NA>"""
+    return parse_ints(
+        pc.list_element(pc.split_pattern(array, ",", max_splits=1), 0)
+    )
+
+
+def guess_timestamp_format(array):
+    """
+    Format of a string array of timestamps, guessed from its first value
+    (day first): 'ISO8601', a strftime format, or None if all are null
+    """
+    values = array.drop_null()
+    if not len(values):
+        return None
+    try:
+        pc.cast(values.slice(0, 1), pa.timestamp("ns"))
+        return "ISO8601"
+    except pa.ArrowInvalid:
+        pass
+    value = values[0].as_py()
+    timestamp_format = guess_datetime_format(value, dayfirst=True)
+    if timestamp_format is None:
+        raise ValueError(f"Unknown timestamp format: {value!r}")
+    return timestamp_format
+
+
+def parse_timestamps(array, timestamp_format):
+    """
+    Parses a string array of timestamps with `timestamp_format`
+    (see `guess_timestamp_format`), ISO 8601 ones natively.
+    Invalid timestamps become NaT, but a format that matches
+    none of the timestamps raises a ValueError.
+    """
+    if timestamp_format == "ISO8601":
+        try:
+            return pc.cast(array, pa.timestamp("ns")).to_pandas()
+        except pa.ArrowInvalid:
+            pass
+    timestamps = pd.to_datetime(
+        array.to_pandas(), format=timestamp_format, errors="coerce"
+    )
+    n_values = len(array) - array.null_count
+    if n_values and timestamps.isnull().all():
+        raise ValueError(
+            f"Timestamps do not match the format {timestamp_format!r}: "
+            f"{array.drop_null()[:3].to_pylist()}"
+        )
+    return timestamps
+
+
+def batch_to_frame(batch, col_mapping, timestamp_format):
+    """Processed afc dataframe of a batch of raw (string) csv columns"""
+    columns = {col: batch.column(col_mapping[col]) for col in cols_to_save}
+
+    return pd.DataFrame(
+        {
+            "timestamp": parse_timestamps(
+                columns["timestamp"], timestamp_format
+            ),
+            "card_id": parse_ints(columns["card_id"]),
+            "stop_id": parse_stop_ids(columns["stop_id"]),
+            "route_id": columns["route_id"].to_pandas(),
+            "route_variant": parse_ints(columns["route_variant"]),
+            "route_direction": columns["route_direction"]
+            .to_pandas()
+            .fillna(""),
+            "stop_number": parse_ints(columns["stop_number"]),
+        }
+    )
+
 
 def process_carris_afc(
     path: str,
@@ -23,114 +136,188 @@ def process_carris_afc(
     encoding: str = "latin1",
     sep: str = ";",
     output_path: str = None,
-    **kwargs,
+    timestamp_format: str = None,
+    block_size: int = 64 * 2**20,
+    store_path: str = None,
+    n_buckets: int = None,
+    card_mapping_path: str = config.CARD_MAPPING_PATH,
+    partition_freq: str = "D",
+    tmp_dir: str = None,
 ):
     """
     Processes carris raw AFC csv file.
+
+    The csv is read in blocks of `block_size` bytes by a multithreaded
+    reader, and every block is parsed with vectorized operations.
+    Rows are spilled to temporary files by `partition_freq` period
+    (duplicates share a timestamp, so they share a period), which are then
+    deduplicated and sorted one at a time, and appended to the output.
+    Memory is bounded by a block and a period of data, whatever
+    the size of the file. Malformed rows (e.g. a truncated last row) are
+    skipped, as are rows with invalid timestamps or card ids.
+    The output has the compact afc schema (see `odx.afc_schema`), with card
+    ids encoded by the card mapping in `card_mapping_path`.
+    Timestamps are parsed with `timestamp_format`, by default guessed
+    once from the first timestamp of the file.
     """
     path = Path(path)
 
-    assert path.is_file(), "No such file {path}"
-    # Final column names
-    cols = [
-        "timestamp",
-        "card_id",
-        "stop_id",
-        "stop_name",
-        "route_id",
-        "route_variant",
-        "route_direction",
-        "stop_number",
-    ]
+    assert path.is_file(), f"No such file {path}"
 
     # check if col_mapping has all the necessary cols
-    for col in cols:
+    for col in cols_to_save:
         if col not in col_mapping:
             raise ValueError(f"Missing column in col_mapping: '{col}'")
 
     # list columns to extract from csv
-    usecols = [col_mapping[col] for col in cols]
-
-    dtype = {
-        col_mapping["route_direction"]: str,
-        col_mapping["route_id"]: str,
-        col_mapping["route_variant"]: "Int64",
-        col_mapping["stop_name"]: str,
-        col_mapping["card_id"]: "Int64",
-        # col_mapping["stop_id"]: 'Int64',
-        col_mapping["stop_number"]: "Int64",
-    }
-
-    def convert_stop_id(sid):
-        if sid == "":
-            return None
-        try:
-            return int(sid.split(",")[0])
-        except ValueError:
-            return None
+    usecols = [col_mapping[col] for col in cols_to_save]
+
+    read_options = pv.ReadOptions(
+        encoding=encoding, block_size=block_size, use_threads=True
+    )
+    with open(path, encoding=encoding) as f:
+        header = f.readline().rstrip("\r\n").split(sep)
+    print(f"Raw Columns: {header}\n")
 
-    parse_dates = [col_mapping["timestamp"]]
+    wrong_cols = [col for col in usecols if col not in header]
+    if wrong_cols:
+        raise RuntimeError(f"Columns not found in csv: {wrong_cols}")
 
-    header = pd.read_csv(path, nrows=1, encoding=encoding, sep=sep)
-    print(f"Raw Columns: {list(header.columns)}\n")
+    # a set, as the multithreaded reader may report a row more than once
+    invalid_rows = set()
+
+    def skip_invalid_row(row):
+        invalid_rows.add(row.number)
+        return "skip"
+
+    reader = pv.open_csv(
+        path,
+        read_options=read_options,
+        parse_options=pv.ParseOptions(
+            delimiter=sep, invalid_row_handler=skip_invalid_row
+        ),
+        convert_options=pv.ConvertOptions(
+            include_columns=usecols,
+            column_types={col: pa.string() for col in usecols},
+            strings_can_be_null=True,
+        ),
+    )
 
-    print(f"Reading raw CSV from {path}..\n")
-    try:
-        df = pd.read_csv(
-            path,
-            usecols=usecols,
-            dtype=dtype,
-            infer_datetime_format=True,
-            parse_dates=parse_dates,
-            header=0,
-            encoding=encoding,
-            sep=sep,
-            converters={col_mapping["stop_id"]: convert_stop_id},
-            **kwargs,
-        )
-    except ValueError as e:
-        wrong_cols = []
-        for col in col_mapping.values():
-            if col not in header.columns:
-                wrong_cols.append(col)
-        if wrong_cols:
-            raise RuntimeError(f"Columns not found in csv: {wrong_cols}")
-        raise e
-
-    # standard column naming
-    inv_col_mapping = {v: k for k, v in col_mapping.items()}
-
-    print("Renaming columns..")
-    df.rename(columns=inv_col_mapping, inplace=True)
-    print(f"Missing values:\n{df.isnull().sum()/len(df)}")
-
-    print("Dropping duplicates..")
-    # drop entries that have the same timestamp, card_id pair
-    df.drop_duplicates(subset=["timestamp", "card_id"], inplace=True)
-    print("Sorting by timestamp..")
-    # sort by timestamp
-    df["route_direction"] = df["route_direction"].fillna("")
-    df["stop_id"] = df["stop_id"].astype("Int64")
-    df.sort_values(by="timestamp", ignore_index=True, inplace=True)
-
-    cols_to_save = [
-        "timestamp",
-        "card_id",
-        "stop_id",
-        "route_id",
-        "route_variant",
-        "route_direction",
-        "stop_number",
-    ]
     output_path = (
         path.parent / (path.stem + "_processed.feather")
         if output_path is None
         else output_path
     )
 
-    print(f"Saving processed dataframe to {output_path}")
+    card_mapping = CardMapping(card_mapping_path)
+    dictionaries = {col: set() for col in dictionary_cols}
 
-    df[cols_to_save].to_feather(output_path)
+    n_rows = 0
+    n_invalid = 0
+    missing = pd.Series(0, index=cols_to_save)
+
+    # locked until saved (see `CardMapping`)
+    with card_mapping, tempfile.TemporaryDirectory(dir=tmp_dir) as spill_dir:
+        spill_writers = {}
+
+        print(f"Reading raw CSV from {path}..\n")
+        for batch in tqdm(reader, unit="block"):
+            if timestamp_format is None:
+                # the same format for every block
+                timestamp_format = guess_timestamp_format(
+                    batch.column(col_mapping["timestamp"])
+                )
+                if timestamp_format is not None:
+                    print(f"Timestamp format: {timestamp_format}")
+            df = batch_to_frame(batch, col_mapping, timestamp_format)
+            n_rows += len(df)
+            missing += df.isnull().sum()
+
+            invalid = df["timestamp"].isnull() | df["card_id"].isnull()
+            n_invalid += invalid.sum()
+            df = df[~invalid].assign(
+                card_id=lambda df: card_mapping.encode(
+                    df["card_id"].to_numpy(dtype=np.int64)
+                )
+            )
+            for col in dictionary_cols:
+                dictionaries[col].update(df[col].dropna().unique())
+
+            periods = df["timestamp"].dt.floor(partition_freq)
+            for period, period_df in df.groupby(periods, sort=False):
+                if period not in spill_writers:
+                    spill_writers[period] = pa.ipc.new_stream(
+                        Path(spill_dir) / f"{period.value}.arrow",
+                        spill_schema,
+                    )
+                spill_writers[period].write_table(
+                    pa.Table.from_pandas(
+                        period_df,
+                        schema=spill_schema,
+                        preserve_index=False,
+                    )
+                )
+
+        for writer in spill_writers.values():
+            writer.close()
+
+        print(f"Read {n_rows} rows")
+        print(f"Missing values:\n{missing / max(n_rows, 1)}")
+        if invalid_rows:
+            print(
+                f"[red]Skipped {len(invalid_rows)} malformed rows "
+                f"(rows {sorted(invalid_rows)[:10]}..)"
+            )
+        if n_invalid:
+            print(
+                f"[red]Dropped {n_invalid} rows with invalid timestamps or card ids"
+            )
+        dictionaries = {
+            col: sorted(values) for col, values in dictionaries.items()
+        }
+
+        print(
+            f"Dropping duplicates and sorting by timestamp, "
+            f"in {len(spill_writers)} periods.."
+        )
+        print(f"Saving processed dataframe to {output_path}")
+        n_saved = 0
+        with pa.ipc.new_file(
+            output_path,
+            get_afc_schema(cols_to_save),
+            options=pa.ipc.IpcWriteOptions(compression="lz4"),
+        ) as output:
+            for period in tqdm(sorted(spill_writers)):
+                with pa.ipc.open_stream(
+                    Path(spill_dir) / f"{period.value}.arrow"
+                ) as spill:
+                    df = spill.read_pandas(
+                        types_mapper={
+                            pa.int32(): pd.Int32Dtype(),
+                            pa.int16(): pd.Int16Dtype(),
+                        }.get
+                    )
+
+                # drop entries that have the same timestamp, card_id pair
+                df.drop_duplicates(
+                    subset=["timestamp", "card_id"], inplace=True
+                )
+                df.sort_values(
+                    by="timestamp",
+                    kind="stable",
+                    ignore_index=True,
+                    inplace=True,
+                )
+                n_saved += len(df)
+                output.write_table(to_afc_table(df, dictionaries))
+
+        card_mapping.save()
+    print(f"Saved {n_saved} rows ({n_rows - n_saved} dropped)")
+
+    if store_path is not None:
+        store = AFCStore(store_path, n_buckets)
+        print(f"Appending processed afc to {store}..")
+        store.append_file(output_path, config.AFC_STORE_OPERATORS["bus"])
 
 
 if __name__ == "__main__":
@@ -142,14 +329,39 @@ if __name__ == "__main__":
         help="output path",
         default=config.PROCESSED_BUS_AFC_PATH,
     )
+    parser.add_argument(
+        "--block-size",
+        type=int,
+        help="csv block size, in MB",
+        default=64,
+    )
+    parser.add_argument(
+        "--tmp-dir",
+        help="directory for temporary files, system default if not given",
+        default=None,
+    )
+    parser.add_argument(
+        "--store",
+        help="afc store to also append the processed afc to",
+        default=None,
+    )
+    parser.add_argument(
+        "--buckets",
+        type=int,
+        help="number of card buckets of a new afc store",
+        default=None,
+    )
 
     args = parser.parse_args()
     input_path = args.path[0]
     output_path = args.output
 
-    print(
-        "[red]Assuming data is from October 2019, which has the last row corrupted.\nIf this is not the case, remove the 'nrows' argument from the call to 'process_carris_afc'\n"
-    )
     process_carris_afc(
-        input_path, carris_col_mapping, output_path=output_path, nrows=6282065
+        input_path,
+        carris_col_mapping,
+        output_path=output_path,
+        block_size=args.block_size * 2**20,
+        store_path=args.store,
+        n_buckets=args.buckets,
+        tmp_dir=args.tmp_dir,
     )
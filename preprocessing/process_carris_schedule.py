@@ -2,9 +2,10 @@
 Processes carris .xlsx file containing stop and route data, and outputs two json files
 This file is an alternative to the GTFS, and is compatible with the carris AFC data.
 """
+import os
 import json
+import hashlib
 from pathlib import Path
-from collections import defaultdict
 from rich import print
 import pandas as pd
 import argparse
@@ -25,85 +26,148 @@ class RawColumnNames:
     route_direction = "Sentido"
 
 
-def process_carris_excel(path, output_dir):
-    print(f"Reading excel from {Path(path).resolve()}..")
-    routes_df = pd.read_excel(path).dropna(how="all")
+direction_mapping = {
+    "A": BusRoute.Directions.ASC,
+    "D": BusRoute.Directions.DESC,
+    "C": BusRoute.Directions.CIRC,
+}
+
+
+def get_file_hash(path, chunk_size=2**20):
+    """sha256 of the contents of the file in `path`"""
+    file_hash = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+
+def normalize_object_columns(df):
+    """
+    `df` with the values of its object columns as strings, and their
+    nulls as None (as read from feather). Excel columns may mix numbers
+    and strings (route 758 and '15E'), which can not be written to feather
+    """
+    df = df.copy()
+    for col in df.columns[df.dtypes == object]:
+        df[col] = df[col].astype(str).where(df[col].notnull(), None)
+    return df
+
+
+def read_carris_excel(path, cache_dir=None):
+    """
+    Reads the carris excel, through a feather copy of the parsed sheet
+    in `cache_dir` (the excel's directory by default), keyed by the hash
+    of the excel, so the workbook is only parsed when it changes.
+    Object columns are read as strings (see `normalize_object_columns`).
+    """
+    path = Path(path)
+    cache_dir = path.parent if cache_dir is None else Path(cache_dir)
+    cache_path = cache_dir / f".{path.stem}.{get_file_hash(path)[:16]}.feather"
+
+    if cache_path.is_file():
+        print(f"Reading parsed excel from {cache_path}..")
+        return normalize_object_columns(pd.read_feather(cache_path))
+
+    print(f"Reading excel from {path.resolve()}..")
+    routes_df = normalize_object_columns(
+        pd.read_excel(path).dropna(how="all").reset_index(drop=True)
+    )
 
-    stops = []
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    tmp_path = cache_path.with_name(cache_path.name + ".tmp")
+    routes_df.to_feather(tmp_path)
+    os.replace(tmp_path, cache_path)
+
+    return routes_df
+
+
+def get_stops(routes_df):
+    """
+    Stops of the routes dataframe, with the information of the first row
+    of each stop, sorted by stop_id
+    """
+    stop_cols = [
+        RawColumnNames.stop_id,
+        RawColumnNames.stop_lat,
+        RawColumnNames.stop_lon,
+        RawColumnNames.stop_name,
+    ]
+    entries = routes_df[stop_cols].drop_duplicates()
+    for sid in entries.loc[
+        entries[RawColumnNames.stop_id].duplicated(), RawColumnNames.stop_id
+    ].unique():
+        print(
+            f"[red]Stop {sid} has more multiple entries, using first appearance"
+        )
 
-    unique_stops_ids = routes_df[RawColumnNames.stop_id].unique()
+    first = entries.drop_duplicates(subset=RawColumnNames.stop_id)
+    stops = [
+        BusStop(
+            stop_id=int(sid),
+            stop_name=str(name),
+            stop_lat=float(lat),
+            stop_lon=float(lon),
+        )
+        for sid, lat, lon, name in first.itertuples(index=False)
+    ]
+    stops.sort(key=lambda s: s.stop_id)
+    return stops
+
+
+def get_routes(routes_df):
+    """
+    Routes of the routes dataframe, in order of first appearance,
+    with their stops in row order
+    """
+    directions = (
+        routes_df[RawColumnNames.route_direction]
+        .map(direction_mapping)
+        .fillna(BusRoute.Directions.UNDEFINED)
+    )
+    route_stop_ids = (
+        routes_df[RawColumnNames.stop_id]
+        .astype(int)
+        .groupby(
+            [
+                routes_df[RawColumnNames.route_id],
+                directions,
+                routes_df[RawColumnNames.route_variant],
+            ],
+            sort=False,
+            dropna=False,
+        )
+        .agg(list)
+    )
 
-    print("Processing stops..")
+    return [
+        {
+            "route_id": str(route_id),
+            "route_direction": str(direction),
+            "route_variant": int(route_variant),
+            "route_stop_ids": stop_ids,
+        }
+        for (route_id, direction, route_variant), stop_ids in (
+            route_stop_ids.items()
+        )
+    ]
 
-    for sid in unique_stops_ids:
 
-        # get relevant stop information
-        stop_df = routes_df.loc[routes_df[RawColumnNames.stop_id] == sid][
-            [
-                RawColumnNames.stop_lat,
-                RawColumnNames.stop_lon,
-                RawColumnNames.stop_name,
-            ]
-        ]
-        if len(stop_df.drop_duplicates()) > 1:
-            print(
-                f"[red]Stop {sid} has more multiple entries, using first appearance"
-            )
-
-        row = stop_df.iloc[0]
-
-        stops.append(
-            BusStop(
-                stop_id=int(sid),
-                stop_name=str(row[RawColumnNames.stop_name]),
-                stop_lat=float(row[RawColumnNames.stop_lat]),
-                stop_lon=float(row[RawColumnNames.stop_lon]),
-            )
-        )
+def process_carris_excel(path, output_dir, cache_dir=None):
+    routes_df = read_carris_excel(path, cache_dir)
 
+    print("Processing stops..")
+    stops = get_stops(routes_df)
     validate_stops(stops)
 
-    stops.sort(key=lambda s: s.stop_id)
     stops_path = Path(f"{output_dir}/stops.json")
 
     print(f"Writing {len(stops)} processed stops to {stops_path.resolve()}")
     with open(str(stops_path), "w") as fout:
         json.dump(stops, fout, default=lambda x: x.to_dict(), indent=2)
 
-    routes_dict = defaultdict(list)
-
     print(f"Processing routes..")
-    for idx, row in routes_df.iterrows():
-        route_id = row[RawColumnNames.route_id]
-        route_variant = row[RawColumnNames.route_variant]
-        direction = row[RawColumnNames.route_direction]
-
-        if direction == "A":
-            direction = BusRoute.Directions.ASC
-        elif direction == "D":
-            direction = BusRoute.Directions.DESC
-        elif direction == "C":
-            direction = BusRoute.Directions.CIRC
-        else:
-            direction = BusRoute.Directions.UNDEFINED
-
-        routes_dict[route_id, direction, route_variant].append(
-            int(row[RawColumnNames.stop_id])
-        )
-
-    routes = []
-
-    for key, values in routes_dict.items():
-        route_id, direction, route_variant = key
-
-        routes.append(
-            {
-                "route_id": str(route_id),
-                "route_direction": str(direction),
-                "route_variant": int(route_variant),
-                "route_stop_ids": values,
-            }
-        )
+    routes = get_routes(routes_df)
 
     routes_path = Path(f"{output_dir}/routes.json")
 
@@ -121,8 +185,13 @@ if __name__ == "__main__":
         help="output directory",
         default=config.PROCESSED_DATA_PATH,
     )
+    parser.add_argument(
+        "--cache-dir",
+        help="directory of the parsed excel cache, the excel's by default",
+        default=None,
+    )
 
     args = parser.parse_args()
     input_path = args.path[0]
     output_dir = args.output
-    process_carris_excel(input_path, output_dir)
+    process_carris_excel(input_path, output_dir, cache_dir=args.cache_dir)
@@ -1,9 +1,23 @@
 import json
 import argparse
+import tempfile
+from collections import Counter
 from pathlib import Path
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pv
+import pyarrow.compute as pc
 from rich import print
+from tqdm.auto import tqdm
 from odx import config
+from odx.afc_store import AFCStore
+from odx.afc_schema import (
+    CardMapping,
+    get_afc_schema,
+    parse_ints,
+    to_afc_table,
+)
 
 metro_col_mapping = {
     "date": "FECHA",
@@ -13,6 +27,76 @@ metro_col_mapping = {
     "way": "E_S",
 }
 
+way_mapping = {
+    "E": "IN",
+    "S": "OUT",
+}
+
+cols_to_save = ["timestamp", "stop_id", "card_id", "way"]
+
+# gate codes start with the two letter code of their station ('SP1' -> 'SP')
+STATION_CODE_LEN = 2
+
+# schema of the temporary files, as `AFC_FIELDS` without dictionaries
+spill_schema = pa.schema(
+    [
+        ("timestamp", pa.timestamp("ns")),
+        ("stop_id", pa.int32()),
+        ("card_id", pa.int32()),
+        ("way", pa.string()),
+    ]
+)
+
+
+class StationLookup:
+    """
+    Precomputed station code -> metro stop id lookup, from the
+    `metro_stop_mapping.json` mapping ({'SP': 'M46', ..}).
+
+    Gate codes are mapped by their station prefix ('SP1' -> 'SP' -> 46),
+    through a categorical with the mapped stations as categories,
+    so a whole array is mapped with a single take.
+    """
+
+    def __init__(self, metro_stop_mapping):
+        self.stations = pd.Index(sorted(metro_stop_mapping))
+        self.stop_ids = np.array(
+            [int(metro_stop_mapping[s][1:]) for s in self.stations],
+            dtype=np.int64,
+        )  # M46 -> 46
+
+    def get_stations(self, gates):
+        """Station codes of an arrow array of gate codes ('SP1' -> 'SP')"""
+        return pc.utf8_slice_codeunits(gates, 0, STATION_CODE_LEN)
+
+    def get_stop_ids(self, stations):
+        """
+        Stop ids of an arrow array of station codes, with a mask of the
+        stations that have no mapping (their stop id is -1)
+        """
+        codes = pd.Categorical(
+            stations.to_pandas(), categories=self.stations
+        ).codes
+        unmapped = codes < 0
+        return np.where(unmapped, -1, self.stop_ids[codes]), unmapped
+
+
+def parse_timestamps(dates, times, timestamp_format=None):
+    """
+    Parses string arrays of dates and times as one timestamp array:
+    ISO 8601 ones natively, others with pandas (`timestamp_format`,
+    or inferred). Invalid timestamps become NaT.
+    """
+    timestamps = pc.binary_join_element_wise(dates, times, " ")
+    if timestamp_format is None:
+        try:
+            return pc.cast(timestamps, pa.timestamp("ns")).to_pandas()
+        except pa.ArrowInvalid:
+            pass
+    return pd.to_datetime(
+        timestamps.to_pandas(), format=timestamp_format, errors="coerce"
+    )
+
 
 def process_metro_afc(
     path: str,
@@ -21,62 +105,208 @@ def process_metro_afc(
     encoding: str = "latin1",
     sep: str = ";",
     output_path: str = None,
-    **kwargs,
+    timestamp_format: str = None,
+    block_size: int = 64 * 2**20,
+    store_path: str = None,
+    n_buckets: int = None,
+    card_mapping_path: str = config.CARD_MAPPING_PATH,
+    partition_freq: str = "D",
+    tmp_dir: str = None,
+    max_unmapped_share: float = 0.01,
 ):
+    """
+    Processes metro raw AFC csv file.
+
+    The csv is read in blocks of `block_size` bytes by a multithreaded
+    reader, and every block is parsed with vectorized operations.
+    As in `process_carris_afc`, rows are spilled to temporary files by
+    `partition_freq` period, which are then deduplicated (by timestamp and
+    card) and sorted by timestamp one at a time, and appended to the
+    output, so memory is bounded by a block and a period of data.
+    Rows whose station has no mapping in `metro_stop_mapping_path`, or with
+    an invalid timestamp or card id, are dropped and reported. More than
+    `max_unmapped_share` of the rows without a station mapping aborts
+    the processing (the mapping is likely wrong or incomplete).
+    The output has the compact afc schema (see `odx.afc_schema`), with card
+    ids encoded by the card mapping in `card_mapping_path`.
+    """
     path = Path(path)
 
-    assert path.is_file(), "No such file {path}"
+    assert path.is_file(), f"No such file {path}"
 
     print(f"Reading stop mapping from {metro_stop_mapping_path}..")
     with open(metro_stop_mapping_path, "r") as f:
-        metro_stop_mapping = json.load(f)
+        station_lookup = StationLookup(json.load(f))
+
+    with open(path, encoding=encoding) as f:
+        header = f.readline().rstrip("\r\n").split(sep)
+
+    wrong_cols = [col for col in col_mapping.values() if col not in header]
+    if wrong_cols:
+        raise RuntimeError(f"Columns not found in csv: {wrong_cols}")
 
-    converters = {
-        col_mapping["way"]: {
-            "E": "IN",
-            "S": "OUT",
-        }.get,
-    }
+    # a set, as the multithreaded reader may report a row more than once
+    invalid_rows = set()
+
+    def skip_invalid_row(row):
+        invalid_rows.add(row.number)
+        return "skip"
 
     print(f"Reading raw CSV from {path}..\n")
-    df = pd.read_csv(
+    reader = pv.open_csv(
         path,
-        usecols=col_mapping.values(),
-        parse_dates=[[col_mapping["date"], col_mapping["time"]]],
-        converters=converters,
-        encoding="latin1",
-        sep=";",
-        nrows=100,
+        read_options=pv.ReadOptions(
+            encoding=encoding, block_size=block_size, use_threads=True
+        ),
+        parse_options=pv.ParseOptions(
+            delimiter=sep, invalid_row_handler=skip_invalid_row
+        ),
+        convert_options=pv.ConvertOptions(
+            include_columns=list(col_mapping.values()),
+            column_types={col: pa.string() for col in col_mapping.values()},
+            strings_can_be_null=True,
+        ),
     )
 
-    print("Applying col mapping..")
-    inv_col_mapping = {v: k for k, v in col_mapping.items()}
+    output_path = (
+        path.parent / (path.stem + "_processed.feather")
+        if output_path is None
+        else output_path
+    )
 
-    inv_col_mapping[
-        "_".join([col_mapping["date"], col_mapping["time"]])
-    ] = "timestamp"
-    df.rename(columns=inv_col_mapping, inplace=True)
+    card_mapping = CardMapping(card_mapping_path)
+    dictionaries = {"way": sorted(way_mapping.values())}
 
-    df["stop_id"] = df["stop_id"].apply(lambda x: x[:2])  # SP1 -> SP
+    n_rows = 0
+    n_invalid = 0
+    unmapped_stations = Counter()
 
-    df["stop_id"] = df["stop_id"].map(metro_stop_mapping)  # SP -> M46
+    # locked until saved (see `CardMapping`)
+    with card_mapping, tempfile.TemporaryDirectory(dir=tmp_dir) as spill_dir:
+        spill_writers = {}
 
-    df["stop_id"] = df["stop_id"].apply(lambda x: x[1:])  # M46 -> 46
+        for batch in tqdm(reader, unit="block"):
+            n_rows += batch.num_rows
 
-    df["stop_id"] = df["stop_id"].astype(int)
+            stations = station_lookup.get_stations(
+                batch.column(col_mapping["stop_id"])
+            )
+            stop_ids, unmapped = station_lookup.get_stop_ids(stations)
+            if unmapped.any():
+                unmapped_stations.update(
+                    stations.filter(pa.array(unmapped))
+                    .fill_null("")
+                    .to_pylist()
+                )
 
-    assert len(df) == len(
-        df.stop_id.dropna()
-    ), "Not every stop has a mapping, aborting.."
+            df = pd.DataFrame(
+                {
+                    "timestamp": parse_timestamps(
+                        batch.column(col_mapping["date"]),
+                        batch.column(col_mapping["time"]),
+                        timestamp_format,
+                    ),
+                    "stop_id": stop_ids,
+                    "card_id": parse_ints(
+                        batch.column(col_mapping["card_id"])
+                    ),
+                    "way": batch.column(col_mapping["way"])
+                    .to_pandas()
+                    .map(way_mapping),
+                }
+            )
 
-    output_path = (
-        path.parent / (path.stem + "_processed.feather")
-        if output_path is None
-        else output_path
-    )
+            invalid = (
+                df["timestamp"].isnull() | df["card_id"].isnull()
+            ).to_numpy()
+            n_invalid += (invalid & ~unmapped).sum()
+            df = df[~(invalid | unmapped)].assign(
+                card_id=lambda df: card_mapping.encode(
+                    df["card_id"].to_numpy(dtype=np.int64)
+                )
+            )
+
+            periods = df["timestamp"].dt.floor(partition_freq)
+            for period, period_df in df.groupby(periods, sort=False):
+                if period not in spill_writers:
+                    spill_writers[period] = pa.ipc.new_stream(
+                        Path(spill_dir) / f"{period.value}.arrow",
+                        spill_schema,
+                    )
+                spill_writers[period].write_table(
+                    pa.Table.from_pandas(
+                        period_df,
+                        schema=spill_schema,
+                        preserve_index=False,
+                    )
+                )
+
+        for writer in spill_writers.values():
+            writer.close()
+
+        print(f"Read {n_rows} rows")
+        if invalid_rows:
+            print(
+                f"[red]Skipped {len(invalid_rows)} malformed rows "
+                f"(rows {sorted(invalid_rows)[:10]}..)"
+            )
+        n_unmapped = sum(unmapped_stations.values())
+        if n_unmapped > max_unmapped_share * n_rows:
+            raise ValueError(
+                f"{n_unmapped}/{n_rows} rows of stations without a mapping "
+                f"in {metro_stop_mapping_path}: "
+                f"{dict(unmapped_stations.most_common(10))}, aborting.."
+            )
+        if unmapped_stations:
+            print(
+                f"[red]Dropped {n_unmapped} rows of "
+                f"{len(unmapped_stations)} stations without a mapping: "
+                f"{dict(unmapped_stations.most_common(10))}"
+            )
+        if n_invalid:
+            print(
+                f"[red]Dropped {n_invalid} rows with invalid timestamps "
+                "or card ids"
+            )
+
+        print(
+            f"Dropping duplicates and sorting by timestamp, "
+            f"in {len(spill_writers)} periods.."
+        )
+        n_saved = 0
+        with pa.ipc.new_file(
+            output_path,
+            get_afc_schema(cols_to_save),
+            options=pa.ipc.IpcWriteOptions(compression="lz4"),
+        ) as output:
+            for period in tqdm(sorted(spill_writers)):
+                with pa.ipc.open_stream(
+                    Path(spill_dir) / f"{period.value}.arrow"
+                ) as spill:
+                    df = spill.read_pandas(
+                        types_mapper={pa.int32(): pd.Int32Dtype()}.get
+                    )
+
+                # drop entries that have the same timestamp, card_id pair
+                df.drop_duplicates(
+                    subset=["timestamp", "card_id"], inplace=True
+                )
+                df.sort_values(
+                    by="timestamp",
+                    kind="stable",
+                    ignore_index=True,
+                    inplace=True,
+                )
+                n_saved += len(df)
+                output.write_table(to_afc_table(df, dictionaries))
 
-    print(f"Saving processed dataframe to {output_path}..")
-    df.to_feather(output_path)
+        card_mapping.save()
+    print(f"Saved processed dataframe ({n_saved} rows) to {output_path}")
+
+    if store_path is not None:
+        store = AFCStore(store_path, n_buckets)
+        print(f"Appending processed afc to {store}..")
+        store.append_file(output_path, config.AFC_STORE_OPERATORS["metro"])
 
 
 if __name__ == "__main__":
@@ -88,9 +318,39 @@ if __name__ == "__main__":
         help="output path",
         default=config.PROCESSED_METRO_AFC_PATH,
     )
+    parser.add_argument(
+        "--block-size",
+        type=int,
+        help="csv block size, in MB",
+        default=64,
+    )
+    parser.add_argument(
+        "--tmp-dir",
+        help="directory for temporary files, system default if not given",
+        default=None,
+    )
+    parser.add_argument(
+        "--store",
+        help="afc store to also append the processed afc to",
+        default=None,
+    )
+    parser.add_argument(
+        "--buckets",
+        type=int,
+        help="number of card buckets of a new afc store",
+        default=None,
+    )
 
     args = parser.parse_args()
     input_path = args.path[0]
     output_path = args.output
 
-    process_metro_afc(input_path, metro_col_mapping, output_path=output_path)
+    process_metro_afc(
+        input_path,
+        metro_col_mapping,
+        output_path=output_path,
+        block_size=args.block_size * 2**20,
+        store_path=args.store,
+        n_buckets=args.buckets,
+        tmp_dir=args.tmp_dir,
+    )